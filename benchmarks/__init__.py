@@ -0,0 +1,4 @@
+"""Benchmarks for the wiki backend.
+
+Each module can be run on its own, e.g. `python -m benchmarks.revisions`.
+"""
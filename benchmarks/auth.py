@@ -0,0 +1,85 @@
+"""Measures the cost of authenticating requests during a login storm.
+
+Replays a burst of logins from a small set of users (plus some attempts with
+unknown usernames) and the session requests that follow them, against a
+user bucket with a simulated round-trip latency. Reports the reads that hit
+the user bucket and the mean time per request, with the user caches disabled
+and enabled.
+
+Usage: python -m benchmarks.auth [--users N] [--requests N] [--latency MS]
+"""
+
+from benchmarks.fakes import LatencyStorage
+from flaskr.backend import Backend
+from flaskr.cache import LRUCache
+from flaskr.storage import LocalStorage
+import argparse
+import random
+import tempfile
+import time
+
+
+def make_requests(users, count, seed=0):
+    """Returns (kind, username) pairs: logins, failed logins and sessions."""
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.3:
+            requests.append(('login', f'user{rng.randrange(users)}'))
+        elif roll < 0.4:
+            requests.append(('login', f'nobody{rng.randrange(users)}'))
+        else:
+            requests.append(('session', f'user{rng.randrange(users)}'))
+    return requests
+
+
+def replay(backend, requests):
+    for kind, username in requests:
+        if kind == 'session':
+            backend.get_user(username)
+            continue
+        try:
+            backend.sign_in(username, 'password')
+        except ValueError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=5.0)
+    args = parser.parse_args()
+
+    requests = make_requests(args.users, args.requests)
+    print(f'{args.requests} requests from {args.users} users, '
+          f'{args.latency} ms per user bucket call')
+    print(f'{"user cache":<12}{"bucket reads":>14}{"mean ms":>10}')
+    for label, size in (('disabled', 0), ('enabled', 1024)):
+        with tempfile.TemporaryDirectory() as root:
+            users = LatencyStorage(LocalStorage(root))
+            backend = Backend(user_storage=users,
+                              content_storage=LocalStorage(root),
+                              user_cache=LRUCache(size, 300),
+                              unknown_user_cache=LRUCache(size, 10))
+            for i in range(args.users):
+                backend.sign_up(f'user{i}', 'password')
+            # start cold, as after a deploy
+            backend = Backend(user_storage=users,
+                              content_storage=LocalStorage(root),
+                              user_cache=LRUCache(size, 300),
+                              unknown_user_cache=LRUCache(size, 10))
+            users.calls.clear()
+            users.latency = args.latency / 1000
+            start = time.perf_counter()
+            replay(backend, requests)
+            elapsed = time.perf_counter() - start
+        reads = sum(count for operation, count in users.calls.items()
+                    if operation != 'put')
+        print(f'{label:<12}{reads:>14}'
+              f'{elapsed / len(requests) * 1000:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""A storage engine that behaves like a remote bucket, for benchmarks."""
+
+from collections import Counter
+from flaskr.storage import Storage
+import random
+import threading
+import time
+
+
+class LatencyStorage(Storage):
+    """Wraps a storage engine, counting calls and delaying each one.
+
+    Every operation sleeps for latency seconds, plus or minus up to jitter
+    seconds, before running on the wrapped engine (usually a LocalStorage),
+    like a round trip to a bucket. Calls are counted in self.calls by
+    operation name. Iterating a listing counts as one call.
+    """
+
+    def __init__(self, storage, latency=0.0, jitter=0.0, seed=0):
+        self.storage = storage
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # e.g. the bucket of a GcsStorage for URL signing
+        return getattr(self.storage, name)
+
+    def _round_trip(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+            delay = self.latency
+            if self.jitter:
+                delay += self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def get(self, name):
+        self._round_trip('get')
+        return self.storage.get(name)
+
+    def get_with_info(self, name):
+        self._round_trip('get_with_info')
+        return self.storage.get_with_info(name)
+
+    def get_range(self, name, start, end=None):
+        self._round_trip('get_range')
+        return self.storage.get_range(name, start, end)
+
+    def stat(self, name):
+        self._round_trip('stat')
+        return self.storage.stat(name)
+
+    def open(self, name, generation=None):
+        self._round_trip('open')
+        return self.storage.open(name, generation)
+
+    def put(self, name, data, if_generation_match=None):
+        self._round_trip('put')
+        return self.storage.put(name, data, if_generation_match)
+
+    def compose(self, name, sources, if_generation_match=None):
+        self._round_trip('compose')
+        return self.storage.compose(name, sources, if_generation_match)
+
+    def copy(self, source, destination, source_generation=None,
+             if_generation_match=None):
+        self._round_trip('copy')
+        return self.storage.copy(source, destination, source_generation,
+                                 if_generation_match)
+
+    def list(self, prefix=None):
+        self._round_trip('list')
+        return self.storage.list(prefix)
+
+    def exists(self, name):
+        self._round_trip('exists')
+        return self.storage.exists(name)
+
+    def delete(self, name):
+        self._round_trip('delete')
+        return self.storage.delete(name)
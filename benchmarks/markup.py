@@ -0,0 +1,91 @@
+"""Checks that wiki markup renders in time linear in the page size.
+
+Renders generated pages of growing size, both realistic ones (headings,
+lists, links, emphasis) and pathological ones full of unmatched delimiters,
+and reports the time per page and the throughput. Linear parsing shows up
+as a flat MB/s column. Also reports the cost of a cached render.
+
+Usage: python -m benchmarks.markup [--sizes KB,KB,...] [--repeat N]
+"""
+
+from flaskr import markup
+from flaskr.cache import LRUCache
+import argparse
+import random
+import time
+
+SECTION = '''## Section {i}
+
+Some *emphasis*, some **strong text**, `inline code` and a link to
+[[Page {i}]] or [an external site](https://example.com/{i}).
+
+- first item with [[Another Page|a label]]
+- second item
+- third item
+
+> A quote with **bold** words.
+
+```
+code block {i}
+```
+'''
+
+PATHOLOGICAL = {
+    'unmatched *': '*',
+    'unmatched [': '[',
+    'unmatched [[': '[[',
+    'unclosed links': '[a](',
+    'star runs': '**a',
+}
+
+
+def realistic(size):
+    sections = []
+    total = 0
+    i = 0
+    while total < size:
+        sections.append(SECTION.format(i=i))
+        total += len(sections[-1])
+        i += 1
+    return ''.join(sections)
+
+
+def best_time(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10,100,1000,4000')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    sizes = [int(size) * 1024 for size in args.sizes.split(',')]
+
+    pages = {'realistic': realistic}
+    for label, unit in PATHOLOGICAL.items():
+        pages[label] = lambda size, unit=unit: unit * (size // len(unit))
+
+    print(f'{"page":<16}{"KB":>7}{"render ms":>11}{"MB/s":>8}')
+    for label, make_page in pages.items():
+        for size in sizes:
+            text = make_page(size)
+            seconds = best_time(
+                lambda: markup.to_html(markup.parse(text)), args.repeat)
+            print(f'{label:<16}{size // 1024:>7}{seconds * 1000:>11.1f}'
+                  f'{len(text) / seconds / 1024 / 1024:>8.1f}')
+
+    text = realistic(sizes[-1])
+    renderer = markup.Renderer(LRUCache(16))
+    renderer.render(text)
+    cached = best_time(lambda: renderer.render(text), args.repeat)
+    print(f'\ncached render of {sizes[-1] // 1024} KB: {cached * 1000:.2f} ms '
+          f'(hashing the content)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Reports logins per second for each password hashing cost.
+
+Simulates web workers checking passwords concurrently through a
+PasswordHasher and reports the throughput and latency of a login at each
+scheme and cost, so PASSWORD_HASH_COST can be picked for the hardware the
+wiki runs on. A common target is a median login of 50-250 ms.
+
+Usage: python -m benchmarks.passwords [--threads N] [--workers N]
+                                      [--seconds S]
+"""
+
+from flaskr.passwords import PBKDF2, SCRYPT, PasswordHasher
+import argparse
+import statistics
+import threading
+import time
+
+COSTS = {
+    SCRYPT: [2**13, 2**14, 2**15, 2**16],
+    PBKDF2: [100000, 300000, 600000, 1200000],
+}
+
+
+def run(hasher, threads, seconds):
+    """Returns (logins per second, login latencies in seconds)."""
+    record = hasher.hash('password')
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            assert hasher.verify(record, 'password', 'user')
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return len(latencies) / (time.perf_counter() - start), latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+
+    print(f'{args.threads} request threads, {args.workers} hashing workers')
+    print(f'{"scheme":<15}{"cost":>9}{"logins/s":>10}{"p50 ms":>9}'
+          f'{"p95 ms":>9}')
+    for scheme, costs in COSTS.items():
+        for cost in costs:
+            hasher = PasswordHasher(scheme,
+                                    cost,
+                                    max_workers=args.workers,
+                                    max_pending=args.threads)
+            rate, latencies = run(hasher, args.threads, args.seconds)
+            quantiles = statistics.quantiles(latencies, n=20)
+            print(f'{scheme:<15}{cost:>9}{rate:>10.1f}'
+                  f'{statistics.median(latencies) * 1000:>9.1f}'
+                  f'{quantiles[18] * 1000:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
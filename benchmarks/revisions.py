@@ -0,0 +1,104 @@
+"""Compares full-copy page history with the delta-compressed RevisionStore.
+
+Simulates a page receiving a number of small edits and reports, for both
+schemes, the bytes stored under history/ and how long it takes to rebuild
+every previous version.
+
+Usage: python -m benchmarks.revisions [--lines N] [--edits N] [--interval N]
+"""
+
+from flaskr.revisions import RevisionStore
+from flaskr.storage import LocalStorage
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+
+def make_versions(lines, edits, seed=0):
+    """Returns edits + 1 versions of a page, each a small edit of the last."""
+    rng = random.Random(seed)
+    page = [
+        f'Line {i}: ' + 'lorem ipsum dolor sit amet ' * 3 for i in range(lines)
+    ]
+    versions = ['\n'.join(page)]
+    for edit in range(edits):
+        position = rng.randrange(len(page))
+        if rng.random() < 0.7:
+            page[position] = f'Edited line {edit}: ' + page[position][:40]
+        else:
+            page.insert(position, f'New line added in edit {edit}')
+        versions.append('\n'.join(page))
+    return versions
+
+
+def history_bytes(root):
+    total = 0
+    for directory, _, files in os.walk(root):
+        total += sum(os.path.getsize(os.path.join(directory, f)) for f in files)
+    return total
+
+
+def run_full_copies(storage, versions):
+    # the scheme used before RevisionStore: one full copy per edit
+    names = []
+    for i, old in enumerate(versions[:-1]):
+        name = f'history/Page-{20230101000000 + i}-user.txt'
+        storage.put(name, old)
+        names.append(name)
+    storage.put('Page', versions[-1])
+    return [lambda name=name: storage.get(name).decode() for name in names]
+
+
+def run_revision_store(storage, versions, interval):
+    store = RevisionStore(storage, interval)
+    storage.put('Page', versions[0])
+    for old, new in zip(versions, versions[1:]):
+        store.record('Page', old, new, 'user')
+        storage.put('Page', new)
+    current = lambda: storage.get('Page').decode()
+    return [
+        lambda name=revision.name: store.content('Page', name, current)
+        for revision in reversed(store.list('Page'))
+    ]
+
+
+def measure(readers, versions):
+    latencies = []
+    for reader, expected in zip(readers, versions):
+        start = time.perf_counter()
+        content = reader()
+        latencies.append(time.perf_counter() - start)
+        assert content == expected
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=500)
+    parser.add_argument('--edits', type=int, default=200)
+    parser.add_argument('--interval', type=int, default=10)
+    args = parser.parse_args()
+
+    versions = make_versions(args.lines, args.edits)
+    print(f'{args.edits} edits of a {len(versions[-1])} byte page, '
+          f'snapshot interval {args.interval}')
+    print(f'{"scheme":<16}{"history bytes":>15}{"mean ms":>10}{"max ms":>10}')
+    for label in ('full copies', 'revision store'):
+        with tempfile.TemporaryDirectory() as root:
+            storage = LocalStorage(root)
+            if label == 'full copies':
+                readers = run_full_copies(storage, versions)
+            else:
+                readers = run_revision_store(storage, versions, args.interval)
+            latencies = measure(readers, versions[:-1])
+            size = history_bytes(os.path.join(root, 'history@'))
+        print(f'{label:<16}{size:>15}'
+              f'{statistics.mean(latencies) * 1000:>10.2f}'
+              f'{max(latencies) * 1000:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
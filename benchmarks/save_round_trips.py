@@ -0,0 +1,83 @@
+"""Counts the storage round trips and latency of saving a page.
+
+Every storage call is counted and delayed by a simulated round-trip time.
+Three save paths are compared:
+
+- before: the original sequence (exists, read, full history copy upload,
+  content upload), one call after the other
+- after, cold: Backend.save_wiki_page when the page is not cached
+- after, warm: the same right after the page was viewed, the usual case since
+  edits are made from the page view
+
+Reports the storage calls per save, the calls on the critical path (saves
+run the history and content writes at the same time) and the mean latency.
+
+Usage: python -m benchmarks.save_round_trips [--saves N] [--latency MS]
+                                             [--interval N]
+"""
+
+from benchmarks.fakes import LatencyStorage
+from flaskr.backend import Backend
+from flaskr.cache import LRUCache
+from flaskr.storage import LocalStorage
+import argparse
+import tempfile
+import time
+
+
+def legacy_save(storage, page_name, content, username, number):
+    """The save path before conditional writes and delta history."""
+    if storage.exists(page_name):
+        current = storage.get(page_name)
+        storage.put(f'history/{page_name}-{20230101000000 + number}-'
+                    f'{username}.txt', current)
+        storage.put(page_name, content)
+
+
+def run(label, saves, latency, interval):
+    with tempfile.TemporaryDirectory() as root:
+        storage = LatencyStorage(LocalStorage(root))
+        backend = Backend(user_storage=LocalStorage(root),
+                          content_storage=storage,
+                          page_cache=LRUCache(16, 60),
+                          snapshot_interval=interval)
+        backend.upload('Page', b'line\n' * 200)
+        backend.rebuild_search_index()
+        storage.latency = latency
+        elapsed = 0
+        for i in range(saves):
+            content = 'line\n' * 200 + f'edit {i}\n'
+            if label == 'after, warm':
+                backend.get_wiki_page('Page')
+            elif label == 'after, cold':
+                backend.page_cache.clear()
+            storage.calls.clear()
+            start = time.perf_counter()
+            if label == 'before':
+                legacy_save(storage, 'Page', content, 'user', i)
+            else:
+                backend.save_wiki_page('Page', content, 'user')
+            elapsed += time.perf_counter() - start
+            calls = sum(storage.calls.values())
+        return calls, elapsed / saves, storage.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--saves', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=20.0)
+    parser.add_argument('--interval', type=int, default=10)
+    args = parser.parse_args()
+
+    latency = args.latency / 1000
+    print(f'{args.saves} saves, {args.latency} ms per storage call')
+    print(f'{"path":<14}{"calls":>7}{"on critical path":>18}{"mean ms":>10}'
+          f'  last save')
+    for label in ('before', 'after, cold', 'after, warm'):
+        calls, mean, last = run(label, args.saves, latency, args.interval)
+        print(f'{label:<14}{calls:>7}{mean / latency:>18.1f}'
+              f'{mean * 1000:>10.1f}  {dict(last)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Measures worker memory while uploading files of growing size.
+
+Each upload runs in a fresh process that posts a file to /upload and reports
+how much its peak resident set size grew during the request. The 'buffered'
+mode reads the whole file before storing it, like the upload path used to;
+'streamed' is the current path copying it to storage in chunks, whose peak
+should stay flat however big the file is.
+
+Usage: python -m benchmarks.upload_memory [--sizes MB [MB ...]]
+"""
+
+from flaskr import create_app
+from flaskr.backend import Backend
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+MB = 1024 * 1024
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_file(path, size):
+    chunk = os.urandom(MB)
+    with open(path, 'wb') as f:
+        for offset in range(0, size, MB):
+            f.write(chunk[:min(MB, size - offset)])
+
+
+def upload_once(mode, size):
+    """Uploads a file of size bytes and returns (seconds, peak KB growth)."""
+    with tempfile.TemporaryDirectory() as root:
+        app = create_app({
+            'TESTING': True,
+            'LOGIN_DISABLED': True,
+            'STORAGE_ENGINE': 'local',
+            'STORAGE_ROOT': os.path.join(root, 'storage'),
+            'MAX_CONTENT_LENGTH': None,
+        })
+        if mode == 'buffered':
+            upload = Backend.upload
+            Backend.upload = lambda self, name, data: upload(
+                self, name, data.read())
+        path = os.path.join(root, 'upload.bin')
+        write_file(path, size)
+        client = app.test_client()
+        baseline = peak_rss_kb()
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            resp = client.post('/upload',
+                               data={
+                                   'wikiname': 'upload',
+                                   'wikicontent': (f, 'upload.bin')
+                               })
+        elapsed = time.perf_counter() - start
+        assert resp.status_code == 302, resp.status_code
+        return elapsed, peak_rss_kb() - baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[8, 32, 128])
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        elapsed, growth = upload_once(args.child[0], int(args.child[1]))
+        print(elapsed, growth)
+        return
+
+    print(f'{"mode":<10}{"size MB":>9}{"seconds":>10}{"peak RSS growth MB":>20}')
+    for mode in ('buffered', 'streamed'):
+        for size in args.sizes:
+            # a new process per upload, so every run starts from a clean peak
+            command = [
+                sys.executable, '-m', 'benchmarks.upload_memory', '--child',
+                mode,
+                str(size * MB)
+            ]
+            output = subprocess.run(command,
+                                    check=True,
+                                    capture_output=True,
+                                    text=True).stdout
+            elapsed, growth = output.split()
+            print(f'{mode:<10}{size:>9}{float(elapsed):>10.2f}'
+                  f'{int(growth) / 1024:>20.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""Measures the wiki's main requests against a synthetic wiki.
+
+Generates a wiki of --pages pages with --revisions saved edits each and
+--images images on local disk, then serves it through the Flask app with
+every bucket call delayed by --latency ms (plus or minus --jitter ms), like
+a remote bucket. Each scenario sends --requests requests from --threads
+concurrent clients:
+
+- view: GET /pages/<page> of a random page
+- list: GET /pages
+- edit: POST /save_changes of a random page
+- history: GET /pages/<page>/previous_version of a random page
+- upload: POST /upload of a new --image-size byte image
+
+and reports the throughput, latency percentiles and bucket calls per
+request, and the errors: responses with a 4xx or 5xx status and requests
+that raised an exception. Everything random is seeded, so runs with the
+same options send the same requests.
+
+--output saves the results as JSON. --compare reads a previous results file
+and flags every scenario whose p50 latency grew, or whose throughput fell,
+by more than --threshold (a fraction); the exit status is 1 if any did.
+
+Usage: python -m benchmarks.wiki [--pages N] [--revisions N] [--images N]
+                                 [--requests N] [--threads N]
+                                 [--latency MS] [--jitter MS]
+                                 [--scenarios view,list,...]
+                                 [--output FILE] [--compare FILE]
+                                 [--threshold F]
+"""
+
+from benchmarks.fakes import LatencyStorage
+from concurrent.futures import ThreadPoolExecutor
+from flaskr.backend import Backend
+from flaskr.storage import LocalStorage, USER_BUCKET_NAME, CONTENT_BUCKET_NAME
+from io import BytesIO
+from unittest.mock import patch
+import argparse
+import flaskr
+import itertools
+import json
+import os
+import platform
+import queue
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+SCENARIOS = ('view', 'list', 'edit', 'history', 'upload')
+USERNAME = 'bench'
+PASSWORD = 'bench-password'
+WORDS = ('sega nintendo console cartridge arcade controller genesis '
+         'dreamcast saturn famicom handheld sprite pixel sound chip '
+         'release sales japan europe america').split()
+
+
+def page_text(rng, paragraphs=8):
+    return '\n\n'.join(' '.join(rng.choices(WORDS, k=60))
+                       for _ in range(paragraphs))
+
+
+def generate(root, pages, revisions, images, seed=0):
+    """Writes a synthetic wiki under root, returning its page names."""
+    rng = random.Random(seed)
+    backend = Backend(
+        user_storage=LocalStorage(os.path.join(root, USER_BUCKET_NAME)),
+        content_storage=LocalStorage(os.path.join(root, CONTENT_BUCKET_NAME)))
+    backend.sign_up(USERNAME, PASSWORD)
+    names = [f'Page {i:05d}' for i in range(pages)]
+    for name in names:
+        text = page_text(rng)
+        backend.upload(name, text.encode())
+        for revision in range(revisions):
+            text += f'\n\nEdit {revision}: ' + ' '.join(rng.choices(WORDS,
+                                                                    k=20))
+            backend.save_wiki_page(name, text, USERNAME)
+    for i in range(images):
+        backend.upload(f'image{i:05d}.png', rng.randbytes(4096))
+    backend.rebuild_page_index()
+    backend.rebuild_search_index()
+    return names
+
+
+def make_app(root, storages, latency, jitter):
+    """Returns the wiki app with every bucket wrapped in a LatencyStorage."""
+
+    def storage_from_config(config, bucket_name):
+        storage = LatencyStorage(LocalStorage(os.path.join(root, bucket_name)),
+                                 latency, jitter, seed=len(storages))
+        storages.append(storage)
+        return storage
+
+    with patch.object(flaskr, 'storage_from_config', storage_from_config):
+        return flaskr.create_app({
+            'TESTING': True,
+            'STORAGE_ENGINE': 'local',
+            'STORAGE_ROOT': root,
+            'METRICS_ENABLED': False,
+        })
+
+
+def logged_in_clients(app, count):
+    """Returns a queue of count test clients logged in as USERNAME."""
+    clients = queue.Queue()
+    for _ in range(count):
+        client = app.test_client()
+        client.post('/login',
+                    data={
+                        'username': USERNAME,
+                        'password': PASSWORD
+                    })
+        clients.put(client)
+    return clients
+
+
+def make_requests(scenario, names, count, image_size, seed=0):
+    """Returns count functions sending one request of a scenario each."""
+    rng = random.Random(seed)
+    requests = []
+    for i in range(count):
+        name = rng.choice(names)
+        if scenario == 'view':
+            requests.append(lambda c, name=name: c.get(f'/pages/{name}'))
+        elif scenario == 'list':
+            requests.append(lambda c: c.get('/pages'))
+        elif scenario == 'edit':
+            data = {'page_name': name, 'content': page_text(rng, 4)}
+            requests.append(
+                lambda c, data=data: c.post('/save_changes', data=data))
+        elif scenario == 'history':
+            requests.append(
+                lambda c, name=name: c.get(f'/pages/{name}/previous_version'))
+        else:
+            body = rng.randbytes(image_size)
+            requests.append(lambda c, i=i, body=body: c.post(
+                '/upload',
+                data={
+                    'wikiname': f'upload-{seed}-{i}.png',
+                    'wikicontent': (BytesIO(body), 'upload.png')
+                },
+                content_type='multipart/form-data'))
+    return requests
+
+
+def run_scenario(clients, storages, requests, threads):
+    """Sends the requests, returning the scenario's results."""
+    for storage in storages:
+        storage.calls.clear()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def send(request):
+        nonlocal errors
+        client = clients.get()
+        start = time.perf_counter()
+        try:
+            failed = request(client).status_code >= 400
+        except Exception:
+            # with TESTING, errors in a view are raised by the test client
+            # instead of becoming a 500
+            failed = True
+        finally:
+            elapsed = time.perf_counter() - start
+            # the other threads wait for this client
+            clients.put(client)
+        with lock:
+            latencies.append(elapsed)
+            if failed:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(send, requests))
+    seconds = time.perf_counter() - start
+    calls = sum(sum(storage.calls.values()) for storage in storages)
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {
+        'requests': len(requests),
+        'errors': errors,
+        'seconds': seconds,
+        'throughput': len(requests) / seconds,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': quantiles[49] * 1000,
+        'p90_ms': quantiles[89] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'storage_calls': calls / len(requests),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Prints the change against baseline, returning the regressions."""
+    if baseline['config'] != results['config']:
+        print('warning: the baseline was run with different options: '
+              f'{baseline["config"]}')
+    regressions = []
+    print(f'\n{"scenario":<10}{"p50 change":>12}{"throughput change":>19}')
+    for scenario, current in results['scenarios'].items():
+        previous = baseline['scenarios'].get(scenario)
+        if previous is None:
+            continue
+        latency = current['p50_ms'] / previous['p50_ms'] - 1
+        throughput = current['throughput'] / previous['throughput'] - 1
+        regressed = latency > threshold or throughput < -threshold
+        if regressed:
+            regressions.append(scenario)
+        print(f'{scenario:<10}{latency:>+12.1%}{throughput:>+19.1%}'
+              f'{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--revisions', type=int, default=5)
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--image-size', type=int, default=64 * 1024)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=10.0)
+    parser.add_argument('--jitter', type=float, default=2.0)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f'unknown scenario {scenario}')
+    config = {
+        key: getattr(args, key) for key in ('pages', 'revisions', 'images',
+                                            'image_size', 'requests',
+                                            'threads', 'latency', 'jitter',
+                                            'seed')
+    }
+    results = {
+        'config': config,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'scenarios': {},
+    }
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        names = generate(root, args.pages, args.revisions, args.images,
+                         args.seed)
+        print(f'Generated {args.pages} pages x {args.revisions} revisions '
+              f'and {args.images} images in '
+              f'{time.perf_counter() - start:.1f}s')
+        storages = []
+        app = make_app(root, storages, args.latency / 1000,
+                       args.jitter / 1000)
+        clients = logged_in_clients(app, args.threads)
+        print(f'{args.requests} requests per scenario, {args.threads} '
+              f'threads, {args.latency} +/- {args.jitter} ms per bucket call')
+        print(f'{"scenario":<10}{"req/s":>8}{"mean ms":>9}{"p50 ms":>9}'
+              f'{"p90 ms":>9}{"p99 ms":>9}{"calls/req":>11}{"errors":>8}')
+        for number, scenario in zip(itertools.count(), scenarios):
+            requests = make_requests(scenario, names, args.requests,
+                                     args.image_size, args.seed + number)
+            result = run_scenario(clients, storages, requests, args.threads)
+            results['scenarios'][scenario] = result
+            print(f'{scenario:<10}{result["throughput"]:>8.1f}'
+                  f'{result["mean_ms"]:>9.1f}{result["p50_ms"]:>9.1f}'
+                  f'{result["p90_ms"]:>9.1f}{result["p99_ms"]:>9.1f}'
+                  f'{result["storage_calls"]:>11.1f}{result["errors"]:>8}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
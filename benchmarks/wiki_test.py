@@ -0,0 +1,35 @@
+from benchmarks import wiki
+from unittest.mock import patch
+import pytest
+
+
+@pytest.fixture
+def wiki_app(tmp_path):
+    root = str(tmp_path)
+    names = wiki.generate(root, pages=3, revisions=2, images=1)
+    storages = []
+    app = wiki.make_app(root, storages, latency=0, jitter=0)
+    return names, storages, wiki.logged_in_clients(app, 2)
+
+
+@pytest.mark.parametrize('scenario', wiki.SCENARIOS)
+def test_scenario_runs_without_errors(wiki_app, scenario):
+    names, storages, clients = wiki_app
+    requests = wiki.make_requests(scenario, names, 4, image_size=64)
+
+    result = wiki.run_scenario(clients, storages, requests, threads=2)
+
+    assert result['requests'] == 4
+    assert result['errors'] == 0
+    assert result['storage_calls'] > 0
+
+
+def test_raised_exceptions_are_errors(wiki_app):
+    names, storages, clients = wiki_app
+    requests = wiki.make_requests('history', names, 4, image_size=64)
+
+    with patch('flaskr.backend.Backend.get_previous_version',
+               side_effect=RuntimeError('storage unavailable')):
+        result = wiki.run_scenario(clients, storages, requests, threads=2)
+
+    assert result['errors'] == 4
@@ -1,9 +1,13 @@
-from flaskr import pages, login, upload
+from flaskr import pages, login, upload, signing, passwords, archive, metrics, profiling, thumbnails
 from flaskr.backend import Backend  # import our Backend implementation
+from flaskr.cache import LRUCache
+from flaskr.storage import storage_from_config, USER_BUCKET_NAME, CONTENT_BUCKET_NAME
 from flask_login import LoginManager
 from flask import Flask
 
+import click
 import logging
+import os
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -17,7 +21,62 @@ def create_app(test_config=None):
 
     # This is the default secret key used for login sessions
     # By default the dev environment uses the key 'dev'
-    app.config.from_mapping(SECRET_KEY='dev',)
+    app.config.from_mapping(
+        SECRET_KEY='dev',
+        # 'gcs' buckets in production or 'local' files under STORAGE_ROOT
+        STORAGE_ENGINE='gcs',
+        STORAGE_ROOT=os.path.join(app.instance_path, 'storage'),
+        # in-process caches: number of entries and seconds to live
+        PAGE_CACHE_SIZE=256,
+        PAGE_CACHE_TTL=60,
+        RENDERED_CACHE_SIZE=512,
+        MARKUP_CACHE_SIZE=1024,
+        DIFF_CACHE_SIZE=128,
+        HISTORY_PER_PAGE=50,
+        # seconds browsers may reuse a page shown to anonymous users
+        PAGE_MAX_AGE=60,
+        USER_CACHE_SIZE=1024,
+        USER_CACHE_TTL=300,
+        UNKNOWN_USER_CACHE_TTL=10,
+        # see `python -m benchmarks.passwords` to pick the scheme and cost
+        PASSWORD_HASH_SCHEME='scrypt',
+        PASSWORD_HASH_COST=None,
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_MAX_PENDING=32,
+        SEARCH_RESULTS=20,
+        SEARCH_MAX_RESULTS=100,
+        # seconds a worker uses its copy of the search and link indexes
+        SEARCH_INDEX_MAX_AGE=5,
+        # threads running a request's independent storage calls
+        STORAGE_IO_WORKERS=8,
+        PAGES_PER_PAGE=100,
+        PAGES_MAX_PER_PAGE=1000,
+        PAGES_STREAM=False,
+        # every how many revisions a full copy is stored instead of a delta
+        HISTORY_SNAPSHOT_INTERVAL=10,
+        IMAGE_MAX_AGE=3600,
+        # scaling images needs Pillow, otherwise originals are sent
+        IMAGE_VARIANT_WIDTHS=thumbnails.DEFAULT_WIDTHS,
+        IMAGE_VARIANT_CACHE_SIZE=128,
+        # send image downloads and uploads straight to storage
+        SIGNED_URLS=False,
+        SIGNED_URL_TTL=300,
+        # bigger files use resumable uploads, see flaskr.upload
+        MAX_CONTENT_LENGTH=32 * 1024 * 1024,
+        UPLOAD_CHUNK_SIZE=8 * 1024 * 1024,
+        UPLOAD_MAX_SIZE=1024 * 1024 * 1024,
+        # /metrics, see flaskr.metrics; set a token before exposing it
+        METRICS_ENABLED=False,
+        METRICS_TOKEN=None,
+        METRICS_SAMPLE_RATE=1.0,
+        # profiling of slow endpoints, see flaskr.profiling; set a token
+        # before exposing it
+        PROFILE_ENABLED=False,
+        PROFILE_TOKEN=None,
+        PROFILE_ENDPOINTS=('pages', 'show_page', 'save_changes'),
+        PROFILE_SAMPLE_RATE=0.1,
+        PROFILE_DIR=os.path.join(app.instance_path, 'profiles'),
+    )
 
     if test_config is None:
         # Load the instance config, if it exists, when not testing.
@@ -34,13 +93,165 @@ def create_app(test_config=None):
     # set the default login view to /login
     login_manager.login_view = 'login'
 
-    # initialize instance of our Backend
-    backend = Backend()
+    # initialize instance of our Backend on top of the configured storage
+    content_storage = storage_from_config(app.config, CONTENT_BUCKET_NAME)
+    user_storage = storage_from_config(app.config, USER_BUCKET_NAME)
+    registry = None
+    if app.config['METRICS_ENABLED']:
+        registry = metrics.Registry(app.config['METRICS_SAMPLE_RATE'])
+        metrics.instrument_storage(content_storage, registry, 'content')
+        metrics.instrument_storage(user_storage, registry, 'users')
+    url_signer = signing.signer_from_config(app.config, content_storage)
+    backend = Backend(
+        user_storage=user_storage,
+        content_storage=content_storage,
+        page_cache=LRUCache(app.config['PAGE_CACHE_SIZE'],
+                            app.config['PAGE_CACHE_TTL']),
+        snapshot_interval=app.config['HISTORY_SNAPSHOT_INTERVAL'],
+        url_signer=url_signer,
+        rendered_cache=LRUCache(app.config['RENDERED_CACHE_SIZE']),
+        user_cache=LRUCache(app.config['USER_CACHE_SIZE'],
+                            app.config['USER_CACHE_TTL']),
+        unknown_user_cache=LRUCache(app.config['USER_CACHE_SIZE'],
+                                    app.config['UNKNOWN_USER_CACHE_TTL']),
+        password_hasher=passwords.hasher_from_config(app.config),
+        search_max_age=app.config['SEARCH_INDEX_MAX_AGE'],
+        io_workers=app.config['STORAGE_IO_WORKERS'],
+        variant_cache=LRUCache(app.config['IMAGE_VARIANT_CACHE_SIZE']),
+        markup_cache=LRUCache(app.config['MARKUP_CACHE_SIZE']),
+        diff_cache=LRUCache(app.config['DIFF_CACHE_SIZE']))
 
     # create all the endpoints required for the app
     pages.make_endpoints(app, backend)
     login.make_endpoints(app, login_manager, backend)
     upload.make_endpoints(app, backend)
+    if isinstance(url_signer, signing.LocalSigner):
+        signing.make_endpoints(app, url_signer)
+    if registry is not None:
+        metrics.instrument_backend(backend, registry)
+        metrics.make_endpoints(app, backend, registry,
+                               app.config['METRICS_TOKEN'])
+    if app.config['PROFILE_ENABLED']:
+        profiling.make_endpoints(app,
+                                 profiling.Profiles(app.config['PROFILE_DIR']),
+                                 app.config['PROFILE_ENDPOINTS'],
+                                 app.config['PROFILE_SAMPLE_RATE'],
+                                 app.config['PROFILE_TOKEN'])
+
+    @app.cli.command('rebuild-page-index')
+    def rebuild_page_index():
+        """Rebuilds the page name index from a full listing of the bucket."""
+        names = backend.rebuild_page_index()
+        click.echo(f'Indexed {len(names)} pages')
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index():
+        """Rebuilds the full-text search index from every page."""
+        count = backend.rebuild_search_index()
+        click.echo(f'Indexed {count} pages for search')
+
+    @app.cli.command('rebuild-link-index')
+    def rebuild_link_index():
+        """Rebuilds the index of the links between pages from every page."""
+        count = backend.rebuild_link_index()
+        click.echo(f'Indexed the links of {count} pages')
+
+    @app.cli.command('migrate-history')
+    def migrate_history():
+        """Builds the per-page revision manifests from the history blobs."""
+        count = backend.migrate_history()
+        click.echo(f'Migrated the history of {count} pages')
+
+    @app.cli.command('expire-uploads')
+    @click.option('--max-age', default=24 * 3600, show_default=True,
+                  help='Seconds without a new part before an upload is '
+                  'deleted.')
+    def expire_uploads(max_age):
+        """Deletes the parts of abandoned resumable uploads."""
+        count = backend.expire_uploads(max_age)
+        click.echo(f'Deleted {count} abandoned uploads')
+
+    @app.cli.command('revert-edits')
+    @click.argument('username')
+    @click.option('--since',
+                  required=True,
+                  type=click.DateTime(['%Y-%m-%d', '%Y-%m-%d %H:%M:%S']),
+                  help='Oldest edit to revert, in UTC.')
+    @click.option('--by', 'reverted_by', default='admin', show_default=True,
+                  help='Who the reverts are recorded as made by.')
+    @click.option('--workers', default=16, show_default=True,
+                  help='Pages reverted at the same time.')
+    @click.option('--dry-run', is_flag=True,
+                  help='Only list the pages that would be reverted.')
+    def revert_edits(username, since, reverted_by, workers, dry_run):
+        """Reverts every edit USERNAME made since --since, on every page.
+
+        Pages someone else edited afterwards are skipped."""
+        reverted, skipped = backend.revert_edits_by(username,
+                                                    since,
+                                                    reverted_by,
+                                                    workers=workers,
+                                                    dry_run=dry_run)
+        for name in reverted:
+            click.echo(f'{"Would revert" if dry_run else "Reverted"} {name}')
+        for name in skipped:
+            click.echo(f'Skipped {name}, edited by someone else since')
+        done = 'to revert' if dry_run else 'reverted'
+        click.echo(f'{len(reverted)} pages {done}, {len(skipped)} skipped')
+
+    def archive_sources(users):
+        sources = {'content': backend.content_storage}
+        if users:
+            sources['users'] = backend.user_storage
+        return sources
+
+    def report(stats):
+        click.echo(f'... {stats}')
+
+    @app.cli.command('export-wiki')
+    @click.argument('path')
+    @click.option('--users', is_flag=True, help='Also export the accounts.')
+    @click.option('--workers', default=16, show_default=True,
+                  help='Objects downloaded at the same time.')
+    @click.option('--dry-run', is_flag=True,
+                  help='Only count what would be exported.')
+    @click.option('--restart', is_flag=True,
+                  help='Ignore the checkpoint of an interrupted export.')
+    def export_wiki(path, users, workers, dry_run, restart):
+        """Exports every page, image and revision to a .tar or .jsonl file."""
+        stats = archive.export_archive(archive_sources(users),
+                                       path,
+                                       workers=workers,
+                                       dry_run=dry_run,
+                                       resume=not restart,
+                                       progress=report)
+        click.echo(f'{"Would export" if dry_run else "Exported"} {stats}')
+
+    @app.cli.command('import-wiki')
+    @click.argument('path')
+    @click.option('--users', is_flag=True, help='Also import the accounts.')
+    @click.option('--workers', default=16, show_default=True,
+                  help='Objects uploaded at the same time.')
+    @click.option('--dry-run', is_flag=True,
+                  help='Only read the archive, without storing anything.')
+    @click.option('--restart', is_flag=True,
+                  help='Ignore the checkpoint of an interrupted import.')
+    def import_wiki(path, users, workers, dry_run, restart):
+        """Imports an archive written by export-wiki, then rebuilds the
+        page, search and link indexes."""
+        stats = archive.import_archive(archive_sources(users),
+                                       path,
+                                       workers=workers,
+                                       dry_run=dry_run,
+                                       resume=not restart,
+                                       progress=report)
+        click.echo(f'{"Would import" if dry_run else "Imported"} {stats}')
+        if not dry_run:
+            click.echo(f'Indexed {len(backend.rebuild_page_index())} pages')
+            click.echo(
+                f'Indexed {backend.rebuild_search_index()} pages for search')
+            click.echo(
+                f'Indexed the links of {backend.rebuild_link_index()} pages')
 
     return app
 
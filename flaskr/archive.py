@@ -0,0 +1,443 @@
+"""Exports the wiki buckets to an archive file and imports them back.
+
+An archive holds every object of one or more storage engines, each under the
+name of its source: 'content/Some Page', 'content/history/...',
+'users/alice'. Two formats are supported, picked by the file extension:
+
+- '.tar': one regular file per object, readable with any tar tool
+- '.jsonl': one JSON line per chunk of at most CHUNK_SIZE bytes of an
+  object, {"name": ..., "offset": ..., "size": ..., "data": <base64>}, so
+  no line is larger than a few MiB however big the object is
+
+Objects are downloaded or uploaded on a thread pool while the archive is
+read or written in order by a single thread. At most a window of objects is
+in flight, and each is spooled to a temporary file once it grows past
+SPOOL_SIZE, so memory stays bounded on multi-GB buckets.
+
+Progress is saved to a checkpoint file next to the archive every
+CHECKPOINT_INTERVAL seconds. If a transfer is interrupted, running it again
+picks up where the checkpoint left off: an export truncates the archive to
+the last checkpointed entry and appends the rest, an import skips the
+entries it already stored. The checkpoint is removed once the transfer
+completes.
+
+Derived objects (the page, search and link indexes, scaled down images) and
+in-progress resumable uploads are not transferred; rebuild the indexes after
+an import.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+TAR = 'tar'
+JSONL = 'jsonl'
+# Objects larger than this are spooled to disk while in flight.
+SPOOL_SIZE = 1024 * 1024
+# Size of the object chunks in a JSONL archive (a multiple of 3, so chunks
+# encode to base64 without padding in between).
+CHUNK_SIZE = 3 * 256 * 1024
+# Seconds between checkpoints, and between progress reports.
+CHECKPOINT_INTERVAL = 5
+# Prefixes of the objects that are never transferred.
+SKIPPED_PREFIXES = ('indexes/', 'uploads/', 'variants/')
+
+
+def archive_format(path):
+    """Returns TAR or JSONL depending on the extension of path."""
+    if path.endswith('.tar'):
+        return TAR
+    if path.endswith('.jsonl'):
+        return JSONL
+    raise ValueError(f'Unsupported archive {path}, use a .tar or .jsonl file')
+
+
+class TransferStats:
+    """Counts the objects and bytes of a transfer."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.objects = 0
+        self.bytes = 0
+        self.skipped = 0
+
+    def add(self, size):
+        self.objects += 1
+        self.bytes += size
+
+    @property
+    def seconds(self):
+        return self.clock() - self.started
+
+    def __str__(self):
+        seconds = self.seconds
+        rate = self.bytes / seconds / 1024 / 1024 if seconds else 0
+        return (f'{self.objects} objects, {self.bytes / 1024 / 1024:.1f} MiB '
+                f'in {seconds:.1f}s ({self.objects / (seconds or 1):.1f} '
+                f'objects/s, {rate:.1f} MiB/s)')
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_checkpoint(path, checkpoint):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+
+def _remove_checkpoint(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _transferred(name):
+    return not name.startswith(SKIPPED_PREFIXES)
+
+
+def _spool(source, size=None):
+    """Copies a file object to a spooled temporary file, returning
+    (file positioned at 0, size)."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    if size is None:
+        shutil.copyfileobj(source, spool, CHUNK_SIZE)
+    else:
+        while size:
+            chunk = source.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                raise ValueError('The archive ends in the middle of an object')
+            spool.write(chunk)
+            size -= len(chunk)
+    size = spool.tell()
+    spool.seek(0)
+    return spool, size
+
+
+class _Window:
+    """Runs tasks on a thread pool, returning results in submission order.
+
+    At most size tasks are in flight; submit() blocks on the oldest one
+    when the window is full.
+    """
+
+    def __init__(self, executor, size):
+        self.executor = executor
+        self.size = size
+        self._futures = deque()
+
+    def submit(self, key, fn, *args):
+        """Queues fn(*args), returning the (key, result) pairs of the oldest
+        tasks if the window was full."""
+        self._futures.append((key, self.executor.submit(fn, *args)))
+        finished = []
+        while len(self._futures) >= self.size:
+            finished.append(self._pop())
+        return finished
+
+    def drain(self):
+        """Waits for every task, returning their (key, result) pairs."""
+        finished = []
+        while self._futures:
+            finished.append(self._pop())
+        return finished
+
+    def _pop(self):
+        key, future = self._futures.popleft()
+        return key, future.result()
+
+    def cancel(self):
+        for _, future in self._futures:
+            future.cancel()
+
+
+def _download(storage, name):
+    try:
+        with storage.open(name) as source:
+            return _spool(source)
+    except Exception:
+        # deleted since it was listed
+        if not storage.exists(name):
+            return None
+        raise
+
+
+def _upload(storage, name, spool, size):
+    with spool:
+        storage.put(name, spool)
+    return size
+
+
+def _noop(result=None):
+    return result
+
+
+class _TarWriter:
+
+    def __init__(self, f):
+        self._tar = tarfile.open(fileobj=f, mode='w', format=tarfile.PAX_FORMAT)
+
+    def add(self, name, spool, size):
+        member = tarfile.TarInfo(name)
+        member.size = size
+        member.mtime = int(time.time())
+        self._tar.addfile(member, spool)
+
+    def close(self):
+        # the end of archive marker, without closing the file
+        self._tar.close()
+
+
+class _JsonlWriter:
+
+    def __init__(self, f):
+        self._f = f
+
+    def add(self, name, spool, size):
+        offset = 0
+        while True:
+            chunk = spool.read(CHUNK_SIZE)
+            line = {
+                'name': name,
+                'offset': offset,
+                'size': size,
+                'data': base64.b64encode(chunk).decode()
+            }
+            self._f.write(json.dumps(line).encode() + b'\n')
+            offset += len(chunk)
+            if offset >= size:
+                return
+
+    def close(self):
+        pass
+
+
+_WRITERS = {TAR: _TarWriter, JSONL: _JsonlWriter}
+
+
+def _entries(sources):
+    """Yields the archive name, storage and object name of every object."""
+    for source in sorted(sources):
+        storage = sources[source]
+        for name in storage.list():
+            if _transferred(name):
+                yield f'{source}/{name}', storage, name
+
+
+def export_archive(sources,
+                   path,
+                   workers=8,
+                   dry_run=False,
+                   resume=True,
+                   progress=None):
+    """Writes every object of the given storage engines to an archive.
+
+    Args:
+        sources: dict of source name -> Storage engine, e.g.
+            {'content': content_storage}
+        path: the .tar or .jsonl file to write
+        workers: number of objects downloaded at the same time
+        dry_run: only list what would be exported, without downloading
+        resume: continue from the checkpoint of an interrupted export
+        progress: function called with the TransferStats every
+            CHECKPOINT_INTERVAL seconds
+
+    Returns the TransferStats of the objects exported by this run.
+    """
+    writer_class = _WRITERS[archive_format(path)]
+    checkpoint_path = path + '.checkpoint'
+    checkpoint = _read_checkpoint(checkpoint_path) if resume else None
+    after = checkpoint['last'] if checkpoint else None
+    stats = TransferStats()
+    entries = (entry for entry in _entries(sources)
+               if after is None or entry[0] > after)
+
+    if dry_run:
+        for _, storage, name in entries:
+            info = storage.stat(name)
+            if info is not None:
+                stats.add(info.size)
+        return stats
+
+    f = open(path, 'r+b' if checkpoint else 'wb')
+    if checkpoint:
+        # drop anything written after the last checkpoint
+        f.seek(checkpoint['offset'])
+        f.truncate()
+    writer = writer_class(f)
+    saved = time.monotonic()
+
+    def write(archive_name, result):
+        nonlocal saved
+        if result is None:
+            stats.skipped += 1
+            return
+        spool, size = result
+        with spool:
+            writer.add(archive_name, spool, size)
+        stats.add(size)
+        if time.monotonic() - saved >= CHECKPOINT_INTERVAL:
+            f.flush()
+            _write_checkpoint(checkpoint_path, {
+                'last': archive_name,
+                'offset': f.tell()
+            })
+            saved = time.monotonic()
+            if progress is not None:
+                progress(stats)
+
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix='export') as executor:
+        window = _Window(executor, 2 * workers)
+        try:
+            for archive_name, storage, name in entries:
+                for done in window.submit(archive_name, _download, storage,
+                                          name):
+                    write(*done)
+            for done in window.drain():
+                write(*done)
+        except BaseException:
+            window.cancel()
+            f.close()
+            raise
+    writer.close()
+    f.close()
+    _remove_checkpoint(checkpoint_path)
+    return stats
+
+
+def _read_tar(f):
+    with tarfile.open(fileobj=f, mode='r|') as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, member.size, tar.extractfile(member)
+
+
+class _Chunks:
+    """A file object reading the base64 chunks of one JSONL object."""
+
+    def __init__(self, first, lines):
+        self._buffer = base64.b64decode(first['data'])
+        self._name = first['name']
+        self._remaining = first['size'] - len(self._buffer)
+        self._lines = lines
+
+    def read(self, size=-1):
+        while self._remaining > 0 and (size < 0 or len(self._buffer) < size):
+            line = json.loads(next(self._lines))
+            if line['name'] != self._name:
+                raise ValueError(f'The archive is missing part of {self._name}')
+            data = base64.b64decode(line['data'])
+            self._buffer += data
+            self._remaining -= len(data)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _read_jsonl(f):
+    lines = iter(f)
+    for line in lines:
+        first = json.loads(line)
+        if first['offset'] != 0:
+            raise ValueError(f'The archive is missing the start of '
+                             f'{first["name"]}')
+        chunks = _Chunks(first, lines)
+        yield first['name'], first['size'], chunks
+        # skip whatever the caller did not read
+        while chunks.read(CHUNK_SIZE):
+            pass
+
+
+_READERS = {TAR: _read_tar, JSONL: _read_jsonl}
+
+
+def import_archive(sources,
+                   path,
+                   workers=8,
+                   dry_run=False,
+                   resume=True,
+                   progress=None):
+    """Stores every object of an archive written by export_archive.
+
+    Objects whose source is not in sources are skipped, so e.g. the user
+    accounts of an archive are only restored if a 'users' engine is given.
+    Existing objects with the same names are overwritten.
+
+    Args:
+        sources: dict of source name -> Storage engine
+        path: the .tar or .jsonl file to read
+        workers: number of objects uploaded at the same time
+        dry_run: only read the archive, without storing anything
+        resume: skip the entries stored before an interrupted import
+        progress: function called with the TransferStats every
+            CHECKPOINT_INTERVAL seconds
+
+    Returns the TransferStats of the objects imported by this run.
+    """
+    read = _READERS[archive_format(path)]
+    checkpoint_path = path + '.checkpoint'
+    checkpoint = _read_checkpoint(checkpoint_path) if resume else None
+    skip = checkpoint['entries'] if checkpoint else 0
+    stats = TransferStats()
+    # number of entries, from the start of the archive, that are stored
+    stored = skip
+    saved = time.monotonic()
+
+    def done(_, size):
+        nonlocal stored, saved
+        stored += 1
+        if size is None:
+            stats.skipped += 1
+        else:
+            stats.add(size)
+        if time.monotonic() - saved >= CHECKPOINT_INTERVAL:
+            if not dry_run:
+                _write_checkpoint(checkpoint_path, {'entries': stored})
+            saved = time.monotonic()
+            if progress is not None:
+                progress(stats)
+
+    with open(path, 'rb') as f, ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='import') as executor:
+        window = _Window(executor, 2 * workers)
+        try:
+            for number, (archive_name, size, data) in enumerate(read(f)):
+                if number < skip:
+                    continue
+                source, _, name = archive_name.partition('/')
+                if (source not in sources or not name or
+                        not _transferred(name)):
+                    # still goes through the window, so entries are
+                    # counted as stored in archive order
+                    task = (_noop,)
+                elif dry_run:
+                    task = (_noop, size)
+                else:
+                    spool, size = _spool(data, size)
+                    task = (_upload, sources[source], name, spool, size)
+                for finished in window.submit(archive_name, *task):
+                    done(*finished)
+            for finished in window.drain():
+                done(*finished)
+        except BaseException:
+            window.cancel()
+            if not dry_run:
+                _write_checkpoint(checkpoint_path, {'entries': stored})
+            raise
+    _remove_checkpoint(checkpoint_path)
+    return stats
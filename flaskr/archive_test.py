@@ -0,0 +1,157 @@
+from flaskr import archive
+from flaskr.storage import LocalStorage
+import json
+import pytest
+import tarfile
+
+
+@pytest.fixture
+def content(tmp_path):
+    storage = LocalStorage(str(tmp_path / "content"))
+    storage.put("Sega", "Genesis")
+    storage.put("logo.png", b"\x89PNG" + bytes(range(256)) * 10)
+    storage.put("history/Sega/manifest.jsonl", "{}\n")
+    storage.put("empty", b"")
+    storage.put("indexes/pages.json", "[]")
+    storage.put("uploads/1234/session.json", "{}")
+    return storage
+
+
+@pytest.fixture
+def users(tmp_path):
+    storage = LocalStorage(str(tmp_path / "users"))
+    storage.put("alice", "$scrypt$...")
+    return storage
+
+
+def objects(storage):
+    return {name: storage.get(name) for name in storage.list()}
+
+
+@pytest.mark.parametrize("extension", ["tar", "jsonl"])
+def test_export_and_import_round_trip(tmp_path, content, users, extension):
+    path = str(tmp_path / f"wiki.{extension}")
+
+    sources = {"content": content, "users": users}
+
+    stats = archive.export_archive(sources, path, workers=2)
+    restored = LocalStorage(str(tmp_path / "restored"))
+    imported = archive.import_archive({"content": restored}, path, workers=2)
+
+    expected = objects(content)
+    del expected["indexes/pages.json"]
+    del expected["uploads/1234/session.json"]
+    assert objects(restored) == expected
+    assert stats.objects == 5
+    assert imported.objects == 4
+    # the user accounts were in the archive but not asked for
+    assert imported.skipped == 1
+    assert not (tmp_path / f"wiki.{extension}.checkpoint").exists()
+
+
+def test_export_writes_a_plain_tar(tmp_path, content):
+    path = str(tmp_path / "wiki.tar")
+
+    archive.export_archive({"content": content}, path)
+
+    with tarfile.open(path) as tar:
+        assert tar.getnames() == [
+            "content/Sega", "content/empty", "content/history/Sega/manifest.jsonl",
+            "content/logo.png"
+        ]
+        assert tar.extractfile("content/Sega").read() == b"Genesis"
+
+
+def test_jsonl_splits_large_objects(tmp_path, content, monkeypatch):
+    monkeypatch.setattr(archive, "CHUNK_SIZE", 300)
+    path = str(tmp_path / "wiki.jsonl")
+
+    archive.export_archive({"content": content}, path)
+
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    logo = [line for line in lines if line["name"] == "content/logo.png"]
+    assert [line["offset"] for line in logo] == list(range(0, 2564, 300))
+    restored = LocalStorage(str(tmp_path / "restored"))
+    archive.import_archive({"content": restored}, path)
+    assert restored.get("logo.png") == content.get("logo.png")
+
+
+def test_dry_run_transfers_nothing(tmp_path, content):
+    path = str(tmp_path / "wiki.tar")
+
+    stats = archive.export_archive({"content": content}, path, dry_run=True)
+
+    assert stats.objects == 4
+    assert stats.bytes == 7 + 2564 + 3
+    assert not (tmp_path / "wiki.tar").exists()
+
+    archive.export_archive({"content": content}, path)
+    restored = LocalStorage(str(tmp_path / "restored"))
+    stats = archive.import_archive({"content": restored}, path, dry_run=True)
+    assert stats.objects == 4
+    assert list(restored.list()) == []
+
+
+def test_export_resumes_from_checkpoint(tmp_path, content):
+    path = str(tmp_path / "wiki.tar")
+    archive.export_archive({"content": content}, path)
+    with tarfile.open(path) as tar:
+        # everything up to and including the second (empty) entry was
+        # written
+        offset = tar.getmembers()[1].offset_data
+    archive._write_checkpoint(path + ".checkpoint", {
+        "last": "content/empty",
+        "offset": offset
+    })
+    content.put("Sega", "Dreamcast")
+    content.put("zelda", "Link")
+
+    stats = archive.export_archive({"content": content}, path)
+
+    assert stats.objects == 3
+    with tarfile.open(path) as tar:
+        assert tar.getnames() == [
+            "content/Sega", "content/empty", "content/history/Sega/manifest.jsonl",
+            "content/logo.png", "content/zelda"
+        ]
+        # written before the checkpoint, so it is not exported again
+        assert tar.extractfile("content/Sega").read() == b"Genesis"
+
+
+def test_import_resumes_from_checkpoint(tmp_path, content):
+    path = str(tmp_path / "wiki.jsonl")
+    archive.export_archive({"content": content}, path)
+    archive._write_checkpoint(path + ".checkpoint", {"entries": 2})
+    restored = LocalStorage(str(tmp_path / "restored"))
+
+    stats = archive.import_archive({"content": restored}, path)
+
+    assert stats.objects == 2
+    assert sorted(restored.list()) == ["history/Sega/manifest.jsonl",
+                                       "logo.png"]
+
+
+def test_import_checkpoints_on_failure(tmp_path, content):
+    path = str(tmp_path / "wiki.tar")
+    archive.export_archive({"content": content}, path)
+
+    class Failing(LocalStorage):
+
+        def put(self, name, data, if_generation_match=None):
+            if name == "logo.png":
+                raise OSError("disk full")
+            return super().put(name, data, if_generation_match)
+
+    with pytest.raises(OSError):
+        archive.import_archive({"content": Failing(str(tmp_path / "r"))},
+                               path,
+                               workers=1)
+
+    with open(path + ".checkpoint") as f:
+        assert json.load(f) == {"entries": 3}
+
+
+def test_unknown_extension():
+    with pytest.raises(ValueError):
+        archive.archive_format("wiki.zip")
@@ -1,130 +1,1014 @@
+from flaskr.cache import LRUCache
+from flaskr.links import LinkIndex
+from flaskr.page_index import PageIndex, RESERVED_PREFIXES, is_page_name
+from flaskr.passwords import PasswordHasher
+from flaskr.revisions import RevisionStore, StaleBaseError, DISPLAY_FORMAT
+from flaskr.search import SearchIndex
+from flaskr import diff, markup, thumbnails
 from flaskr.user import User
-from google.cloud import storage
+from flaskr.storage import (ConflictError, GcsStorage, USER_BUCKET_NAME,
+                            CONTENT_BUCKET_NAME)
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
 from io import BytesIO
-from hashlib import sha256
-from datetime import datetime
+import bisect
+import json
+import logging
 import re
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Number of bytes of an image sent to the client at a time.
+IMAGE_CHUNK_SIZE = 64 * 1024
+# Resumable uploads keep their session and the parts received so far here.
+UPLOADS_PREFIX = 'uploads/'
+# Uploaded pages larger than this are not added to the search index.
+MAX_INDEXED_BYTES = 1024 * 1024
+
+_UPLOAD_ID = re.compile(r'[0-9a-f]{32}')
 
 
 class Backend:
 
-    def __init__(self, storage_client=storage.Client()):
-        self.user_bucket_name = 'theuserspasswords'
-        self.content_bucket_name = 'thewikicontent'
-        self.user_bucket = storage_client.bucket(self.user_bucket_name)
-        self.content_bucket = storage_client.bucket(self.content_bucket_name)
+    # how many times an edit not tied to a version is retried on conflicts
+    MAX_SAVE_RETRIES = 3
+
+    def __init__(self,
+                 storage_client=None,
+                 user_storage=None,
+                 content_storage=None,
+                 page_cache=None,
+                 snapshot_interval=10,
+                 url_signer=None,
+                 rendered_cache=None,
+                 user_cache=None,
+                 unknown_user_cache=None,
+                 password_hasher=None,
+                 search_max_age=5,
+                 io_workers=8,
+                 variant_cache=None,
+                 markup_cache=None,
+                 diff_cache=None):
+        """Constructs a Backend on top of two storage engines.
+
+        By default both engines wrap GCS buckets. The GCS client is only
+        created when a bucket is first used, unless one is passed in.
+
+        Args:
+            storage_client: optional google.cloud.storage.Client to use
+            user_storage: optional Storage holding the user records
+            content_storage: optional Storage holding pages and images
+            page_cache: optional LRUCache for page contents
+            snapshot_interval: keep a full copy of every this many revisions
+                of a page, storing the others as compressed deltas
+            url_signer: optional signer handing out direct storage URLs
+            rendered_cache: optional LRUCache for the rendered HTML of pages
+            user_cache: optional LRUCache for user records
+            unknown_user_cache: optional LRUCache remembering usernames that
+                do not exist, usually with a shorter ttl than user_cache
+            password_hasher: optional PasswordHasher for the user records
+            search_max_age: seconds a process reuses its copy of the search
+                and link indexes before checking storage for newer ones
+            io_workers: size of the thread pool running independent storage
+                calls concurrently, or 0 to run them one after the other
+            variant_cache: optional LRUCache for scaled down images
+            markup_cache: optional LRUCache for parsed page markup
+            diff_cache: optional LRUCache for diffs between page versions
+        """
+        if user_storage is None:
+            user_storage = GcsStorage(USER_BUCKET_NAME, storage_client)
+        if content_storage is None:
+            content_storage = GcsStorage(CONTENT_BUCKET_NAME, storage_client)
+        if page_cache is None:
+            page_cache = LRUCache(maxsize=256, ttl=60)
+        if rendered_cache is None:
+            rendered_cache = LRUCache(maxsize=512)
+        if user_cache is None:
+            user_cache = LRUCache(maxsize=1024, ttl=300)
+        if unknown_user_cache is None:
+            unknown_user_cache = LRUCache(maxsize=1024, ttl=10)
+        if password_hasher is None:
+            password_hasher = PasswordHasher()
+        if variant_cache is None:
+            variant_cache = LRUCache(maxsize=128)
+        if markup_cache is None:
+            markup_cache = LRUCache(maxsize=1024)
+        if diff_cache is None:
+            diff_cache = LRUCache(maxsize=128)
+        self.user_storage = user_storage
+        self.content_storage = content_storage
+        # maps page name -> (generation, content)
+        self.page_cache = page_cache
+        self.page_index = PageIndex(content_storage)
+        self.search_index = SearchIndex(content_storage, search_max_age)
+        self.link_index = LinkIndex(content_storage, search_max_age)
+        self.io_executor = None
+        if io_workers > 0:
+            self.io_executor = ThreadPoolExecutor(
+                max_workers=io_workers, thread_name_prefix='storage-io')
+        self.revisions = RevisionStore(content_storage, snapshot_interval)
+        self.url_signer = url_signer
+        # maps (page name, generation, username or None) -> rendered HTML.
+        # The generation in the key keeps entries from going stale, the
+        # invalidation on writes only frees the memory early.
+        self.rendered_cache = rendered_cache
+        # maps username -> stored password hash, and username -> True for
+        # usernames that were not found, so repeated logins (or attempts
+        # with an unknown name) do not each read the user bucket
+        self.user_cache = user_cache
+        self.unknown_user_cache = unknown_user_cache
+        # maps username -> User, shared by all the sessions of a user
+        self.users = LRUCache(maxsize=user_cache.maxsize)
+        self.password_hasher = password_hasher
+        # maps (image name, width, generation) -> (bytes, content type), or
+        # False when the original is served instead
+        self.variant_cache = variant_cache
+        # parses page markup once per distinct content, see flaskr.markup
+        self.renderer = markup.Renderer(markup_cache)
+        # maps (page name, old revision, new revision or the generation of
+        # the current page) -> diff.Diff; revisions never change, so
+        # entries never go stale
+        self.diff_cache = diff_cache
 
     def get_wiki_page(self, name):
-        blob = self.content_bucket.get_blob(name)
-        if blob is None:
+        content, _ = self.get_wiki_page_info(name)
+        return content
+
+    def get_wiki_page_info(self, name):
+        """Returns (content, generation) of a page.
+
+        The generation changes whenever the page is rewritten, so it can key
+        anything derived from the content.
+        """
+        cached = self.page_cache.get(name)
+        if cached is not None:
+            return cached[1], cached[0]
+        # once an entry expires, only pay for a metadata lookup if the page
+        # has not been rewritten since we cached it
+        stale = self.page_cache.peek(name)
+        if stale is not None:
+            info = self.content_storage.stat(name)
+            if info is not None and info.generation == stale[0]:
+                self.page_cache.set(name, stale)
+                return stale[1], stale[0]
+        data, info = self.content_storage.get_with_info(name)
+        if data is None:
+            self.page_cache.pop(name)
             raise ValueError(f'No page exists with the given name: {name}')
-        else:
-            # default mode for blob open() is read-only mode
-            with blob.open() as b:
-                return b.read()
-
-    def save_wiki_page(self, page_name, content, username):
-        if self.content_bucket.blob(page_name).exists():
-            current_content = self.get_wiki_page(page_name)
-            current_time = datetime.now()
-            formatted_time = current_time.strftime("%Y-%m-%d %H:%M:%S")
-            timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-            history_blob = self.content_bucket.blob(f'history/{page_name}-{timestamp}-{username}.txt')
-            history_blob.upload_from_string(current_content)
-
-            blob = self.content_bucket.blob(page_name)
-            blob.upload_from_string(content)
+        content = data.decode()
+        self.page_cache.set(name, (info.generation, content))
+        return content, info.generation
+
+    def render_page(self, content):
+        """Returns the HTML of a page's markup."""
+        return self.renderer.render(content)
+
+    def get_page_generation(self, name):
+        """Returns the generation of a page without reading it, or None.
+
+        This costs at most a metadata lookup, which is all a conditional
+        request needs to be answered.
+        """
+        cached = self.page_cache.get(name)
+        if cached is not None:
+            return cached[0]
+        info = self.content_storage.stat(name)
+        if info is None:
+            return None
+        stale = self.page_cache.peek(name)
+        if stale is not None and stale[0] == info.generation:
+            self.page_cache.set(name, stale)
+        return info.generation
+
+    def _invalidate(self, name):
+        """Drops everything cached about a page after it was written."""
+        self.page_cache.pop(name)
+        self.rendered_cache.pop_where(lambda key: key[0] == name)
+
+    def _written(self, name, content=None):
+        """Updates the caches and indexes after a page was (re)written.
+
+        Args:
+            name: name of the page
+            content: the new content (str or bytes) if known, otherwise it
+                is read back for the search index
+        """
+        self._invalidate(name)
+        if not is_page_name(name):
+            self.page_index.add(name)
+            return
+        self._wait(self._submit(self.page_index.add, name),
+                   self._submit(self._reindex, name, content))
+
+    def _indexable_content(self, name, content=None):
+        """Returns the text of a page to index, or None if it is too large.
+
+        The page is read if content (str or bytes) is None.
+        """
+        if content is None:
+            info = self.content_storage.stat(name)
+            if info is None or info.size > MAX_INDEXED_BYTES:
+                return None
+            content = self.content_storage.get(name)
+        if isinstance(content, bytes):
+            if len(content) > MAX_INDEXED_BYTES:
+                return None
+            content = content.decode(errors='replace')
+        return content
+
+    def _index_content(self, name, content):
+        content = self._indexable_content(name, content)
+        if content is None:
+            # too large to parse: drop any older version from search, and
+            # record the page without links so links to it are not broken
+            self.search_index.remove(name)
+            self.link_index.add(name, [])
+            return
+        self.search_index.add(name, content)
+        # usually a single read: the index is only written when the links
+        # of the page changed
+        self.link_index.add(name, self.renderer.parse(content).wiki_links())
+
+    def _submit(self, fn, *args):
+        """Starts fn(*args) on the I/O pool and returns its Future."""
+        if self.io_executor is not None:
+            return self.io_executor.submit(fn, *args)
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    @staticmethod
+    def _wait(*futures):
+        """Waits for all the futures, then raises the first error if any."""
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def save_wiki_page(self, page_name, content, username,
+                       base_generation=None):
+        """Replaces the content of an existing page, keeping the old one.
+
+        Every write is conditional on the generation of the content the edit
+        replaces, so concurrent edits are never silently lost.
+
+        Args:
+            page_name: name of the page
+            content: the new content
+            username: author of the edit
+            base_generation: generation of the page the edit was made on, or
+                None to apply the edit to whatever version is current
+
+        Raises:
+            ConflictError if the page changed since base_generation (or, for
+            base_generation None, kept changing while saving).
+        """
+        for _ in range(self.MAX_SAVE_RETRIES):
+            try:
+                # usually served from the page cache, and tells us whether
+                # the page exists without a separate call
+                current_content, generation = self.get_wiki_page_info(
+                    page_name)
+            except ValueError:
+                return
+            if base_generation is not None and generation != base_generation:
+                # make sure it is not just our cached copy that is stale
+                self.page_cache.pop(page_name)
+                current_content, generation = self.get_wiki_page_info(
+                    page_name)
+                if generation != base_generation:
+                    raise ConflictError(
+                        f'{page_name} was changed since it was opened')
+            try:
+                self._save(page_name, current_content, generation, content,
+                           username)
+                return
+            except ConflictError:
+                # our copy of the page was outdated, so the content write was
+                # rejected; only retry edits not tied to a version
+                self._invalidate(page_name)
+                if base_generation is not None:
+                    raise
+        raise ConflictError(f'Unable to save {page_name}')
+
+    def _save(self, page_name, current_content, generation, content,
+              username):
+        # the revision is a delta between the two contents we already have,
+        # so it is written at the same time as the new content, and so are
+        # the search and link indexes
+        recorded = self._submit(self.revisions.record, page_name,
+                                current_content, content, username,
+                                generation)
+        stored = self._submit(self.content_storage.put, page_name, content,
+                              generation)
+        indexed = self._submit(self._index_content, page_name, content)
+        wait([recorded, stored, indexed])
+        failed = stored.exception() or recorded.exception()
+        if stored.exception() is not None and recorded.exception() is None:
+            self.revisions.discard(page_name, recorded.result())
+        elif recorded.exception() is not None and stored.exception() is None:
+            # keep the page and its history consistent, unless someone saved
+            # over our content already
+            try:
+                self.content_storage.put(page_name, current_content,
+                                         stored.result())
+            except ConflictError:
+                pass
+            self._invalidate(page_name)
+        if failed is not None:
+            if indexed.exception() is None:
+                self._reindex(page_name, current_content)
+            raise failed
+        # the page already exists, so the page index does not change
+        self._invalidate(page_name)
+        if stored.result() is not None:
+            # the redirect to the page right after saving needs no read
+            self.page_cache.set(page_name, (stored.result(), content))
+        if indexed.exception() is not None:
+            self._log_index_error(page_name, indexed.exception())
+
+    def _reindex(self, name, content):
+        """Indexes a page, logging rather than raising index errors."""
+        try:
+            self._index_content(name, content)
+        except Exception as e:
+            self._log_index_error(name, e)
+
+    @staticmethod
+    def _log_index_error(name, error):
+        # the content is saved either way: retrying the save would record
+        # another revision, and the next save of the page or the rebuild
+        # commands fix the index
+        logger.error('Unable to index %s', name, exc_info=error)
 
     def revert_to_previous(self, page_name, username):
-        content, _, _ = self.get_previous_version(page_name)
-        if content is not None:
-            self.save_wiki_page(page_name, content, username)
-            return True
-        return False
+        """Reverts a page to its newest revision, returning False if none."""
+        # only the end of the page's revision manifest is read
+        revision = self.revisions.latest(page_name)
+        if revision is None:
+            return False
+        self.revert_to_revision(page_name, revision.name, username)
+        return True
+
+    def revert_to_revision(self, page_name, revision_name, username):
+        """Makes a previous version of a page its current version again.
+
+        The current version is kept as a new revision, and a revision stored
+        as a full copy is copied back over the page, both inside the storage
+        engine, so neither passes through the app. A revision stored as a
+        delta is rebuilt and uploaded once. The page is only replaced if it
+        is still the version that was kept.
+
+        Args:
+            page_name: name of the page
+            revision_name: name of the revision, as listed by
+                get_all_previous_versions
+            username: who reverts the page
+
+        Raises:
+            ValueError if the page or the revision does not exist.
+            ConflictError if the page was changed while reverting.
+        """
+        content = self._revert(page_name, revision_name, username)
+        # the search and link indexes still need the text, which is read
+        # back unless the revision was rebuilt here
+        self._reindex(page_name, content)
+
+    def _revert(self, page_name, revision_name, username):
+        """Reverts a page without updating the search and link indexes.
+
+        Returns the new content if it was rebuilt from deltas, else None.
+        """
+        revision = self.revisions.find(page_name, revision_name)
+        info = self.content_storage.stat(page_name)
+        if info is None:
+            raise ValueError(f'No page exists with the given name: {page_name}')
+
+        def current_content():
+            cached = self.page_cache.peek(page_name)
+            if cached is not None and cached[0] == info.generation:
+                return cached[1]
+            data, current = self.content_storage.get_with_info(page_name)
+            if data is None or current.generation != info.generation:
+                raise ConflictError(f'{page_name} was changed while reverting')
+            return data.decode()
+
+        content = None
+        if revision.is_delta:
+            content = self.revisions.content(page_name, revision_name,
+                                             current_content)
+        recorded = self.revisions.record_copy(page_name, info, username)
+        try:
+            if content is None:
+                generation = self.content_storage.copy(
+                    revision.name,
+                    page_name,
+                    if_generation_match=info.generation)
+            else:
+                generation = self.content_storage.put(
+                    page_name, content, if_generation_match=info.generation)
+        except ConflictError:
+            # someone saved the page since we kept its version
+            self.revisions.discard(page_name, recorded)
+            raise
+        finally:
+            self._invalidate(page_name)
+        if content is not None and generation is not None:
+            self.page_cache.set(page_name, (generation, content))
+        return content
+
+    def revert_edits_by(self, username, since, reverted_by, workers=8,
+                        dry_run=False):
+        """Reverts the edits a user made since a given time, on every page.
+
+        On each page, the newest edits are undone as long as username made
+        them at or after since. Pages where someone else edited after them
+        are skipped, so no one else's edit is lost. The pages are checked
+        and reverted workers at a time, and the search and link indexes are
+        updated once at the end.
+
+        Args:
+            username: author of the edits to revert
+            since: naive UTC datetime of the oldest edit to revert
+            reverted_by: who the reverts are recorded as made by
+            workers: number of pages handled at the same time
+            dry_run: only find the pages that would be reverted
+
+        Returns:
+            (reverted page names, skipped page names), both sorted
+        """
+
+        def revert(page_name):
+            revisions = self.revisions.list(page_name)
+            target = None
+            for revision in revisions:
+                if revision.username != username or revision.timestamp < since:
+                    break
+                target = revision
+            if target is None:
+                if any(revision.username == username and
+                       revision.timestamp >= since for revision in revisions):
+                    return 'skipped'
+                return None
+            if not dry_run:
+                try:
+                    self._revert(page_name, target.name, reverted_by)
+                except ConflictError:
+                    return 'skipped'
+            return 'reverted'
+
+        names = self.get_all_page_names()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(revert, names))
+            reverted = [
+                name for name, outcome in zip(names, outcomes)
+                if outcome == 'reverted'
+            ]
+            skipped = [
+                name for name, outcome in zip(names, outcomes)
+                if outcome == 'skipped'
+            ]
+            if dry_run or not reverted:
+                return reverted, skipped
+            contents = list(executor.map(self._indexable_content, reverted))
+        pages = [(name, content)
+                 for name, content in zip(reverted, contents)
+                 if content is not None]
+        self.search_index.add_many(pages)
+        self.link_index.add_many(
+            (name, self.renderer.parse(content).wiki_links())
+            for name, content in pages)
+        return reverted, skipped
 
 
     def get_all_page_names(self):
-        blobs = self.content_bucket.list_blobs()
-        ignored_prefixes = ('history/', 'authorImages/')
-        ignored_extensions = ('.png', '.jpg', '.jpeg')
-
-        page_names = [
-            blob.name
-            for blob in blobs
-            if not blob.name.startswith(ignored_prefixes) and not blob.name.endswith(ignored_extensions)
-        ]
-        return page_names
+        # read the sorted names from the page index instead of listing every
+        # object (history, images, ...) in the content bucket
+        return self.page_index.names()
+
+    def get_page_names(self, prefix='', start_after=None, limit=None):
+        """Returns one page of sorted page names and the cursor for the next.
+
+        Args:
+            prefix: only return names starting with this string
+            start_after: cursor returned by a previous call, or None
+            limit: maximum number of names to return, or None for all
+
+        Returns:
+            (names, next_cursor) where next_cursor is None on the last page
+        """
+        names = self.get_all_page_names()
+        # the index is sorted, so both the prefix and the cursor are found
+        # with a binary search and only the requested slice is copied
+        start = bisect.bisect_left(names, prefix)
+        if start_after is not None:
+            start = max(start, bisect.bisect_right(names, start_after))
+        end = len(names) if limit is None else min(start + limit, len(names))
+        selected = [name for name in names[start:end] if name.startswith(prefix)]
+        more = end < len(names) and names[end].startswith(prefix)
+        return selected, selected[-1] if selected and more else None
+
+    def rebuild_page_index(self):
+        return self.page_index.rebuild()
+
+    def search(self, query, limit=20):
+        """Returns up to limit (page name, score) pairs matching query."""
+        return self.search_index.search(query, limit)
+
+    def _indexed_pages(self, too_large=False):
+        """Yields (name, content) of every page small enough to index.
+
+        With too_large, the other pages are yielded too, with None content.
+        """
+        for name in self.page_index.names():
+            info = self.content_storage.stat(name)
+            if info is None:
+                continue
+            if info.size > MAX_INDEXED_BYTES:
+                if too_large:
+                    yield name, None
+                continue
+            yield name, self.content_storage.get(name).decode(errors='replace')
+
+    def rebuild_search_index(self):
+        """Indexes every page from scratch, returning how many were indexed."""
+        return self.search_index.rebuild(self._indexed_pages())
+
+    def get_backlinks(self, page_name):
+        """Returns the sorted names of the pages linking to a page."""
+        return self.link_index.backlinks(page_name)
+
+    def get_broken_links(self, page_name):
+        """Returns the pages a page links to that do not exist."""
+        return self.link_index.broken_links(page_name)
+
+    def get_all_broken_links(self):
+        """Returns (missing page, sorted pages linking to it) pairs."""
+        return self.link_index.broken()
+
+    def rebuild_link_index(self):
+        """Indexes the links of every page, returning how many were indexed."""
+        return self.link_index.rebuild(
+            (name, [] if content is None else
+             self.renderer.parse(content).wiki_links())
+            for name, content in self._indexed_pages(too_large=True))
 
     def upload(self, name, blob_data):
-        blob = self.content_bucket.get_blob(name)
-        if blob is not None:
-            raise ValueError(f'{name} already exists in the content bucket!')
-        blob = self.content_bucket.blob(name)
-        # write the byte data to the bucket
-        with blob.open('wb') as b:
-            b.write(blob_data)
+        """Stores a new page or image.
+
+        blob_data may be bytes or a file object, which is copied to storage
+        in chunks instead of being read into memory.
+        """
+        self._check_upload_name(name)
+        # write the byte data to the bucket, unless the name is taken
+        try:
+            self.content_storage.put(name, blob_data, if_generation_match=0)
+        except ConflictError as ce:
+            raise ValueError(
+                f'{name} already exists in the content bucket!') from ce
+        # streamed uploads are read back by _written, in-memory ones are not
+        self._written(name, None if hasattr(blob_data, 'read') else blob_data)
+
+    @staticmethod
+    def _check_upload_name(name):
+        """Raises ValueError if uploads may not use the name."""
+        if name.startswith(RESERVED_PREFIXES):
+            raise ValueError(
+                f'Names starting with {name.split("/")[0]}/ are reserved!')
 
     def sign_up(self, username, password):
-        blob = self.user_bucket.get_blob(username)
-        if blob is not None:
+        if (self.user_cache.get(username) is not None or
+                self.user_storage.exists(username)):
             raise ValueError(f'Username {username} already exists!')
-        blob = self.user_bucket.blob(username)
-        # hash the username/password together and store in bucket
-        hashed_string = sha256(f'{username}:{password}'.encode()).hexdigest()
-        with blob.open('w') as b:
-            b.write(hashed_string)
+        # hash the password with a fresh salt and store the record in bucket;
+        # the write fails if someone took the username in the meantime
+        record = self.password_hasher.hash(password)
+        try:
+            self.user_storage.put(username, record, if_generation_match=0)
+        except ConflictError as ce:
+            raise ValueError(f'Username {username} already exists!') from ce
+        self.unknown_user_cache.pop(username)
+        self.user_cache.set(username, record)
         # return a default user object with the given username
-        return User(username)
+        return self.get_user(username)
 
     def sign_in(self, username, password):
-        blob = self.user_bucket.get_blob(username)
-        if blob is None:
+        record = self._stored_hash(username)
+        if record is None:
             raise ValueError(f'Username {username} does not exist!')
 
-        # create hashed string to compare with bucket contents
-        expected_hashed_string = sha256(
-            f'{username}:{password}'.encode()).hexdigest()
-        with blob.open() as b:
-            if expected_hashed_string == b.read():
-                # successful login, return a User object
-                return User(username)
-            else:
-                # failed login, throw error
-                raise ValueError(f'Invalid password for username {username}!')
+        # hash the password the same way as the stored record to compare
+        if not self.password_hasher.verify(record, password, username):
+            # failed login, throw error
+            raise ValueError(f'Invalid password for username {username}!')
+        if self.password_hasher.needs_rehash(record):
+            # the record is unsalted or made with old parameters; now that we
+            # know the password, replace it with a current one
+            record = self.password_hasher.hash(password)
+            self.user_storage.put(username, record)
+            self.user_cache.set(username, record)
+        # successful login, return a User object
+        return self.get_user(username)
+
+    def _stored_hash(self, username):
+        """Returns the stored password hash of a user, or None if unknown."""
+        stored_hash = self.user_cache.get(username)
+        if stored_hash is not None:
+            return stored_hash
+        if self.unknown_user_cache.get(username):
+            return None
+        data = self.user_storage.get(username)
+        if data is None:
+            self.unknown_user_cache.set(username, True)
+            return None
+        stored_hash = data.decode()
+        self.user_cache.set(username, stored_hash)
+        return stored_hash
+
+    def get_user(self, username):
+        """Returns the User for a username, reusing a cached instance.
+
+        This is what sessions load on every request, so it does not touch
+        the user bucket.
+        """
+        user = self.users.get(username)
+        if user is None:
+            user = User(username)
+            self.users.set(username, user)
+        return user
 
     def get_image(self, name):
-        blob = self.content_bucket.get_blob(name)
-        if blob is None:
+        data = self.content_storage.get(name)
+        if data is None:
             # return empty bytes stream if image does not exist
             return BytesIO()
-        else:
-            with blob.open('rb') as b:
-                return BytesIO(b.read())
-
-
-    def _fetch_previous_versions(self, page_name):
-        history_blobs = sorted(
-            [blob for blob in self.content_bucket.list_blobs(prefix=f'history/{page_name}')],
-            key=lambda x: x.name,
-            reverse=True
-        )
-        previous_versions = []
-        for blob in history_blobs:
-            split_list = re.split('/|-', blob.name[:-4])
-            if len(split_list) >= 4:
-                _, _, timestamp, username = split_list
-                timestamp = datetime.strptime(timestamp, "%Y%m%d%H%M%S").strftime("%Y-%m-%d %H:%M:%S")
-                previous_versions.append((blob.name, timestamp, username))
-        return previous_versions
+        return BytesIO(data)
+
+    def get_image_url(self, name, expires_in, generation=None):
+        """Returns a short-lived URL reading the image straight from storage."""
+        return self.url_signer.download_url(name, expires_in, generation)
+
+    def create_upload_url(self, name, content_type, expires_in):
+        """Returns (url, method) to upload a new page straight to storage.
+
+        Once the client has uploaded the data, complete_upload must be called
+        so the page shows up in the wiki.
+        """
+        self._check_upload_name(name)
+        if self.content_storage.exists(name):
+            raise ValueError(f'{name} already exists in the content bucket!')
+        return self.url_signer.upload_url(name, content_type, expires_in)
+
+    def complete_upload(self, name):
+        """Registers a page that was uploaded through create_upload_url."""
+        if not self.content_storage.exists(name):
+            raise ValueError(f'{name} has not been uploaded yet!')
+        self._written(name)
+
+    def start_upload(self, name, size, max_size=None):
+        """Starts a resumable upload of a new page and returns its id.
+
+        The data is sent with write_upload in as many parts as needed, so an
+        interrupted upload can continue from upload_offset. An empty page
+        has no parts to send, so it is created right away and None is
+        returned instead of an id.
+
+        Args:
+            name: name of the new page
+            size: total number of bytes that will be uploaded
+            max_size: optional limit for size
+        """
+        self._check_upload_name(name)
+        if self.content_storage.exists(name):
+            raise ValueError(f'{name} already exists in the content bucket!')
+        if size < 0 or (max_size is not None and size > max_size):
+            raise ValueError(f'Uploads must be at most {max_size} bytes!')
+        if size == 0:
+            self.upload(name, b'')
+            return None
+        upload_id = uuid.uuid4().hex
+        self.content_storage.put(f'{UPLOADS_PREFIX}{upload_id}/session.json',
+                                 json.dumps({
+                                     'name': name,
+                                     'size': size
+                                 }))
+        return upload_id
+
+    def _upload_session(self, upload_id):
+        """Returns (session, sorted part names) of a resumable upload."""
+        data = None
+        if _UPLOAD_ID.fullmatch(upload_id):
+            data = self.content_storage.get(
+                f'{UPLOADS_PREFIX}{upload_id}/session.json')
+        if data is None:
+            raise KeyError(upload_id)
+        parts = sorted(
+            self.content_storage.list(
+                prefix=f'{UPLOADS_PREFIX}{upload_id}/part-'))
+        # each part is checked when the next one is written, so only the
+        # newest one may have been stored short of the range in its name
+        if parts:
+            start, end = self._part_range(parts[-1])
+            info = self.content_storage.stat(parts[-1])
+            if info is None or info.size != end - start:
+                self.content_storage.delete(parts.pop())
+        return json.loads(data), parts
+
+    @staticmethod
+    def _part_range(part_name):
+        # parts are named part-{start:020d}-{end:020d}
+        _, start, end = part_name.rsplit('-', 2)
+        return int(start), int(end)
+
+    def upload_offset(self, upload_id):
+        """Returns (bytes received, total size) of a resumable upload.
+
+        Raises KeyError if there is no such upload.
+        """
+        session, parts = self._upload_session(upload_id)
+        offset = self._part_range(parts[-1])[1] if parts else 0
+        return offset, session['size']
+
+    def write_upload(self, upload_id, start, stream, length):
+        """Stores the next part of a resumable upload.
+
+        The part is streamed from the file object to storage. Once all bytes
+        have arrived the parts are combined into the page inside the storage
+        engine.
+
+        Args:
+            upload_id: id returned by start_upload
+            start: offset of the first byte in stream
+            stream: file object holding the part
+            length: number of bytes in the part
+
+        Returns:
+            (offset, name) where name is the page name once the upload is
+            complete and None before that.
+
+        Raises:
+            KeyError if there is no such upload, ConflictError if start is not
+            the current offset, ValueError if the part does not fit.
+        """
+        session, parts = self._upload_session(upload_id)
+        offset = self._part_range(parts[-1])[1] if parts else 0
+        if start != offset:
+            raise ConflictError(f'Upload {upload_id} continues at {offset}')
+        end = start + length
+        if length <= 0 or end > session['size']:
+            raise ValueError(f'Part {start}-{end} does not fit the upload!')
+        part_name = f'{UPLOADS_PREFIX}{upload_id}/part-{start:020d}-{end:020d}'
+        try:
+            self.content_storage.put(part_name, stream, if_generation_match=0)
+        except ConflictError as ce:
+            raise ConflictError(
+                f'Upload {upload_id} continues at {offset}') from ce
+        except BaseException:
+            # e.g. the client went away; make sure no engine keeps the bytes
+            # read so far under the name of the whole part
+            self.content_storage.delete(part_name)
+            raise
+        info = self.content_storage.stat(part_name)
+        if info is None or info.size != length:
+            # the client went away before sending the whole part
+            self.content_storage.delete(part_name)
+            raise ValueError(f'Part {start}-{end} was not fully received!')
+        if end < session['size']:
+            return end, None
+        self._finish_upload(upload_id, session['name'], parts + [part_name])
+        return end, session['name']
+
+    def _finish_upload(self, upload_id, name, parts):
+        try:
+            self.content_storage.compose(name, parts, if_generation_match=0)
+        except ConflictError as ce:
+            # someone created the page while we were uploading
+            self.abort_upload(upload_id)
+            raise ValueError(
+                f'{name} already exists in the content bucket!') from ce
+        self.abort_upload(upload_id)
+        self._written(name)
+
+    def abort_upload(self, upload_id):
+        """Deletes the session and the parts of a resumable upload."""
+        for name in self.content_storage.list(
+                prefix=f'{UPLOADS_PREFIX}{upload_id}/'):
+            self.content_storage.delete(name)
+
+    def expire_uploads(self, max_age, now=None):
+        """Deletes the resumable uploads nothing was written to for a while.
+
+        Args:
+            max_age: seconds since the last part (or the start) of an upload
+                after which it is considered abandoned
+            now: the current time as an aware datetime, for tests
+
+        Returns the number of uploads deleted.
+        """
+        now = now or datetime.now(timezone.utc)
+        # parts left behind without a session (e.g. by an interrupted
+        # abort_upload) are grouped under their upload id as well
+        last_written = {}
+        for name in self.content_storage.list(prefix=UPLOADS_PREFIX):
+            info = self.content_storage.stat(name)
+            if info is None:
+                continue
+            upload_id = name[len(UPLOADS_PREFIX):].split('/', 1)[0]
+            last_written[upload_id] = max(
+                info.updated, last_written.get(upload_id, info.updated))
+        expired = [
+            upload_id for upload_id, updated in last_written.items()
+            if (now - updated).total_seconds() > max_age
+        ]
+        for upload_id in expired:
+            self.abort_upload(upload_id)
+        return len(expired)
+
+    def get_image_info(self, name):
+        """Returns the ObjectInfo (size, generation, ...) of an image or None."""
+        return self.content_storage.stat(name)
+
+    def get_image_variant(self, name, width, info=None):
+        """Returns (bytes, content type) of an image scaled down to width.
+
+        The variant is made and stored the first time it is asked for.
+        Returns None if the original should be served instead: the image
+        does not exist, is not wider than width, or cannot be scaled.
+
+        Args:
+            name: name of the image
+            width: one of the allowed widths, see thumbnails.snap_width
+            info: the image's ObjectInfo, if the caller already has it
+        """
+        if not thumbnails.available():
+            return None
+        if info is None:
+            info = self.content_storage.stat(name)
+        if info is None or info.size > thumbnails.MAX_SOURCE_BYTES:
+            return None
+        key = (name, width, info.generation)
+        variant = self.variant_cache.get(key)
+        if variant is None:
+            variant = self._load_variant(name, width, info.generation)
+            self.variant_cache.set(key, variant)
+        return variant or None
+
+    def _load_variant(self, name, width, generation):
+        variant_name = thumbnails.variant_name(name, width, generation)
+        data = self.content_storage.get(variant_name)
+        if data is not None:
+            return bool(data) and (data, thumbnails.content_type(data))
+        original = self.content_storage.get(name)
+        if original is None:
+            return False
+        variant = thumbnails.resize(original, width)
+        try:
+            # an empty variant remembers that the original is served
+            self.content_storage.put(variant_name,
+                                     variant[0] if variant else b'',
+                                     if_generation_match=0)
+        except ConflictError:
+            # another worker made the same variant
+            pass
+        return variant or False
+
+    def stream_image(self, name, start=0, end=None, generation=None):
+        """Yields bytes start:end of an image in chunks.
+
+        Only one chunk is held in memory at a time, so large images are never
+        read into the worker as a whole.
+
+        Args:
+            name: name of the image
+            start: offset of the first byte to send
+            end: offset after the last byte to send, or None for the end
+            generation: generation of the image we expect to read
+        """
+        remaining = None if end is None else end - start
+        with self.content_storage.open(name, generation) as f:
+            f.seek(start)
+            while remaining is None or remaining > 0:
+                size = IMAGE_CHUNK_SIZE
+                if remaining is not None:
+                    size = min(size, remaining)
+                    remaining -= size
+                chunk = f.read(size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+    def _fetch_previous_versions(self, page_name, offset=0, limit=None):
+        return [(revision.name, revision.timestamp.strftime(DISPLAY_FORMAT),
+                 revision.username)
+                for revision in self.revisions.list(page_name, offset, limit)]
+
+    def _from_current(self, page_name, rebuild):
+        """Returns rebuild(current_content) for rebuilding revisions.
+
+        current_content returns the page, usually from the page cache. If
+        the revisions were recorded against a newer version than the cached
+        one, the page is read again and rebuild is called once more.
+        """
+        try:
+            return rebuild(lambda: self.get_wiki_page(page_name))
+        except StaleBaseError:
+            self.page_cache.pop(page_name)
+            return rebuild(lambda: self.get_wiki_page(page_name))
 
     def get_previous_version(self, page_name):
-        previous_versions = self._fetch_previous_versions(page_name)
-        if not previous_versions:
+        """Returns (content, timestamp, username) of the newest revision.
+
+        All three are None if the page has no revisions.
+
+        Raises:
+            StaleBaseError if the page kept changing while reading it.
+        """
+        # only the newest line of the page's revision manifest is read, and
+        # deltas are rebuilt on top of the current page, which is usually
+        # already in the page cache
+        revision, content = self._from_current(
+            page_name, lambda current_content: self.revisions.latest_content(
+                page_name, current_content))
+        if revision is None:
             return None, None, None
+        return (content, revision.timestamp.strftime(DISPLAY_FORMAT),
+                revision.username)
+
+    def get_all_previous_versions(self, page_name, offset=0, limit=None):
+        return self._fetch_previous_versions(page_name, offset, limit)
+
+    def get_revision(self, page_name, revision_name):
+        """Returns (content, timestamp, username) of one revision of a page.
+
+        Raises:
+            ValueError if the page has no such revision.
+            StaleBaseError if the page kept changing while reading it.
+        """
+        revision, content = self._from_current(
+            page_name, lambda current_content: self.revisions.get(
+                page_name, revision_name, current_content))
+        return (content, revision.timestamp.strftime(DISPLAY_FORMAT),
+                revision.username)
+
+    def get_diff(self, page_name, old_revision, new_revision=None):
+        """Returns the diff.Diff between two versions of a page.
+
+        Args:
+            page_name: name of the page
+            old_revision: name of the older revision, as listed by
+                get_all_previous_versions
+            new_revision: name of the newer revision, or None for the
+                current page
+
+        Raises:
+            ValueError if the page or either revision does not exist.
+            StaleBaseError if the page kept changing while reading it.
+        """
+        try:
+            return self._get_diff(page_name, old_revision, new_revision)
+        except StaleBaseError:
+            self.page_cache.pop(page_name)
+            return self._get_diff(page_name, old_revision, new_revision)
+
+    def _get_diff(self, page_name, old_revision, new_revision):
+        if new_revision is None:
+            new_content, generation = self.get_wiki_page_info(page_name)
+            key = (page_name, old_revision, generation)
+        else:
+            key = (page_name, old_revision, new_revision)
+        cached = self.diff_cache.get(key)
+        if cached is not None:
+            return cached
+
+        def content(revision_name):
+            return self.revisions.content(
+                page_name, revision_name, lambda: self.get_wiki_page(page_name))
+
+        if new_revision is None:
+            # rebuilt on top of the very version the diff is cached for
+            old_content = self.revisions.content(page_name, old_revision,
+                                                 lambda: new_content)
+        else:
+            # both versions may need a chain of deltas read, so fetch them
+            # at the same time
+            old = self._submit(content, old_revision)
+            new = self._submit(content, new_revision)
+            self._wait(old, new)
+            old_content, new_content = old.result(), new.result()
+        result = diff.diff(old_content, new_content)
+        self.diff_cache.set(key, result)
+        return result
 
-        latest_history_blob_name, timestamp, username = previous_versions[0]
-        latest_history_blob = self.content_bucket.get_blob(latest_history_blob_name)
-        return latest_history_blob.download_as_text(), timestamp, username
+    def migrate_history(self):
+        """Builds the revision manifest of every page from its history blobs.
 
-    def get_all_previous_versions(self, page_name):
-        return self._fetch_previous_versions(page_name)
+        Returns the number of pages migrated.
+        """
+        page_names = self.get_all_page_names()
+        for page_name in page_names:
+            self.revisions.migrate(page_name)
+        return len(page_names)
@@ -1,8 +1,15 @@
 from flaskr.backend import Backend
-from unittest.mock import MagicMock, patch
+from flaskr.cache import LRUCache
+from flaskr.storage import ConflictError, LocalStorage
+from flaskr.passwords import PasswordHasher, legacy_hash
+from io import BytesIO
+from unittest.mock import ANY, MagicMock, patch
+from google.api_core.exceptions import PreconditionFailed
 from google.cloud import storage
 from google.cloud.storage.bucket import Bucket
 import pytest
+import datetime
+import threading
 """
 This fixture just creates a mock object that we will use to represent the
 filestream used in our blobs.
@@ -44,19 +51,6 @@ def make_bucket(blob):
     return bucket
 
 
-"""
-This fixture helps use mock the sha256 object that we use when we hash our 
-username and password. It specifically mocks the hexdigest() function call and 
-sets the return value as return_value.
-"""
-
-
-def sha256(return_value):
-    hash_object = MagicMock()
-    hash_object.hexdigest.return_value = return_value
-    return hash_object
-
-
 """
 This fixture helps us mock the content bucket used to store the page contents. 
 It uses the make_bucket() helper method that we defined above.
@@ -102,7 +96,7 @@ def backend(user_bucket, content_bucket):
 
 
 def test_get_wiki_page_success(backend, content_bucket, file_stream):
-    file_stream.read.return_value = "test worked"
+    file_stream.read.return_value = b"test worked"
 
     value = backend.get_wiki_page("test")
 
@@ -118,6 +112,53 @@ def test_get_wiki_page_failure(backend, content_bucket):
         assert str(ve) == "No page exists with the given name: test"
 
 
+def test_get_wiki_page_cached(backend, content_bucket, blob, file_stream):
+    file_stream.read.return_value = b"test worked"
+
+    backend.get_wiki_page("test")
+    value = backend.get_wiki_page("test")
+
+    assert value == "test worked"
+    assert content_bucket.get_blob.call_count == 1
+    assert backend.page_cache.hits == 1
+
+
+def test_get_wiki_page_revalidates_expired_entry(user_bucket, content_bucket,
+                                                 blob, file_stream):
+    storage_client = MagicMock()
+    storage_client.bucket.side_effect = [user_bucket, content_bucket]
+    backend = Backend(storage_client=storage_client,
+                      page_cache=LRUCache(ttl=0))
+    file_stream.read.return_value = b"test worked"
+
+    backend.get_wiki_page("test")
+    value = backend.get_wiki_page("test")
+
+    # the second call only looks up the generation, which is unchanged
+    assert value == "test worked"
+    assert content_bucket.get_blob.call_count == 2
+    assert blob.open.call_count == 1
+
+
+def test_save_wiki_page_caches_new_content(backend, file_stream):
+    file_stream.read.return_value = b"old content"
+    backend.page_index = MagicMock()
+    backend.search_index = MagicMock()
+    backend.link_index = MagicMock()
+    backend.revisions = MagicMock()
+    backend.get_wiki_page("test")
+
+    backend.save_wiki_page("test", "new content", "test_user")
+
+    backend.revisions.record.assert_called_with("test", "old content",
+                                                "new content", "test_user",
+                                                ANY)
+    # the write returned the new generation, so the page is not read again
+    assert backend.page_cache.peek("test")[1] == "new content"
+    # the page already existed, so the page index is left alone
+    backend.page_index.add.assert_not_called()
+
+
 def test_get_all_pages(backend, content_bucket):
     blobs = [MagicMock() for _ in range(5)]
     blobs[0].name = "test0"
@@ -126,30 +167,48 @@ def test_get_all_pages(backend, content_bucket):
     blobs[3].name = "test3"
     blobs[4].name = "test4.jpeg"
     content_bucket.list_blobs.return_value = blobs
+    # no page index has been written yet, so it is rebuilt from a listing
+    content_bucket.get_blob.return_value = None
 
     value = backend.get_all_page_names()
 
-    content_bucket.list_blobs.assert_called_with()
+    content_bucket.list_blobs.assert_called_with(prefix=None)
+    assert value == ["test0", "test3"]
+
+
+def test_get_all_pages_from_index(backend, content_bucket, file_stream):
+    file_stream.read.return_value = b'["test0", "test3"]'
+
+    value = backend.get_all_page_names()
+
+    content_bucket.get_blob.assert_called_with("indexes/pages.json")
+    content_bucket.list_blobs.assert_not_called()
     assert value == ["test0", "test3"]
 
 
 def test_upload_success(backend, content_bucket, blob, file_stream):
-    content_bucket.get_blob.return_value = None
+    blob.exists.return_value = False
+    backend.page_index = MagicMock()
+    backend.search_index = MagicMock()
+    backend.link_index = MagicMock()
 
-    backend.upload("test", "test data")
+    backend.upload("test", b"test data")
 
     content_bucket.blob.assert_called_with("test")
-    blob.open.assert_called_with("wb")
-    file_stream.write.assert_called_with("test data")
+    blob.upload_from_string.assert_called_with(b"test data",
+                                               if_generation_match=0)
+    backend.page_index.add.assert_called_with("test")
 
 
-def test_upload_failure(backend, content_bucket):
-    try:
-        backend.upload("test", "test data")
-    except ValueError as v:
-        assert str(v) == "test already exists in the content bucket!"
+def test_upload_failure(backend, content_bucket, blob):
+    blob.upload_from_string.side_effect = PreconditionFailed("exists")
 
-    content_bucket.get_blob.assert_called_with("test")
+    with pytest.raises(ValueError) as v:
+        backend.upload("test", b"test data")
+
+    assert str(v.value) == "test already exists in the content bucket!"
+
+    content_bucket.blob.assert_called_with("test")
 
 
 def test_get_image_success(backend, content_bucket, blob, file_stream):
@@ -170,16 +229,16 @@ def test_get_image_failure(backend, content_bucket):
     assert image.read() == "".encode()
 
 
-@patch('flaskr.backend.sha256', return_value=sha256("test hash"))
-def test_sign_up_success(hash, backend, user_bucket, blob, file_stream):
-    user_bucket.get_blob.return_value = None
+def test_sign_up_success(backend, user_bucket, blob, file_stream):
+    blob.exists.return_value = False
+    backend.password_hasher = PasswordHasher(cost=2**4)
 
     user = backend.sign_up("test_user", "password")
 
     user_bucket.blob.assert_called_with("test_user")
-    blob.open.assert_called_with("w")
-    hash.assert_called_with("test_user:password".encode())
-    file_stream.write.assert_called_with("test hash")
+    record = blob.upload_from_string.call_args[0][0].decode()
+    assert record.startswith("$scrypt$n=16,r=8,p=1$")
+    assert backend.password_hasher.verify(record, "password", "test_user")
 
     assert user.username == "test_user"
 
@@ -190,18 +249,20 @@ def test_sign_up_failure(backend, user_bucket, blob, file_stream):
     except ValueError as v:
         assert str(v) == "Username test_user already exists!"
 
-    user_bucket.get_blob.assert_called_with("test_user")
+    user_bucket.blob.assert_called_with("test_user")
 
 
-@patch('flaskr.backend.sha256', return_value=sha256("test hash"))
-def test_sign_in_success(hash, backend, user_bucket, blob, file_stream):
-    file_stream.read.return_value = "test hash"
+def test_sign_in_success(backend, user_bucket, blob, file_stream):
+    backend.password_hasher = PasswordHasher(cost=2**4)
+    record = backend.password_hasher.hash("password")
+    file_stream.read.return_value = record.encode()
 
     user = backend.sign_in("test_user", "password")
 
     user_bucket.get_blob.assert_called_with("test_user")
-    blob.open.assert_called_with()
-    hash.assert_called_with("test_user:password".encode())
+    blob.open.assert_called_with("rb")
+    # the record is current, so it is not rewritten
+    blob.open.assert_called_once()
     assert user.username == "test_user"
 
 
@@ -216,9 +277,9 @@ def test_sign_in_no_user(backend, user_bucket, blob, file_stream):
     user_bucket.get_blob.assert_called_with("test_user")
 
 
-@patch('flaskr.backend.sha256', return_value=sha256("bad hash"))
-def test_sign_in_bad_password(hash, backend, user_bucket, blob, file_stream):
-    file_stream.read.return_value = "test hash"
+def test_sign_in_bad_password(backend, user_bucket, blob, file_stream):
+    file_stream.read.return_value = legacy_hash("test_user",
+                                                "password").encode()
 
     try:
         backend.sign_in("test_user", "bad password")
@@ -226,14 +287,615 @@ def test_sign_in_bad_password(hash, backend, user_bucket, blob, file_stream):
         assert str(v) == "Invalid password for username test_user!"
 
     user_bucket.get_blob.assert_called_with("test_user")
-    blob.open.assert_called_with()
-    hash.assert_called_with("test_user:bad password".encode())
+    blob.open.assert_called_with("rb")
+
+
+def test_sign_in_upgrades_legacy_record(local_backend):
+    local_backend.user_storage.put("test_user",
+                                   legacy_hash("test_user", "password"))
+
+    local_backend.sign_in("test_user", "password")
+    record = local_backend.user_storage.get("test_user").decode()
+
+    assert record.startswith("$scrypt$")
+    assert local_backend.sign_in("test_user",
+                                 "password").username == "test_user"
 
 
 
 def test_revert_to_previous_failure(backend, content_bucket, blob):
     content_bucket.list_blobs.return_value = []
+    # the page's revision manifest is empty
+    blob.download_as_bytes.return_value = b""
 
     result = backend.revert_to_previous("test", "test_user")
 
     assert result is False
+
+
+@pytest.mark.parametrize(('prefix', 'start_after', 'limit', 'expected'), (
+    ('', None, None, (["a", "b1", "b2", "c"], None)),
+    ('', None, 2, (["a", "b1"], "b1")),
+    ('', "b1", 2, (["b2", "c"], None)),
+    ('b', None, 1, (["b1"], "b1")),
+    ('b', "b1", 1, (["b2"], None)),
+    ('z', None, 10, ([], None)),
+))
+def test_get_page_names(backend, prefix, start_after, limit, expected):
+    with patch.object(backend,
+                      "get_all_page_names",
+                      return_value=["a", "b1", "b2", "c"]):
+        assert backend.get_page_names(prefix, start_after, limit) == expected
+
+
+@pytest.fixture
+def local_backend(tmp_path):
+    return Backend(user_storage=LocalStorage(str(tmp_path / "users")),
+                   content_storage=LocalStorage(str(tmp_path / "content")),
+                   snapshot_interval=2,
+                   password_hasher=PasswordHasher(cost=2**4))
+
+
+def test_previous_versions_round_trip(local_backend):
+    local_backend.upload("Sega", b"first")
+    for content in ["second", "third", "fourth"]:
+        local_backend.save_wiki_page("Sega", content, "test_user")
+
+    versions = local_backend.get_all_previous_versions("Sega")
+    content, timestamp, username = local_backend.get_previous_version("Sega")
+
+    assert len(versions) == 3
+    assert all(len(version) == 3 for version in versions)
+    assert (content, timestamp, username) == ("third", versions[0][1],
+                                              "test_user")
+    assert local_backend.revert_to_previous("Sega", "test_user")
+    assert local_backend.get_wiki_page("Sega") == "third"
+
+
+def test_get_revision_and_diff(local_backend, monkeypatch):
+    local_backend.upload("Sega", b"Sega Genesis\nSaturn")
+    local_backend.save_wiki_page("Sega", "Sega Mega Drive\nSaturn",
+                                 "test_user")
+    local_backend.save_wiki_page("Sega", "Sega Mega Drive\nSaturn\nDreamcast",
+                                 "other_user")
+    newest, oldest = [name for name, _, _ in
+                      local_backend.get_all_previous_versions("Sega")]
+
+    content, _, username = local_backend.get_revision("Sega", oldest)
+    assert (content, username) == ("Sega Genesis\nSaturn", "test_user")
+
+    changes = local_backend.get_diff("Sega", oldest, newest)
+    assert changes.rows == [("change", [("equal", "Sega "),
+                                        ("delete", "Genesis"),
+                                        ("insert", "Mega Drive")]),
+                            ("equal", "Saturn")]
+    assert local_backend.get_diff("Sega", oldest).added == 2
+
+    # diffs are computed once per pair of versions
+    monkeypatch.setattr(local_backend.revisions, "content", None)
+    assert local_backend.get_diff("Sega", oldest, newest) == changes
+    with pytest.raises(ValueError):
+        local_backend.get_revision("Sega", "history/Sega/missing.delta")
+
+
+def test_revisions_rebuilt_on_stale_cached_page(local_backend):
+    local_backend.upload("Sega", b"Genesis")
+    for content in ["Saturn", "Naomi"]:
+        local_backend.save_wiki_page("Sega", content, "test_user")
+    stale = local_backend.page_cache.peek("Sega")
+    # another worker saves, our page cache still has the old version
+    local_backend.content_storage.put("Sega", b"Dreamcast")
+    local_backend.revisions.record("Sega", "Naomi", "Dreamcast", "other_user")
+    newest = local_backend.get_all_previous_versions("Sega")[0][0]
+
+    local_backend.page_cache.set("Sega", stale)
+    assert local_backend.get_previous_version("Sega")[0] == "Naomi"
+    local_backend.page_cache.set("Sega", stale)
+    assert local_backend.get_revision("Sega", newest)[0] == "Naomi"
+    local_backend.page_cache.set("Sega", stale)
+    assert local_backend.get_diff("Sega", newest).rows == [
+        ("delete", "Naomi"), ("insert", "Dreamcast")]
+
+
+def test_revert_to_revision_copies_inside_storage(local_backend,
+                                                  monkeypatch):
+    local_backend.upload("Sega", b"Genesis")
+    for content in ["Saturn", "Dreamcast", "Naomi"]:
+        local_backend.save_wiki_page("Sega", content, "test_user")
+    # with snapshot_interval 2, the second newest revision is a full copy
+    names = [name for name, _, _ in
+             local_backend.get_all_previous_versions("Sega")]
+    storage = local_backend.content_storage
+    reads = [
+        MagicMock(wraps=storage.get),
+        MagicMock(wraps=storage.get_with_info)
+    ]
+    monkeypatch.setattr(storage, "get", reads[0])
+    monkeypatch.setattr(storage, "get_with_info", reads[1])
+
+    local_backend.revert_to_revision("Sega", names[1], "admin")
+
+    # only the search and link indexes read the reverted page back
+    assert [c.args[0] for read in reads for c in read.call_args_list
+            if c.args[0] == "Sega"] == ["Sega"]
+    assert local_backend.get_wiki_page("Sega") == "Saturn"
+    newest = local_backend.get_all_previous_versions("Sega")[0]
+    assert newest[2] == "admin"
+    assert local_backend.get_revision("Sega", newest[0])[0] == "Naomi"
+    assert [name for name, _ in local_backend.search("saturn")] == ["Sega"]
+
+
+def test_revert_to_delta_revision(local_backend):
+    local_backend.upload("Sega", b"Genesis")
+    for content in ["Saturn", "Dreamcast"]:
+        local_backend.save_wiki_page("Sega", content, "test_user")
+    oldest = local_backend.get_all_previous_versions("Sega")[-1][0]
+
+    local_backend.revert_to_revision("Sega", oldest, "admin")
+
+    assert local_backend.get_wiki_page("Sega") == "Genesis"
+    with pytest.raises(ValueError):
+        local_backend.revert_to_revision("Sega", "history/Sega/missing.txt",
+                                         "admin")
+
+
+def test_revert_conflict_keeps_history(local_backend, monkeypatch):
+    local_backend.upload("Sega", b"Genesis")
+    local_backend.save_wiki_page("Sega", "Saturn", "test_user")
+    revision = local_backend.get_all_previous_versions("Sega")[0][0]
+    storage = local_backend.content_storage
+    put = storage.put
+
+    def put_after_concurrent_save(name, data, if_generation_match=None):
+        if name == "Sega":
+            put("Sega", "Dreamcast")
+        return put(name, data, if_generation_match)
+
+    monkeypatch.setattr(storage, "put", put_after_concurrent_save)
+
+    with pytest.raises(ConflictError):
+        local_backend.revert_to_revision("Sega", revision, "admin")
+    monkeypatch.setattr(storage, "put", put)
+    assert len(local_backend.get_all_previous_versions("Sega")) == 1
+    assert local_backend.get_wiki_page("Sega") == "Dreamcast"
+
+
+def test_revert_edits_by(local_backend):
+    local_backend.upload("Sega", b"Genesis")
+    local_backend.upload("Nintendo", b"NES")
+    local_backend.upload("Atari", b"2600")
+    local_backend.save_wiki_page("Atari", "Jaguar", "alice")
+    since = datetime.datetime.utcnow()
+    for content in ["spam", "more spam"]:
+        local_backend.save_wiki_page("Sega", content, "vandal")
+    local_backend.save_wiki_page("Nintendo", "spam", "vandal")
+    local_backend.save_wiki_page("Nintendo", "SNES", "alice")
+
+    assert local_backend.revert_edits_by("vandal", since, "admin",
+                                         dry_run=True) == (["Sega"],
+                                                           ["Nintendo"])
+    assert local_backend.get_wiki_page("Sega") == "more spam"
+
+    reverted, skipped = local_backend.revert_edits_by("vandal", since,
+                                                      "admin")
+
+    assert (reverted, skipped) == (["Sega"], ["Nintendo"])
+    assert local_backend.get_wiki_page("Sega") == "Genesis"
+    assert local_backend.get_wiki_page("Atari") == "Jaguar"
+    assert local_backend.search("spam") == []
+    assert [name for name, _ in local_backend.search("genesis")] == ["Sega"]
+
+
+def test_stream_image_in_chunks(local_backend, monkeypatch):
+    monkeypatch.setattr("flaskr.backend.IMAGE_CHUNK_SIZE", 4)
+    local_backend.upload("image.png", b"0123456789")
+
+    assert list(local_backend.stream_image("image.png")) == [
+        b"0123", b"4567", b"89"
+    ]
+    assert list(local_backend.stream_image("image.png", 3,
+                                           9)) == [b"3456", b"78"]
+    assert local_backend.get_image_info("image.png").size == 10
+
+
+def test_resumable_upload(local_backend):
+    upload_id = local_backend.start_upload("Sega", 10)
+
+    assert local_backend.write_upload(upload_id, 0, BytesIO(b"0123"),
+                                      4) == (4, None)
+    with pytest.raises(ConflictError):
+        local_backend.write_upload(upload_id, 0, BytesIO(b"0123"), 4)
+    assert local_backend.upload_offset(upload_id) == (4, 10)
+    assert local_backend.write_upload(upload_id, 4, BytesIO(b"456789"),
+                                      6) == (10, "Sega")
+
+    assert local_backend.get_wiki_page("Sega") == "0123456789"
+    assert local_backend.get_all_page_names() == ["Sega"]
+    assert list(local_backend.content_storage.list(prefix="uploads/")) == []
+    with pytest.raises(KeyError):
+        local_backend.upload_offset(upload_id)
+
+
+def test_resumable_upload_drops_short_part(local_backend):
+    upload_id = local_backend.start_upload("Sega", 10)
+
+    with pytest.raises(ValueError):
+        local_backend.write_upload(upload_id, 0, BytesIO(b"01"), 4)
+    assert local_backend.upload_offset(upload_id) == (0, 10)
+
+
+def test_resumable_upload_drops_interrupted_part(local_backend,
+                                                 monkeypatch):
+    upload_id = local_backend.start_upload("Sega", 10)
+    storage = local_backend.content_storage
+    put = storage.put
+
+    def put_then_disconnect(name, data, if_generation_match=None):
+        # like GCS before the fix: what arrived is stored, then the error
+        put(name, data.read(2), if_generation_match)
+        raise ConnectionError("client went away")
+
+    monkeypatch.setattr(storage, "put", put_then_disconnect)
+    with pytest.raises(ConnectionError):
+        local_backend.write_upload(upload_id, 0, BytesIO(b"0123"), 4)
+    monkeypatch.undo()
+
+    assert local_backend.upload_offset(upload_id) == (0, 10)
+    assert local_backend.write_upload(upload_id, 0, BytesIO(b"0123"),
+                                      4) == (4, None)
+
+
+def test_upload_offset_ignores_short_part(local_backend):
+    upload_id = local_backend.start_upload("Sega", 10)
+    local_backend.write_upload(upload_id, 0, BytesIO(b"0123"), 4)
+    short = f"uploads/{upload_id}/part-{4:020d}-{8:020d}"
+    local_backend.content_storage.put(short, b"45")
+
+    assert local_backend.upload_offset(upload_id) == (4, 10)
+    assert not local_backend.content_storage.exists(short)
+    local_backend.write_upload(upload_id, 4, BytesIO(b"456789"), 6)
+    assert local_backend.get_wiki_page("Sega") == "0123456789"
+
+
+def test_start_upload_checks_size_and_name(local_backend):
+    local_backend.upload("Sega", b"data")
+
+    with pytest.raises(ValueError):
+        local_backend.start_upload("Sega", 10)
+    with pytest.raises(ValueError):
+        local_backend.start_upload("Nintendo", 10, max_size=5)
+    with pytest.raises(ValueError):
+        local_backend.start_upload("uploads/Nintendo", 10)
+
+
+def test_start_empty_upload_creates_page(local_backend):
+    assert local_backend.start_upload("Sega", 0) is None
+
+    assert local_backend.get_wiki_page("Sega") == ""
+    assert list(local_backend.content_storage.list(prefix="uploads/")) == []
+
+
+@pytest.mark.parametrize("name", [
+    "indexes/pages.json", "variants/320/logo.png", "uploads/x/session.json",
+    "history/Sega/manifest.jsonl"
+])
+def test_upload_rejects_reserved_names(local_backend, name):
+    local_backend.url_signer = MagicMock()
+
+    with pytest.raises(ValueError):
+        local_backend.upload(name, b"data")
+    with pytest.raises(ValueError):
+        local_backend.create_upload_url(name, "text/plain", 60)
+    assert not local_backend.content_storage.exists(name)
+
+
+def test_expire_uploads(local_backend):
+    old = local_backend.start_upload("Sega", 10)
+    recent = local_backend.start_upload("Nintendo", 10)
+    local_backend.write_upload(old, 0, BytesIO(b"0123"), 4)
+    # the session of an interrupted abort is gone, its part is not
+    local_backend.content_storage.put("uploads/" + "0" * 32 + "/part-x", b"")
+    storage = local_backend.content_storage
+    later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        hours=2)
+    stat = storage.stat
+
+    def stat_recent_as_new(name):
+        info = stat(name)
+        if recent in name:
+            return info._replace(updated=later)
+        return info
+
+    storage.stat = stat_recent_as_new
+
+    assert local_backend.expire_uploads(3600, now=later) == 2
+    with pytest.raises(KeyError):
+        local_backend.upload_offset(old)
+    assert local_backend.upload_offset(recent) == (0, 10)
+    assert [name for name in storage.list(prefix="uploads/")
+            ] == [f"uploads/{recent}/session.json"]
+
+
+def test_save_drops_rendered_pages(local_backend):
+    local_backend.upload("Sega", b"first")
+    _, generation = local_backend.get_wiki_page_info("Sega")
+    local_backend.rendered_cache.set(("Sega", generation, None), "<html>")
+    local_backend.rendered_cache.set(("Nintendo", 1, None), "<html>")
+
+    local_backend.save_wiki_page("Sega", "second", "test_user")
+
+    assert local_backend.get_wiki_page_info("Sega")[1] > generation
+    assert len(local_backend.rendered_cache) == 1
+
+
+def test_sign_in_caches_user_records(local_backend, monkeypatch):
+    local_backend.user_storage.put(
+        "test_user", local_backend.password_hasher.hash("password"))
+    get = MagicMock(wraps=local_backend.user_storage.get)
+    monkeypatch.setattr(local_backend.user_storage, "get", get)
+
+    first = local_backend.sign_in("test_user", "password")
+    second = local_backend.sign_in("test_user", "password")
+    with pytest.raises(ValueError):
+        local_backend.sign_in("test_user", "bad password")
+
+    assert first is second
+    get.assert_called_once_with("test_user")
+
+
+def test_unknown_users_are_cached_until_sign_up(local_backend, monkeypatch):
+    get = MagicMock(wraps=local_backend.user_storage.get)
+    monkeypatch.setattr(local_backend.user_storage, "get", get)
+
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            local_backend.sign_in("test_user", "password")
+    local_backend.sign_up("test_user", "password")
+
+    assert get.call_count == 1
+    assert local_backend.sign_in("test_user",
+                                 "password").username == "test_user"
+
+
+def test_search_follows_saves_and_uploads(local_backend):
+    local_backend.upload("Sega", b"Genesis")
+    local_backend.upload("Nintendo", BytesIO(b"NES"))
+    local_backend.upload("logo.png", b"Genesis")
+    local_backend.save_wiki_page("Sega", "Dreamcast", "test_user")
+
+    assert local_backend.search("genesis") == []
+    assert sorted(name for name, _ in local_backend.search("dreamcast nes")
+                 ) == ["Nintendo", "Sega"]
+
+    local_backend.revert_to_previous("Sega", "test_user")
+    assert [name for name, _ in local_backend.search("genesis")] == ["Sega"]
+
+
+def test_rebuild_search_index(local_backend):
+    local_backend.content_storage.put("Sega", b"Genesis")
+    local_backend.rebuild_page_index()
+
+    assert local_backend.rebuild_search_index() == 1
+    assert [name for name, _ in local_backend.search("genesis")] == ["Sega"]
+
+
+def test_links_follow_saves_and_uploads(local_backend):
+    local_backend.upload("Sega", b"Rival of [[Nintendo]] and [[Atari]].")
+    local_backend.upload("Nintendo", BytesIO(b"See [[Sega]]."))
+
+    assert local_backend.get_backlinks("Sega") == ["Nintendo"]
+    assert local_backend.get_backlinks("Nintendo") == ["Sega"]
+    assert local_backend.get_broken_links("Sega") == ["Atari"]
+
+    local_backend.save_wiki_page("Sega", "Rival of [[Nintendo]].",
+                                 "test_user")
+    assert local_backend.get_all_broken_links() == []
+    local_backend.save_wiki_page("Nintendo", "See [[Sega]] and [[Sony]].",
+                                 "test_user")
+    assert local_backend.get_all_broken_links() == [("Sony", ["Nintendo"])]
+
+
+def test_links_to_pages_too_large_to_index(local_backend, monkeypatch):
+    monkeypatch.setattr("flaskr.backend.MAX_INDEXED_BYTES", 16)
+    local_backend.upload("Big", BytesIO(b"[[Atari]] " * 4))
+    local_backend.upload("Small", b"See [[Big]].")
+
+    assert local_backend.get_all_broken_links() == []
+    assert local_backend.get_backlinks("Big") == ["Small"]
+    local_backend.rebuild_link_index()
+    assert local_backend.get_all_broken_links() == []
+
+
+def test_save_keeping_links_does_not_write_link_index(local_backend,
+                                                      monkeypatch):
+    local_backend.upload("Sega", b"See [[Nintendo]].")
+    put = MagicMock(wraps=local_backend.content_storage.put)
+    monkeypatch.setattr(local_backend.content_storage, "put", put)
+
+    local_backend.save_wiki_page("Sega", "Also see [[Nintendo]].",
+                                 "test_user")
+
+    assert "indexes/links.json.z" not in [c.args[0] for c in put.call_args_list]
+
+
+def test_rebuild_link_index(local_backend):
+    local_backend.content_storage.put("Sega", b"See [[Nintendo]].")
+    local_backend.rebuild_page_index()
+
+    assert local_backend.rebuild_link_index() == 1
+    assert local_backend.get_backlinks("Nintendo") == ["Sega"]
+
+
+def test_save_writes_history_and_content_concurrently(local_backend,
+                                                      monkeypatch):
+    local_backend.upload("Sega", b"Genesis")
+    both_started = threading.Barrier(2, timeout=5)
+    record = local_backend.revisions.record
+    put = local_backend.content_storage.put
+
+    def waiting(fn):
+        calls = []
+
+        def call(*args, **kwargs):
+            # the first call of each only returns once both have started
+            if not calls:
+                calls.append(args)
+                both_started.wait()
+            return fn(*args, **kwargs)
+
+        return call
+
+    monkeypatch.setattr(local_backend.revisions, "record", waiting(record))
+    monkeypatch.setattr(local_backend.content_storage, "put", waiting(put))
+    local_backend.save_wiki_page("Sega", "Dreamcast", "test_user")
+    monkeypatch.undo()
+
+    assert local_backend.get_wiki_page("Sega") == "Dreamcast"
+    assert local_backend.get_previous_version("Sega")[0] == "Genesis"
+
+
+def test_save_discards_revision_if_content_write_fails(local_backend,
+                                                       monkeypatch):
+    local_backend.upload("Sega", b"Genesis")
+    put = local_backend.content_storage.put
+
+    def failing_put(name, data, if_generation_match=None):
+        if name == "Sega":
+            raise ConnectionError("storage unavailable")
+        return put(name, data, if_generation_match)
+
+    monkeypatch.setattr(local_backend.content_storage, "put", failing_put)
+    with pytest.raises(ConnectionError):
+        local_backend.save_wiki_page("Sega", "Dreamcast", "test_user")
+    monkeypatch.undo()
+
+    assert local_backend.get_wiki_page("Sega") == "Genesis"
+    assert local_backend.get_all_previous_versions("Sega") == []
+
+
+def test_save_restores_content_if_history_fails(local_backend, monkeypatch):
+    local_backend.upload("Sega", b"Genesis")
+    monkeypatch.setattr(local_backend.revisions, "record",
+                        MagicMock(side_effect=ConflictError("busy")))
+
+    with pytest.raises(ConflictError):
+        local_backend.save_wiki_page("Sega", "Dreamcast", "test_user")
+
+    assert local_backend.get_wiki_page("Sega") == "Genesis"
+
+
+def test_save_keeps_concurrent_content_if_history_fails(local_backend,
+                                                       monkeypatch):
+    local_backend.upload("Sega", b"Genesis")
+    storage = local_backend.content_storage
+    put = storage.put
+
+    def put_then_concurrent_save(name, data, if_generation_match=None):
+        generation = put(name, data, if_generation_match)
+        if data == "Dreamcast":
+            put(name, b"Saturn")
+        return generation
+
+    monkeypatch.setattr(storage, "put", put_then_concurrent_save)
+    monkeypatch.setattr(local_backend.revisions, "record",
+                        MagicMock(side_effect=ConnectionError("busy")))
+
+    with pytest.raises(ConnectionError):
+        local_backend.save_wiki_page("Sega", "Dreamcast", "test_user")
+
+    assert local_backend.get_wiki_page("Sega") == "Saturn"
+
+
+def test_save_does_not_retry_on_index_conflicts(local_backend, monkeypatch):
+    local_backend.upload("Sega", b"Genesis")
+    monkeypatch.setattr(local_backend.search_index, "add",
+                        MagicMock(side_effect=ConflictError("busy")))
+
+    local_backend.save_wiki_page("Sega", "Dreamcast", "test_user")
+
+    assert local_backend.get_wiki_page("Sega") == "Dreamcast"
+    assert len(local_backend.get_all_previous_versions("Sega")) == 1
+
+
+def test_save_missing_page_does_nothing(local_backend):
+    local_backend.save_wiki_page("Sega", "Dreamcast", "test_user")
+
+    assert not local_backend.content_storage.exists("Sega")
+
+
+def test_save_rejects_edits_of_an_old_version(local_backend):
+    local_backend.upload("Sega", b"Genesis")
+    _, generation = local_backend.get_wiki_page_info("Sega")
+    local_backend.save_wiki_page("Sega", "Dreamcast", "other_user", generation)
+
+    with pytest.raises(ConflictError):
+        local_backend.save_wiki_page("Sega", "Saturn", "test_user", generation)
+
+    assert local_backend.get_wiki_page("Sega") == "Dreamcast"
+    assert len(local_backend.get_all_previous_versions("Sega")) == 1
+
+
+def test_save_retries_when_cached_copy_is_stale(local_backend):
+    local_backend.upload("Sega", b"Genesis")
+    local_backend.get_wiki_page("Sega")
+    # another worker saves, our page cache still has the old version
+    local_backend.content_storage.put("Sega", b"Dreamcast")
+
+    local_backend.save_wiki_page("Sega", "Saturn", "test_user")
+
+    assert local_backend.get_wiki_page("Sega") == "Saturn"
+    assert local_backend.get_previous_version("Sega")[0] == "Dreamcast"
+
+
+def test_save_copies_snapshots_inside_storage(tmp_path, monkeypatch):
+    backend = Backend(user_storage=LocalStorage(str(tmp_path / "users")),
+                      content_storage=LocalStorage(str(tmp_path / "content")),
+                      snapshot_interval=1,
+                      io_workers=0)
+    backend.upload("Sega", b"Genesis")
+    copy = MagicMock(wraps=backend.content_storage.copy)
+    monkeypatch.setattr(backend.content_storage, "copy", copy)
+
+    backend.save_wiki_page("Sega", "Dreamcast", "test_user")
+
+    copy.assert_called_once()
+    assert backend.get_previous_version("Sega")[0] == "Genesis"
+
+
+def test_get_image_variant_is_made_once(local_backend):
+    local_backend.upload("cami.jpg", b"\xff\xd8 original")
+    info = local_backend.get_image_info("cami.jpg")
+    with patch("flaskr.thumbnails.available", return_value=True), patch(
+            "flaskr.thumbnails.resize",
+            return_value=(b"\xff\xd8 small", "image/jpeg")) as mock_resize:
+        assert local_backend.get_image_variant(
+            "cami.jpg", 200) == (b"\xff\xd8 small", "image/jpeg")
+        local_backend.variant_cache.clear()
+        # read back from the stored variant
+        assert local_backend.get_image_variant(
+            "cami.jpg", 200, info) == (b"\xff\xd8 small", "image/jpeg")
+
+    mock_resize.assert_called_once_with(b"\xff\xd8 original", 200)
+    name = f"variants/cami.jpg/w200-{info.generation}"
+    assert local_backend.content_storage.get(name) == b"\xff\xd8 small"
+    # variants are not pages
+    assert "variants" not in " ".join(local_backend.get_all_page_names())
+
+
+def test_get_image_variant_remembers_originals(local_backend):
+    local_backend.upload("tiny.png", b"\x89PNG tiny")
+    with patch("flaskr.thumbnails.available", return_value=True), patch(
+            "flaskr.thumbnails.resize", return_value=None) as mock_resize:
+        assert local_backend.get_image_variant("tiny.png", 200) is None
+        local_backend.variant_cache.clear()
+        assert local_backend.get_image_variant("tiny.png", 200) is None
+        assert local_backend.get_image_variant("missing.png", 200) is None
+
+    mock_resize.assert_called_once()
+
+
+def test_get_image_variant_without_pillow(local_backend):
+    local_backend.upload("cami.jpg", b"\xff\xd8 original")
+    with patch("flaskr.thumbnails.available", return_value=False):
+        assert local_backend.get_image_variant("cami.jpg", 200) is None
+    assert list(local_backend.content_storage.list("variants/")) == []
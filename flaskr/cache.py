@@ -0,0 +1,93 @@
+"""In-process caches used by the Backend.
+
+LRUCache is a small thread-safe mapping with a bounded number of entries,
+least-recently-used eviction and a time-to-live. Expired entries are not
+returned by get() but are kept (until evicted) so callers can cheaply
+revalidate them with peek(), e.g. by comparing storage generations.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+
+    def __init__(self, maxsize=128, ttl=None, clock=time.monotonic):
+        """Constructs an empty cache.
+
+        Args:
+            maxsize: maximum number of entries kept before evicting
+            ttl: seconds an entry stays fresh, or None to never expire
+            clock: function returning the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the fresh value stored under key, counting hits/misses."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry):
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key, default=None):
+        """Returns the value under key even if expired, without counting."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return default if entry is None else entry[0]
+
+    def set(self, key, value):
+        """Stores value under key, evicting the least recently used entry."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, self.clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        """Removes the entry stored under key if there is one."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pop_where(self, predicate):
+        """Removes every entry whose key satisfies predicate(key)."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the counters needed to size the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expired(self, entry):
+        return self.ttl is not None and self.clock() - entry[1] >= self.ttl
@@ -0,0 +1,137 @@
+"""Line and word diffs between two versions of a page.
+
+diff() compares two texts line by line and returns the rows to show: equal
+lines around the changes (longer runs are skipped), deleted and inserted
+lines, and changed lines, which are paired up old with new and compared
+word by word.
+
+Diffing costs time that grows faster than the size of the pages, so the
+work is bounded: the lines the two versions start and end with are skipped
+before comparing, changed regions longer than MAX_LINES lines are shown as a
+plain replacement without matching lines inside them, and changed lines
+stop being compared word by word once MAX_WORD_WORK is used up. A diff
+that took a shortcut has truncated set. Results are cached by the Backend,
+so each pair of versions is only compared once.
+"""
+
+from collections import namedtuple
+import difflib
+import re
+
+# Changed regions with more lines than this (on either side) are shown as
+# a plain replacement.
+MAX_LINES = 2000
+# Comparing two lines word by word costs up to the product of their numbers
+# of words; a diff stops comparing lines word by word after this much.
+MAX_WORD_WORK = 2000000
+# Equal lines shown around each change.
+CONTEXT_LINES = 3
+# Paired lines with less in common than this are shown as a deletion and an
+# insertion rather than a changed line.
+MIN_WORD_RATIO = 0.4
+
+_WORD = re.compile(r'\w+|\s+|[^\w\s]')
+
+# rows are ('equal', line), ('delete', line), ('insert', line),
+# ('change', [(tag, text), ...]) with tags 'equal', 'delete' and 'insert',
+# and ('skip', number of equal lines not shown)
+Diff = namedtuple('Diff', ['rows', 'added', 'removed', 'truncated'])
+
+
+def words(line):
+    """Splits a line into words, runs of whitespace and punctuation."""
+    return _WORD.findall(line)
+
+
+def diff_words(old_words, new_words):
+    """Returns the [(tag, text), ...] of a changed line, or None.
+
+    Takes the words of the old and new line. None means the lines are too
+    different to be worth showing word by word.
+    """
+    matcher = difflib.SequenceMatcher(None, old_words, new_words,
+                                      autojunk=False)
+    if matcher.ratio() < MIN_WORD_RATIO:
+        return None
+    parts = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            parts.append(('equal', ''.join(old_words[i1:i2])))
+            continue
+        if i2 > i1:
+            parts.append(('delete', ''.join(old_words[i1:i2])))
+        if j2 > j1:
+            parts.append(('insert', ''.join(new_words[j1:j2])))
+    return parts
+
+
+def _opcodes(old_lines, new_lines):
+    """Returns (difflib opcodes, truncated) comparing two lists of lines."""
+    start = 0
+    shortest = min(len(old_lines), len(new_lines))
+    while start < shortest and old_lines[start] == new_lines[start]:
+        start += 1
+    old_end, new_end = len(old_lines), len(new_lines)
+    while (old_end > start and new_end > start and
+           old_lines[old_end - 1] == new_lines[new_end - 1]):
+        old_end -= 1
+        new_end -= 1
+    opcodes = []
+    if start:
+        opcodes.append(('equal', 0, start, 0, start))
+    truncated = False
+    if old_end - start > MAX_LINES or new_end - start > MAX_LINES:
+        opcodes.append(('replace', start, old_end, start, new_end))
+        truncated = True
+    elif old_end > start or new_end > start:
+        # autojunk ignores lines repeated all over long pages (blank lines,
+        # rules), which keeps the matching from going quadratic on them
+        matcher = difflib.SequenceMatcher(None, old_lines[start:old_end],
+                                          new_lines[start:new_end])
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            opcodes.append(
+                (tag, start + i1, start + i2, start + j1, start + j2))
+    if old_end < len(old_lines):
+        opcodes.append(
+            ('equal', old_end, len(old_lines), new_end, len(new_lines)))
+    return opcodes, truncated
+
+
+def diff(old, new, context=CONTEXT_LINES):
+    """Returns the Diff turning text old into text new."""
+    old_lines = old.splitlines()
+    new_lines = new.splitlines()
+    opcodes, truncated = _opcodes(old_lines, new_lines)
+    rows = []
+    added = removed = work = 0
+    for number, (tag, i1, i2, j1, j2) in enumerate(opcodes):
+        if tag == 'equal':
+            # keep context lines next to the changes before and after
+            head = context if number > 0 else 0
+            tail = context if number < len(opcodes) - 1 else 0
+            if i2 - i1 <= head + tail:
+                rows += [('equal', line) for line in old_lines[i1:i2]]
+                continue
+            rows += [('equal', line) for line in old_lines[i1:i1 + head]]
+            rows.append(('skip', i2 - i1 - head - tail))
+            rows += [('equal', line) for line in old_lines[i2 - tail:i2]]
+            continue
+        removed += i2 - i1
+        added += j2 - j1
+        deleted = old_lines[i1:i2]
+        inserted = new_lines[j1:j2]
+        if tag == 'replace' and not truncated:
+            pairs = [(words(a), words(b)) for a, b in zip(deleted, inserted)]
+            work += sum(len(a) * len(b) for a, b in pairs)
+            changes = None
+            if work <= MAX_WORD_WORK:
+                changes = [diff_words(a, b) for a, b in pairs]
+            else:
+                truncated = True
+            if changes and all(change is not None for change in changes):
+                rows += [('change', change) for change in changes]
+                deleted = deleted[len(changes):]
+                inserted = inserted[len(changes):]
+        rows += [('delete', line) for line in deleted]
+        rows += [('insert', line) for line in inserted]
+    return Diff(rows, added, removed, truncated)
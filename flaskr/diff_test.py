@@ -0,0 +1,76 @@
+from flaskr import diff
+import time
+
+
+def test_changed_lines_are_diffed_word_by_word():
+    result = diff.diff("Sega made the Genesis.\nThe end.\n",
+                       "Sega made the Mega Drive.\nThe end.\n")
+
+    assert result.rows == [
+        ("change", [("equal", "Sega made the "), ("delete", "Genesis"),
+                    ("insert", "Mega Drive"), ("equal", ".")]),
+        ("equal", "The end."),
+    ]
+    assert (result.added, result.removed, result.truncated) == (1, 1, False)
+
+
+def test_inserted_and_deleted_lines():
+    result = diff.diff("a\nb\nc", "a\nc\nd")
+
+    assert result.rows == [("equal", "a"), ("delete", "b"), ("equal", "c"),
+                           ("insert", "d")]
+    assert (result.added, result.removed) == (1, 1)
+
+
+def test_unrelated_lines_are_not_diffed_word_by_word():
+    result = diff.diff("Sega made the Genesis", "Completely different")
+
+    assert result.rows == [("delete", "Sega made the Genesis"),
+                           ("insert", "Completely different")]
+
+
+def test_long_runs_of_equal_lines_are_skipped():
+    old = "\n".join(str(i) for i in range(100))
+    new = old.replace("\n50\n", "\nfifty\n")
+
+    rows = diff.diff(old, new, context=2).rows
+
+    assert rows[0] == ("skip", 48)
+    assert rows[1:3] == [("equal", "48"), ("equal", "49")]
+    assert rows[-3:] == [("equal", "51"), ("equal", "52"), ("skip", 47)]
+    assert diff.diff(old, old).rows == [("skip", 100)]
+
+
+def test_large_changes_are_shown_as_a_replacement(monkeypatch):
+    monkeypatch.setattr("flaskr.diff.MAX_LINES", 10)
+    old = "\n".join(["same"] + [f"old {i}" for i in range(20)] + ["end"])
+    new = "\n".join(["same"] + [f"new {i}" for i in range(20)] + ["end"])
+
+    result = diff.diff(old, new)
+
+    assert result.truncated
+    assert [kind for kind, _ in result.rows] == (["equal"] + ["delete"] * 20 +
+                                                 ["insert"] * 20 + ["equal"])
+
+
+def test_word_diffs_stop_when_over_budget(monkeypatch):
+    monkeypatch.setattr("flaskr.diff.MAX_WORD_WORK", 10)
+
+    result = diff.diff("one two three", "one two four")
+
+    assert result.truncated
+    assert result.rows == [("delete", "one two three"),
+                           ("insert", "one two four")]
+
+
+def test_worst_case_diff_is_bounded():
+    # lines repeated just too rarely to be ignored by difflib's autojunk
+    # are the slowest to match
+    old = "\n".join(str(i % 100) for i in range(diff.MAX_LINES))
+    new = "\n".join(str(i * 7 % 100) for i in range(diff.MAX_LINES))
+
+    start = time.perf_counter()
+    result = diff.diff(old, new)
+
+    assert not result.truncated
+    assert time.perf_counter() - start < 2
@@ -0,0 +1,207 @@
+"""Index of the [[wiki links]] between pages.
+
+LinkIndex keeps the link graph of the wiki: the pages each page links to
+(forward) and the pages linking to each page (backward). It answers "what
+links here" and finds links to pages that do not exist, without reading any
+page, in time proportional to the answer.
+
+The index is stored as a single zlib-compressed JSON object,
+'indexes/links.json.z'. Only the forward links are stored: every name is
+numbered once in 'names', the first 'pages' of them being the pages of the
+wiki, and 'links' holds the numbers each page links to. The backward links
+and the broken links are rebuilt from them when the index is read. Like
+SearchIndex, every process keeps the decoded index in memory for max_age
+seconds, saves and uploads update it with a conditional write (skipped when
+the links of the page did not change), and rebuild() recreates it. Pages
+too large to be parsed are recorded without links, so links to them are not
+reported as broken.
+"""
+
+from flaskr.storage import ConflictError
+import json
+import threading
+import time
+import zlib
+
+
+class _Graph:
+    """The decoded index: forward and backward links, and broken targets."""
+
+    def __init__(self):
+        # page -> tuple of the names it links to, in order
+        self.forward = {}
+        # name -> set of the pages linking to it
+        self.backward = {}
+        # names linked to that are not pages
+        self.broken = set()
+
+    @classmethod
+    def decode(cls, data):
+        payload = json.loads(zlib.decompress(data))
+        names = payload['names']
+        graph = cls()
+        for name, numbers in zip(names[:payload['pages']], payload['links']):
+            graph.add(name, [names[n] for n in numbers])
+        return graph
+
+    def encode(self):
+        names = list(self.forward)
+        numbers = {name: i for i, name in enumerate(names)}
+        for name in self.broken:
+            numbers[name] = len(names)
+            names.append(name)
+        payload = {
+            'names': names,
+            'pages': len(self.forward),
+            'links': [[numbers[target]
+                       for target in targets]
+                      for targets in self.forward.values()],
+        }
+        return zlib.compress(
+            json.dumps(payload, separators=(',', ':')).encode())
+
+    def _unlink(self, name):
+        for target in self.forward.pop(name, ()):
+            sources = self.backward[target]
+            sources.discard(name)
+            if not sources:
+                del self.backward[target]
+                self.broken.discard(target)
+
+    def add(self, name, links):
+        """Records the links of a page, returning False if they are known."""
+        links = tuple(dict.fromkeys(links))
+        if self.forward.get(name) == links:
+            return False
+        self._unlink(name)
+        self.forward[name] = links
+        self.broken.discard(name)
+        for target in links:
+            self.backward.setdefault(target, set()).add(name)
+            if target not in self.forward:
+                self.broken.add(target)
+        return True
+
+    def remove(self, name):
+        if name not in self.forward:
+            return False
+        self._unlink(name)
+        if name in self.backward:
+            self.broken.add(name)
+        return True
+
+
+class LinkIndex:
+
+    OBJECT_NAME = 'indexes/links.json.z'
+    # how many times a conditional update is retried on concurrent writes
+    MAX_RETRIES = 5
+
+    def __init__(self, storage, max_age=5, clock=time.monotonic):
+        """Constructs a LinkIndex kept in the given storage engine.
+
+        Args:
+            storage: the Storage engine holding the wiki content
+            max_age: seconds the in-memory copy is used before checking
+                whether the stored index changed
+            clock: function returning the current time in seconds
+        """
+        self.storage = storage
+        self.max_age = max_age
+        self.clock = clock
+        # (generation, _Graph, time it was last checked)
+        self._cached = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Reads the stored index, returning (_Graph, generation)."""
+        data, info = self.storage.get_with_info(self.OBJECT_NAME)
+        if data is None:
+            return _Graph(), 0
+        return _Graph.decode(data), info.generation
+
+    def _current(self):
+        """Returns the in-memory index, refreshed if it may be stale."""
+        with self._lock:
+            cached = self._cached
+            now = self.clock()
+            if cached is not None and now - cached[2] < self.max_age:
+                return cached[1]
+            info = self.storage.stat(self.OBJECT_NAME)
+            generation = 0 if info is None else info.generation
+            if cached is not None and cached[0] == generation:
+                self._cached = (generation, cached[1], now)
+                return cached[1]
+            graph, generation = self._load()
+            self._cached = (generation, graph, now)
+            return graph
+
+    def _update(self, change):
+        """Applies change(_Graph) to the stored index with retries.
+
+        Nothing is written if change returns False.
+        """
+        for _ in range(self.MAX_RETRIES):
+            graph, generation = self._load()
+            if not change(graph):
+                return
+            try:
+                generation = self.storage.put(self.OBJECT_NAME,
+                                              graph.encode(),
+                                              if_generation_match=generation)
+            except ConflictError:
+                # someone else updated the index first, retry on their copy
+                continue
+            with self._lock:
+                self._cached = (generation, graph, self.clock())
+            return
+        raise ConflictError('Unable to update the link index')
+
+    def add(self, name, links):
+        """Records the names of the pages a page links to."""
+        self._update(lambda graph: graph.add(name, links))
+
+    def add_many(self, pages):
+        """Records the links of several (name, links) pages at once."""
+        pages = list(pages)
+        self._update(lambda graph: any([graph.add(name, links)
+                                        for name, links in pages]))
+
+    def remove(self, name):
+        """Drops a page from the index; links to it become broken."""
+        self._update(lambda graph: graph.remove(name))
+
+    def rebuild(self, pages):
+        """Recreates the index from (name, links) pairs.
+
+        Returns the number of pages indexed.
+        """
+        graph = _Graph()
+        for name, links in pages:
+            graph.add(name, links)
+        self.storage.put(self.OBJECT_NAME, graph.encode())
+        with self._lock:
+            self._cached = None
+        return len(graph.forward)
+
+    def links(self, name):
+        """Returns the names a page links to, in order."""
+        return list(self._current().forward.get(name, ()))
+
+    def backlinks(self, name):
+        """Returns the sorted names of the pages linking to a page."""
+        return sorted(self._current().backward.get(name, ()))
+
+    def broken_links(self, name):
+        """Returns the names a page links to that are not pages, in order."""
+        graph = self._current()
+        return [
+            target for target in graph.forward.get(name, ())
+            if target in graph.broken
+        ]
+
+    def broken(self):
+        """Returns sorted (missing name, sorted linking pages) pairs."""
+        graph = self._current()
+        return [(name, sorted(graph.backward[name]))
+                for name in sorted(graph.broken)]
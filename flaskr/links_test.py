@@ -0,0 +1,107 @@
+from flaskr.links import LinkIndex, _Graph
+from flaskr.storage import ConflictError, LocalStorage
+from unittest.mock import MagicMock
+import pytest
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(str(tmp_path))
+
+
+@pytest.fixture
+def index(storage):
+    return LinkIndex(storage, max_age=0)
+
+
+def test_backlinks_and_broken_links(index):
+    index.add("Sega", ["Nintendo", "Sonic", "Nintendo"])
+    index.add("Nintendo", ["Sega", "Mario"])
+
+    assert index.links("Sega") == ["Nintendo", "Sonic"]
+    assert index.backlinks("Nintendo") == ["Sega"]
+    assert index.backlinks("Mario") == ["Nintendo"]
+    assert index.broken_links("Sega") == ["Sonic"]
+    assert index.broken() == [("Mario", ["Nintendo"]), ("Sonic", ["Sega"])]
+
+    index.add("Sonic", [])
+    assert index.broken_links("Sega") == []
+    assert index.backlinks("Sonic") == ["Sega"]
+
+
+def test_add_replaces_and_remove_breaks_links(index):
+    index.add("Sega", ["Nintendo"])
+    index.add("Nintendo", [])
+    index.add("Sega", ["Atari"])
+
+    assert index.backlinks("Nintendo") == []
+    assert index.broken() == [("Atari", ["Sega"])]
+
+    index.add("Atari", ["Sega"])
+    index.remove("Sega")
+    assert index.backlinks("Atari") == []
+    assert index.broken() == [("Sega", ["Atari"])]
+
+
+def test_encoding_round_trip():
+    graph = _Graph()
+    graph.add("Sega", ["Nintendo", "Sega", "Sonic"])
+    graph.add("Nintendo", ["Sonic"])
+
+    decoded = _Graph.decode(graph.encode())
+
+    assert decoded.forward == graph.forward
+    assert decoded.backward == graph.backward
+    assert decoded.broken == {"Sonic"}
+
+
+def test_unchanged_links_are_not_written(storage, index):
+    index.add("Sega", ["Nintendo"])
+    storage.put = MagicMock(wraps=storage.put)
+
+    index.add("Sega", ["Nintendo"])
+
+    storage.put.assert_not_called()
+
+
+def test_index_is_shared_through_storage(storage, index):
+    index.add("Sega", ["Nintendo"])
+    other = LinkIndex(storage, max_age=0)
+
+    assert other.backlinks("Nintendo") == ["Sega"]
+    other.add("Atari", ["Nintendo"])
+    assert index.backlinks("Nintendo") == ["Atari", "Sega"]
+
+
+def test_add_retries_on_conflict(storage, index):
+    index.add("Sega", ["Nintendo"])
+    put = storage.put
+    calls = []
+
+    def put_once_conflicting(name, data, if_generation_match=None):
+        if not calls:
+            calls.append(name)
+            # another worker indexes a page in the meantime
+            LinkIndex(storage).add("Atari", ["Nintendo"])
+        return put(name, data, if_generation_match)
+
+    storage.put = put_once_conflicting
+    index.add("Nintendo", [])
+
+    assert index.backlinks("Nintendo") == ["Atari", "Sega"]
+    assert index.broken() == []
+
+
+def test_add_gives_up_after_retries(storage, index):
+    storage.put = MagicMock(side_effect=ConflictError("conflict"))
+
+    with pytest.raises(ConflictError):
+        index.add("Sega", ["Nintendo"])
+
+
+def test_rebuild(storage, index):
+    index.add("Old", ["Sega"])
+
+    assert index.rebuild([("Sega", ["Nintendo"]), ("Nintendo", [])]) == 2
+    assert index.backlinks("Sega") == []
+    assert index.backlinks("Nintendo") == ["Sega"]
@@ -11,7 +11,6 @@ URI     | Method | Description
 /signup | POST   | Extracts signup info from signup page and calls backend.sign_up
 """
 
-from flaskr.user import User  # default User class that we implemented
 from flask import render_template, request
 from flask_login import login_user, login_required, logout_user
 
@@ -30,14 +29,15 @@ def make_endpoints(app, login_manager, backend):
     def load_user(user_id):
         """Returns a user with the unique identifier.
 
-        For now, we just create an instance of our User class and return that 
-        object. Documentation for this method can be found at 
+        This runs on every request with a session, so the backend hands out
+        a cached instance of our User class instead of building a new one.
+        Documentation for this method can be found at
         https://flask-login.readthedocs.io/en/latest/#how-it-works
 
         Args:
             user_id: unique id of a user
         """
-        return User(user_id)
+        return backend.get_user(user_id)
 
     @app.route('/login')
     def login():
@@ -0,0 +1,396 @@
+"""Wiki markup: a small subset of Markdown plus [[wiki links]].
+
+Blocks, separated by blank lines:
+
+    # Heading (up to ######)     - item / * item     1. item
+    > quote                      ``` (fenced code)   --- (rule)
+    anything else is a paragraph
+
+Inline:
+
+    **bold**  *italic*  `code`  [text](https://example.com)
+    [[Page Name]]  [[Page Name|shown text]]
+
+parse() turns text into a tree of tuples (the AST) and to_html() turns the
+tree into HTML. All text is escaped and only http(s), mailto and relative
+URLs are linked, so pages cannot inject markup or scripts.
+
+Both run in time linear in the size of the page: blocks are read line by
+line, and inline markup remembers where it last found (or failed to find)
+each closing delimiter instead of searching the same text again, so even
+text full of unmatched '*' or '[' is read in a single pass (see
+`python -m benchmarks.markup`).
+
+Renderer caches the parsed Document of each distinct text by its hash, so a
+revision is parsed once however many times it is viewed.
+"""
+
+from html import escape
+from urllib.parse import quote
+import hashlib
+import re
+
+# Where [[wiki links]] point to.
+PAGE_URL_PREFIX = '/pages/'
+# The only schemes [links](...) may use.
+SAFE_SCHEMES = ('http:', 'https:', 'mailto:')
+
+_HEADING = re.compile(r'(#{1,6})\s+(.*)$')
+_BULLET = re.compile(r'[-*]\s+(.*)$')
+_NUMBERED = re.compile(r'\d{1,9}[.)]\s+(.*)$')
+_RULE = re.compile(r'(?:-\s*){3,}$|(?:\*\s*){3,}$')
+_SCHEME = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*:')
+_IGNORED_IN_URL = re.compile(r'[\x00-\x20\x7f]')
+_SPECIAL = re.compile(r'[*`\[]')
+
+
+class _Closers:
+    """Finds closing delimiters without scanning the same text twice.
+
+    Remembers the last search for each delimiter: searching again from
+    anywhere between its start and the delimiter it found (or the end of
+    the text, if there was none) has the same answer.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._last = {}
+        self._run = (0, 0)
+
+    def find(self, delimiter, start):
+        last = self._last.get(delimiter)
+        if last is not None and last[0] <= start <= last[1]:
+            return last[2]
+        index = self.text.find(delimiter, start)
+        self._last[delimiter] = (start, len(self.text) if index < 0 else index,
+                                 index)
+        return index
+
+    def run_end(self, index):
+        """Returns the end of the run of '*' starting at index."""
+        if not self._run[0] <= index < self._run[1]:
+            end = index
+            while end < len(self.text) and self.text[end] == '*':
+                end += 1
+            self._run = (index, end)
+        return self._run[1]
+
+
+def parse_inline(text):
+    """Returns the inline nodes of a line of text.
+
+    Nodes are ('text', str), ('code', str), ('strong', nodes),
+    ('em', nodes), ('link', url, nodes) and ('wikilink', page, label).
+    """
+    return _parse_inline(text, 0, len(text), _Closers(text))
+
+
+def _parse_inline(text, start, end, closers):
+    nodes = []
+    plain = start
+    position = start
+
+    def flush(until):
+        if until > plain:
+            nodes.append(('text', text[plain:until]))
+
+    while True:
+        match = _SPECIAL.search(text, position, end)
+        if match is None:
+            break
+        at = match.start()
+        char = text[at]
+        node = None
+        if char == '`':
+            close = closers.find('`', at + 1)
+            if at + 1 < close < end:
+                node, after = ('code', text[at + 1:close]), close + 1
+        elif text.startswith('**', at):
+            close = closers.find('**', at + 2)
+            if close > 0:
+                # '***' closes the inner '*' first, as in '**a *b***'
+                close = closers.run_end(close) - 2
+            if (at + 2 < close and close + 2 <= end and
+                    not _in_code_span(closers, at, close)):
+                node = ('strong', _parse_inline(text, at + 2, close, closers))
+                after = close + 2
+        elif char == '*':
+            close = closers.find('*', at + 1)
+            if (at + 1 < close < end and
+                    not (close + 1 < end and text[close + 1] == '*') and
+                    not _in_code_span(closers, at, close)):
+                node = ('em', _parse_inline(text, at + 1, close, closers))
+                after = close + 1
+        elif text.startswith('[[', at):
+            close = closers.find(']]', at + 2)
+            if at + 2 < close and close + 2 <= end:
+                page, _, label = text[at + 2:close].partition('|')
+                if page.strip():
+                    node = ('wikilink', page.strip(), label.strip() or
+                            page.strip())
+                    after = close + 2
+        elif char == '[':
+            close = closers.find(']', at + 1)
+            if 0 < close < end and text.startswith('](', close):
+                url_end = closers.find(')', close + 2)
+                if 0 < url_end < end:
+                    node = ('link', text[close + 2:url_end].strip(),
+                            _parse_inline(text, at + 1, close, closers))
+                    after = url_end + 1
+        if node is None:
+            position = at + 1
+            continue
+        flush(at)
+        nodes.append(node)
+        plain = position = after
+    flush(end)
+    return nodes
+
+
+def _in_code_span(closers, start, index):
+    """Returns True if index is inside the first code span after start."""
+    opening = closers.find('`', start + 1)
+    if opening < 0 or opening > index:
+        return False
+    return closers.find('`', opening + 1) > index
+
+
+def parse(text):
+    """Returns the block nodes of a page.
+
+    Nodes are ('heading', level, inline nodes), ('paragraph', inline nodes),
+    ('list', ordered, [inline nodes per item]), ('quote', block nodes),
+    ('code', str) and ('rule',).
+    """
+    return _parse_blocks(text.replace('\r\n', '\n').split('\n'))
+
+
+def _parse_blocks(lines):
+    blocks = []
+    paragraph = []
+    items = []
+    ordered = False
+    quote_lines = []
+    i = 0
+
+    def close_paragraph():
+        if paragraph:
+            blocks.append(('paragraph', parse_inline('\n'.join(paragraph))))
+            paragraph.clear()
+
+    def close_list():
+        if items:
+            blocks.append(('list', ordered, [parse_inline(i) for i in items]))
+            items.clear()
+
+    def close_quote():
+        if quote_lines:
+            blocks.append(('quote', _parse_blocks(quote_lines[:])))
+            quote_lines.clear()
+
+    def close_all():
+        close_paragraph()
+        close_list()
+        close_quote()
+
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+        i += 1
+        if stripped.startswith('>'):
+            close_paragraph()
+            close_list()
+            quote_lines.append(stripped[1:].lstrip() if stripped != '>' else '')
+            continue
+        close_quote()
+        if not stripped:
+            close_all()
+            continue
+        if stripped.startswith('```'):
+            close_all()
+            code = []
+            while i < len(lines) and not lines[i].strip().startswith('```'):
+                code.append(lines[i])
+                i += 1
+            i += 1
+            blocks.append(('code', '\n'.join(code)))
+            continue
+        if _RULE.match(stripped):
+            close_all()
+            blocks.append(('rule',))
+            continue
+        heading = _HEADING.match(stripped)
+        if heading:
+            close_all()
+            blocks.append(('heading', len(heading.group(1)),
+                           parse_inline(_heading_text(heading.group(2)))))
+            continue
+        bullet = _BULLET.match(stripped)
+        numbered = None if bullet else _NUMBERED.match(stripped)
+        if bullet or numbered:
+            close_paragraph()
+            if items and ordered != bool(numbered):
+                close_list()
+            ordered = bool(numbered)
+            items.append((bullet or numbered).group(1))
+            continue
+        if items:
+            # a wrapped list item
+            items[-1] += ' ' + stripped
+            continue
+        paragraph.append(stripped)
+    close_all()
+    return blocks
+
+
+def _heading_text(text):
+    """Drops the optional closing #s of a heading, as in '## Title ##'."""
+    stripped = text.rstrip('#')
+    if stripped != text and (not stripped or stripped[-1].isspace()):
+        return stripped.rstrip()
+    return text
+
+
+def _safe_url(url):
+    """Returns url if it is relative or uses a safe scheme, else None."""
+    # browsers ignore whitespace and control characters in schemes
+    url = _IGNORED_IN_URL.sub('', url)
+    scheme = _SCHEME.match(url)
+    if scheme is None or scheme.group().lower() in SAFE_SCHEMES:
+        return url
+    return None
+
+
+def _inline_html(nodes, out):
+    for node in nodes:
+        kind = node[0]
+        if kind == 'text':
+            out.append(escape(node[1], quote=False))
+        elif kind == 'code':
+            out.append(f'<code>{escape(node[1], quote=False)}</code>')
+        elif kind in ('strong', 'em'):
+            out.append(f'<{kind}>')
+            _inline_html(node[1], out)
+            out.append(f'</{kind}>')
+        elif kind == 'wikilink':
+            href = PAGE_URL_PREFIX + quote(node[1], safe='')
+            out.append(f'<a class="wikilink" href="{escape(href)}">'
+                       f'{escape(node[2], quote=False)}</a>')
+        elif kind == 'link':
+            url = _safe_url(node[1])
+            if url is None:
+                _inline_html(node[2], out)
+                continue
+            out.append(f'<a href="{escape(url)}" rel="nofollow">')
+            _inline_html(node[2], out)
+            out.append('</a>')
+
+
+def _blocks_html(blocks, out):
+    for block in blocks:
+        kind = block[0]
+        if kind == 'heading':
+            out.append(f'<h{block[1]}>')
+            _inline_html(block[2], out)
+            out.append(f'</h{block[1]}>\n')
+        elif kind == 'paragraph':
+            out.append('<p>')
+            _inline_html(block[1], out)
+            out.append('</p>\n')
+        elif kind == 'list':
+            tag = 'ol' if block[1] else 'ul'
+            out.append(f'<{tag}>\n')
+            for item in block[2]:
+                out.append('<li>')
+                _inline_html(item, out)
+                out.append('</li>\n')
+            out.append(f'</{tag}>\n')
+        elif kind == 'quote':
+            out.append('<blockquote>\n')
+            _blocks_html(block[1], out)
+            out.append('</blockquote>\n')
+        elif kind == 'code':
+            out.append(f'<pre><code>{escape(block[1], quote=False)}'
+                       '</code></pre>\n')
+        elif kind == 'rule':
+            out.append('<hr>\n')
+
+
+def to_html(blocks):
+    """Returns the HTML of parsed blocks."""
+    out = []
+    _blocks_html(blocks, out)
+    return ''.join(out)
+
+
+def _walk_inline(nodes):
+    for node in nodes:
+        yield node
+        if node[0] in ('strong', 'em'):
+            yield from _walk_inline(node[1])
+        elif node[0] == 'link':
+            yield from _walk_inline(node[2])
+
+
+def _walk_blocks(blocks):
+    for block in blocks:
+        if block[0] == 'heading':
+            yield from _walk_inline(block[2])
+        elif block[0] == 'paragraph':
+            yield from _walk_inline(block[1])
+        elif block[0] == 'list':
+            for item in block[2]:
+                yield from _walk_inline(item)
+        elif block[0] == 'quote':
+            yield from _walk_blocks(block[1])
+
+
+class Document:
+    """A parsed page: its AST and, once asked for, its HTML."""
+
+    __slots__ = ('blocks', '_html')
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self._html = None
+
+    @property
+    def html(self):
+        if self._html is None:
+            self._html = to_html(self.blocks)
+        return self._html
+
+    def wiki_links(self):
+        """Returns the names of the pages linked with [[...]], in order."""
+        return list(
+            dict.fromkeys(node[1]
+                          for node in _walk_blocks(self.blocks)
+                          if node[0] == 'wikilink'))
+
+
+def content_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+class Renderer:
+
+    def __init__(self, cache):
+        """Constructs a Renderer.
+
+        Args:
+            cache: LRUCache mapping content hashes to Documents
+        """
+        self.cache = cache
+
+    def parse(self, text):
+        """Returns the Document of text, parsing it only if not cached."""
+        key = content_hash(text)
+        document = self.cache.get(key)
+        if document is None:
+            document = Document(parse(text))
+            self.cache.set(key, document)
+        return document
+
+    def render(self, text):
+        """Returns the HTML of text."""
+        return self.parse(text).html
@@ -0,0 +1,100 @@
+from flaskr import markup
+from flaskr.cache import LRUCache
+from unittest.mock import patch
+import time
+
+
+def html(text):
+    return markup.to_html(markup.parse(text))
+
+
+def test_blocks():
+    assert html("# Title\n\nSome *text*\nwrapped\n\n- a\n- b\n\n1. c\n---") == (
+        "<h1>Title</h1>\n"
+        "<p>Some <em>text</em>\nwrapped</p>\n"
+        "<ul>\n<li>a</li>\n<li>b</li>\n</ul>\n"
+        "<ol>\n<li>c</li>\n</ol>\n"
+        "<hr>\n")
+
+
+def test_heading_closing_hashes():
+    assert html("## C# ##") == "<h2>C#</h2>\n"
+
+
+def test_code_and_quotes():
+    assert html("> **quoted**\n\n```\n*not* <b>\n```") == (
+        "<blockquote>\n<p><strong>quoted</strong></p>\n</blockquote>\n"
+        "<pre><code>*not* &lt;b&gt;</code></pre>\n")
+
+
+def test_inline():
+    assert html("**bold *both***, `a*b*c` and *open") == (
+        "<p><strong>bold <em>both</em></strong>, <code>a*b*c</code> and "
+        "*open</p>\n")
+
+
+def test_links():
+    assert html("[[Sega Genesis]] [[Sonic|the hedgehog]] [site](https://"
+                "sega.com)") == (
+                    '<p><a class="wikilink" href="/pages/Sega%20Genesis">'
+                    'Sega Genesis</a> <a class="wikilink" href="/pages/Sonic">'
+                    'the hedgehog</a> <a href="https://sega.com" '
+                    'rel="nofollow">site</a></p>\n')
+
+
+def test_unsafe_markup_is_escaped():
+    assert html('<script>alert("x")</script>') == (
+        '<p>&lt;script&gt;alert("x")&lt;/script&gt;</p>\n')
+    assert html("[x](javascript:alert)") == "<p>x</p>\n"
+    assert html("[x](java\tscript:alert)") == "<p>x</p>\n"
+    assert html('[x](/a"onclick="b)') == (
+        '<p><a href="/a&quot;onclick=&quot;b" rel="nofollow">x</a></p>\n')
+
+
+def test_wiki_links():
+    document = markup.Document(
+        markup.parse("[[A]] and **[[B]]**\n\n- [[A]]\n\n> [[C|see C]]"))
+
+    assert document.wiki_links() == ["A", "B", "C"]
+
+
+def test_renderer_parses_each_content_once():
+    renderer = markup.Renderer(LRUCache(16))
+
+    with patch("flaskr.markup.parse", wraps=markup.parse) as mock_parse:
+        first = renderer.render("# Sega")
+        second = renderer.render("# Sega")
+        renderer.render("# Nintendo")
+
+    assert first == second == "<h1>Sega</h1>\n"
+    assert mock_parse.call_count == 2
+
+
+def test_pathological_input_is_linear():
+    # each of these used to be the worst case of a naive parser
+    for unit in ["*", "[", "`", "**a", "[a](", "[[", "* "]:
+        small = unit * 2000
+        large = unit * 20000
+        start = time.perf_counter()
+        markup.parse(small)
+        small_time = time.perf_counter() - start
+        start = time.perf_counter()
+        markup.parse(large)
+        large_time = time.perf_counter() - start
+        # 10x the input, allowing plenty of noise but not 100x
+        assert large_time < max(small_time, 0.001) * 40, unit
+
+
+def test_wiki_links_is_linear():
+    small = markup.Document(
+        markup.parse(" ".join(f"[[P{i}]]" for i in range(2000))))
+    large = markup.Document(
+        markup.parse(" ".join(f"[[P{i}]]" for i in range(20000))))
+
+    start = time.perf_counter()
+    assert len(small.wiki_links()) == 2000
+    small_time = time.perf_counter() - start
+    start = time.perf_counter()
+    assert len(large.wiki_links()) == 20000
+    large_time = time.perf_counter() - start
+    assert large_time < max(small_time, 0.001) * 40
@@ -0,0 +1,366 @@
+"""Request, backend, storage and cache metrics in the Prometheus text format.
+
+A Registry holds counters and histograms, and make_endpoints() exposes them
+(to scrapers sending the configured bearer token, if there is one):
+
+URI       | Method | Description
+----------|--------|-------------
+/metrics  | GET    | Returns every metric in the Prometheus text format
+
+The metrics, all prefixed with 'wiki_':
+
+- http_requests_total{endpoint,method,status} and
+  http_request_duration_seconds{endpoint}: every request served
+- backend_calls_total{method} and backend_call_duration_seconds{method}:
+  every public Backend method, including the calls they make to each other
+- storage_requests_total{bucket,operation} and
+  storage_request_duration_seconds{bucket,operation}: every storage round
+  trip, i.e. the time spent waiting on the buckets
+- template_render_duration_seconds{template}: the time spent rendering
+  templates, apart from storage
+- cache_hits_total, cache_misses_total, cache_evictions_total and
+  cache_entries{cache}: read from the Backend's caches when scraped
+
+Counters count every call. Durations are only observed for a sample_rate
+fraction of the calls, so instrumentation can be kept on busy workers at a
+negligible cost; the _count of a histogram is then the number of sampled
+calls, not the total.
+"""
+
+from flask import Response, g, request
+import bisect
+import functools
+import hmac
+import inspect
+import random
+import threading
+import time
+
+PREFIX = 'wiki_'
+# Upper bounds (seconds) of the histogram buckets, from cache hits to slow
+# uploads.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+STORAGE_OPERATIONS = ('get', 'get_with_info', 'get_range', 'stat', 'open',
+                      'put', 'compose', 'copy', 'list', 'exists', 'delete')
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    TYPE = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def expose(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.TYPE}'
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)}'
+                         f' {_format_number(value)}')
+        return lines
+
+
+class Gauge(Counter):
+
+    TYPE = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., count above the last bucket, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *labels):
+        counts = self._values.get(labels)
+        return 0 if counts is None else sum(counts[:-1])
+
+    def expose(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} histogram'
+        ]
+        with self._lock:
+            values = sorted((labels, list(counts))
+                            for labels, counts in self._values.items())
+        names = self.labelnames + ('le',)
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket'
+                    f'{_format_labels(names, labels + (_format_number(bound),))}'
+                    f' {cumulative}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} '
+                         f'{_format_number(counts[-1])}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class Registry:
+
+    def __init__(self, sample_rate=1.0, random=random.random):
+        """Constructs an empty registry.
+
+        Args:
+            sample_rate: fraction of the calls whose duration is observed
+            random: function returning a float in [0, 1), used for sampling
+        """
+        self.sample_rate = sample_rate
+        self.random = random
+        self._metrics = []
+        self._collectors = []
+
+    def _register(self, metric_class, name, documentation, labelnames):
+        for metric in self._metrics:
+            if metric.name == PREFIX + name:
+                return metric
+        metric = metric_class(PREFIX + name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """Returns the counter called name, creating it if needed."""
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=()):
+        """Returns the histogram called name, creating it if needed."""
+        return self._register(Histogram, name, documentation, labelnames)
+
+    def collector(self, collect):
+        """Registers collect(), returning metrics read when scraped."""
+        self._collectors.append(collect)
+
+    def sampled(self):
+        """Returns True if the duration of the current call is observed."""
+        return self.sample_rate >= 1 or self.random() < self.sample_rate
+
+    def expose(self):
+        """Returns every metric in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics:
+            lines += metric.expose()
+        for collect in self._collectors:
+            for metric in collect():
+                lines += metric.expose()
+        return '\n'.join(lines) + '\n'
+
+
+def _timed(registry, method, calls, durations, labels):
+    """Wraps method to count its calls and observe sampled durations.
+
+    Generators are timed until they are exhausted.
+    """
+
+    def observe_generator(generator, start):
+        try:
+            yield from generator
+        finally:
+            durations.observe(time.perf_counter() - start, *labels)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        calls.inc(*labels)
+        if not registry.sampled():
+            return method(*args, **kwargs)
+        start = time.perf_counter()
+        result = method(*args, **kwargs)
+        if inspect.isgenerator(result):
+            return observe_generator(result, start)
+        durations.observe(time.perf_counter() - start, *labels)
+        return result
+
+    return wrapper
+
+
+def _class_method(obj, name):
+    """Returns a function calling the method name of obj's class.
+
+    The method is looked up on every call, so it can still be patched.
+    """
+
+    def call(*args, **kwargs):
+        method = getattr(type(obj), name)
+        if hasattr(method, '__get__'):
+            method = method.__get__(obj, type(obj))
+        return method(*args, **kwargs)
+
+    return functools.update_wrapper(call, getattr(type(obj), name))
+
+
+def instrument_storage(storage, registry, bucket):
+    """Times every operation of a storage engine, in place."""
+    calls = registry.counter('storage_requests_total',
+                             'Storage round trips.', ('bucket', 'operation'))
+    durations = registry.histogram('storage_request_duration_seconds',
+                                   'Time spent waiting on storage.',
+                                   ('bucket', 'operation'))
+    for operation in STORAGE_OPERATIONS:
+        setattr(
+            storage, operation,
+            _timed(registry, _class_method(storage, operation), calls,
+                   durations, (bucket, operation)))
+    return storage
+
+
+def instrument_backend(backend, registry):
+    """Times every public method of a Backend, in place."""
+    calls = registry.counter('backend_calls_total', 'Backend method calls.',
+                             ('method',))
+    durations = registry.histogram('backend_call_duration_seconds',
+                                   'Time spent in Backend methods.',
+                                   ('method',))
+    for name, value in vars(type(backend)).items():
+        if name.startswith('_') or not callable(value):
+            continue
+        setattr(
+            backend, name,
+            _timed(registry, _class_method(backend, name), calls, durations,
+                   (name,)))
+    return backend
+
+
+def _cache_collector(backend, registry):
+    caches = {
+        'page': backend.page_cache,
+        'rendered': backend.rendered_cache,
+        'user': backend.user_cache,
+        'unknown_user': backend.unknown_user_cache,
+        'image_variant': backend.variant_cache,
+        'markup': backend.renderer.cache,
+        'diff': backend.diff_cache,
+    }
+
+    def collect():
+        hits = Counter(PREFIX + 'cache_hits_total', 'Cache hits.', ('cache',))
+        misses = Counter(PREFIX + 'cache_misses_total', 'Cache misses.',
+                         ('cache',))
+        evictions = Counter(PREFIX + 'cache_evictions_total',
+                            'Entries evicted to make room.', ('cache',))
+        entries = Gauge(PREFIX + 'cache_entries', 'Entries cached.',
+                        ('cache',))
+        for name, cache in caches.items():
+            stats = cache.stats()
+            hits.inc(name, amount=stats['hits'])
+            misses.inc(name, amount=stats['misses'])
+            evictions.inc(name, amount=stats['evictions'])
+            entries.set(stats['size'], name)
+        return [hits, misses, evictions, entries]
+
+    registry.collector(collect)
+
+
+def _timed_template_class(base, registry):
+    durations = registry.histogram('template_render_duration_seconds',
+                                   'Time spent rendering templates.',
+                                   ('template',))
+
+    class TimedTemplate(base):
+
+        def render(self, *args, **kwargs):
+            if not registry.sampled():
+                return super().render(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return super().render(*args, **kwargs)
+            finally:
+                durations.observe(time.perf_counter() - start, self.name)
+
+    return TimedTemplate
+
+
+def make_endpoints(app, backend, registry, token=None):
+    """Times every request and template, and serves /metrics.
+
+    Args:
+        app: an instance of the Flask app
+        backend: the Backend whose caches are reported
+        registry: the Registry holding the metrics
+        token: if given, /metrics requires an 'Authorization: Bearer
+            <token>' header
+    """
+    requests = registry.counter('http_requests_total', 'Requests served.',
+                                ('endpoint', 'method', 'status'))
+    durations = registry.histogram('http_request_duration_seconds',
+                                   'Time spent serving requests.',
+                                   ('endpoint',))
+    _cache_collector(backend, registry)
+    app.jinja_env.template_class = _timed_template_class(
+        app.jinja_env.template_class, registry)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter() if registry.sampled() else None
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.endpoint or 'unmatched'
+        requests.inc(endpoint, request.method, str(response.status_code))
+        start = g.get('metrics_start')
+        if start is not None:
+            durations.observe(time.perf_counter() - start, endpoint)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if token is not None and not hmac.compare_digest(
+                request.headers.get('Authorization', '').encode(),
+                f'Bearer {token}'.encode()):
+            return 'Unauthorized', 401
+        return Response(registry.expose(), content_type=CONTENT_TYPE)
@@ -0,0 +1,139 @@
+from flaskr import create_app, metrics
+from flaskr.storage import LocalStorage
+from unittest.mock import patch
+import pytest
+
+
+@pytest.fixture
+def app(tmp_path):
+    return create_app({
+        'TESTING': True,
+        'STORAGE_ENGINE': 'local',
+        'STORAGE_ROOT': str(tmp_path),
+        'METRICS_ENABLED': True,
+    })
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def test_counter_and_histogram_exposition():
+    registry = metrics.Registry()
+    counter = registry.counter('hits_total', 'Hits.', ('path',))
+    histogram = registry.histogram('latency_seconds', 'Latency.', ('path',))
+
+    counter.inc('/a "b"')
+    counter.inc('/a "b"', amount=2)
+    histogram.observe(0.003, '/')
+    histogram.observe(20, '/')
+
+    text = registry.expose()
+    assert '# TYPE wiki_hits_total counter' in text
+    assert 'wiki_hits_total{path="/a \\"b\\""} 3' in text
+    assert '# TYPE wiki_latency_seconds histogram' in text
+    assert 'wiki_latency_seconds_bucket{path="/",le="0.0025"} 0' in text
+    assert 'wiki_latency_seconds_bucket{path="/",le="0.005"} 1' in text
+    assert 'wiki_latency_seconds_bucket{path="/",le="10"} 1' in text
+    assert 'wiki_latency_seconds_bucket{path="/",le="+Inf"} 2' in text
+    assert 'wiki_latency_seconds_sum{path="/"} 20.003' in text
+    assert 'wiki_latency_seconds_count{path="/"} 2' in text
+
+
+def test_metrics_are_registered_once():
+    registry = metrics.Registry()
+
+    assert registry.counter('a_total', 'A.') is registry.counter(
+        'a_total', 'A.')
+
+
+def test_storage_calls_are_counted_and_sampled(tmp_path):
+    rolls = iter([0.9, 0.1])
+    registry = metrics.Registry(sample_rate=0.5, random=lambda: next(rolls))
+    storage = metrics.instrument_storage(LocalStorage(str(tmp_path)),
+                                         registry, 'content')
+
+    storage.put('Sega', 'Genesis')
+    assert storage.get('Sega') == b'Genesis'
+
+    calls = registry.counter('storage_requests_total', '')
+    durations = registry.histogram('storage_request_duration_seconds', '')
+    assert calls.value('content', 'put') == 1
+    assert calls.value('content', 'get') == 1
+    # only the second call was sampled
+    assert durations.count('content', 'put') == 0
+    assert durations.count('content', 'get') == 1
+
+
+def test_generators_are_timed_until_exhausted(tmp_path):
+    registry = metrics.Registry()
+    storage = metrics.instrument_storage(LocalStorage(str(tmp_path)),
+                                         registry, 'content')
+    storage.put('Sega', 'Genesis')
+    durations = registry.histogram('storage_request_duration_seconds', '')
+
+    names = storage.list()
+    assert durations.count('content', 'list') == 0
+    assert list(names) == ['Sega']
+    assert durations.count('content', 'list') == 1
+
+
+def test_metrics_endpoint(client):
+    client.get('/')
+    client.get('/pages/Missing')
+
+    resp = client.get('/metrics')
+
+    assert resp.status_code == 200
+    assert resp.content_type.startswith('text/plain; version=0.0.4')
+    text = resp.get_data(as_text=True)
+    assert ('wiki_http_requests_total{endpoint="home",method="GET",'
+            'status="200"} 1') in text
+    assert 'wiki_http_request_duration_seconds_count{endpoint="home"} 1' in text
+    assert 'wiki_backend_calls_total{method="get_wiki_page_info"} 1' in text
+    assert ('wiki_storage_requests_total{bucket="content",'
+            'operation="get_with_info"}') in text
+    assert ('wiki_template_render_duration_seconds_count{template="main.html"}'
+            in text)
+    assert 'wiki_cache_misses_total{cache="page"} 1' in text
+    assert '# TYPE wiki_cache_entries gauge' in text
+
+
+def test_instrumented_backend_methods_can_be_patched(app, client):
+    with patch('flaskr.backend.Backend.get_wiki_page_info',
+               return_value=('Genesis', 1)):
+        resp = client.get('/pages/Sega')
+
+    assert b'Genesis' in resp.data
+
+
+def test_metrics_disabled_by_default(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'STORAGE_ENGINE': 'local',
+        'STORAGE_ROOT': str(tmp_path),
+    })
+
+    assert app.test_client().get('/metrics').status_code == 404
+
+
+def test_metrics_token(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'STORAGE_ENGINE': 'local',
+        'STORAGE_ROOT': str(tmp_path),
+        'METRICS_ENABLED': True,
+        'METRICS_TOKEN': 's3cret',
+    })
+    client = app.test_client()
+
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics',
+                      headers={
+                          'Authorization': 'Bearer wrong'
+                      }).status_code == 401
+    assert client.get('/metrics',
+                      headers={
+                          'Authorization': 'Bearer s3cret'
+                      }).status_code == 200
@@ -0,0 +1,87 @@
+"""Persisted index of the page names in the wiki.
+
+Listing pages used to walk the whole content bucket, including every history
+revision and image. Instead we keep a sorted JSON list of page names in a
+single manifest object that is updated whenever a page is added, so listing
+the pages costs one read no matter how many revisions exist.
+"""
+
+from flaskr.storage import ConflictError
+import bisect
+import json
+
+# Objects under these prefixes or with these extensions are not pages.
+IGNORED_PREFIXES = ('history/', 'authorImages/', 'indexes/', 'uploads/',
+                    'variants/')
+IGNORED_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# Objects under these prefixes are written by the wiki itself; uploads may
+# not use them.
+RESERVED_PREFIXES = ('history/', 'indexes/', 'uploads/', 'variants/')
+
+
+def is_page_name(name):
+    """Returns True if the object name refers to a wiki page."""
+    return not name.startswith(IGNORED_PREFIXES) and not name.endswith(
+        IGNORED_EXTENSIONS)
+
+
+class PageIndex:
+
+    MANIFEST_NAME = 'indexes/pages.json'
+    # how many times a conditional update is retried on concurrent writes
+    MAX_RETRIES = 5
+
+    def __init__(self, storage):
+        """Constructs a PageIndex kept in the given storage engine."""
+        self.storage = storage
+
+    def _load(self):
+        """Returns (sorted page names, generation) or (None, 0) if missing."""
+        data, info = self.storage.get_with_info(self.MANIFEST_NAME)
+        if data is None:
+            return None, 0
+        return json.loads(data), info.generation
+
+    def _store(self, names, generation):
+        self.storage.put(self.MANIFEST_NAME,
+                         json.dumps(names),
+                         if_generation_match=generation)
+
+    def names(self):
+        """Returns the sorted page names, rebuilding the index if missing."""
+        names, _ = self._load()
+        if names is None:
+            names = self.rebuild()
+        return names
+
+    def add(self, name):
+        """Adds a page name to the index if it is not already there."""
+        if not is_page_name(name):
+            return
+        for _ in range(self.MAX_RETRIES):
+            names, generation = self._load()
+            if names is None:
+                self.rebuild()
+                return
+            position = bisect.bisect_left(names, name)
+            if position < len(names) and names[position] == name:
+                return
+            names.insert(position, name)
+            try:
+                self._store(names, generation)
+                return
+            except ConflictError:
+                # someone else updated the index first, retry on their copy
+                continue
+        raise ConflictError(f'Unable to add {name} to the page index')
+
+    def rebuild(self):
+        """Recreates the index from a full listing of the storage.
+
+        This walks every object, so it should only be needed for recovery or
+        the first time the index is used.
+        """
+        names = sorted(
+            name for name in self.storage.list() if is_page_name(name))
+        self.storage.put(self.MANIFEST_NAME, json.dumps(names))
+        return names
@@ -0,0 +1,81 @@
+from flaskr.page_index import PageIndex, is_page_name
+from flaskr.storage import ConflictError, LocalStorage
+from unittest.mock import patch
+import pytest
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(str(tmp_path))
+
+
+@pytest.fixture
+def index(storage):
+    return PageIndex(storage)
+
+
+def test_is_page_name():
+    assert is_page_name("Sega")
+    assert not is_page_name("history/Sega-20230101000000-user.txt")
+    assert not is_page_name("authorImages/cami.jpg")
+    assert not is_page_name("indexes/pages.json")
+    assert not is_page_name("logo.png")
+
+
+def test_names_rebuilds_missing_index(storage, index):
+    storage.put("Wii", b"")
+    storage.put("Atari", b"")
+    storage.put("history/Atari-20230101000000-user.txt", b"")
+
+    assert index.names() == ["Atari", "Wii"]
+    assert storage.exists(PageIndex.MANIFEST_NAME)
+
+
+def test_add_keeps_names_sorted(storage, index):
+    index.rebuild()
+
+    index.add("Xbox")
+    index.add("Atari")
+    index.add("Atari")
+    index.add("cover.png")
+
+    assert index.names() == ["Atari", "Xbox"]
+
+
+def test_names_does_not_list_storage(storage, index):
+    index.rebuild()
+    index.add("Sega")
+
+    with patch.object(storage, "list") as mock_list:
+        assert index.names() == ["Sega"]
+    mock_list.assert_not_called()
+
+
+def test_add_retries_on_conflict(storage, index):
+    index.rebuild()
+    original_store = index._store
+    calls = []
+
+    def store_once_concurrently(names, generation):
+        if not calls:
+            calls.append(names)
+            # another writer adds a page between our read and our write
+            original_store(["Atari"], generation)
+        original_store(names, generation)
+
+    with patch.object(index, "_store", side_effect=store_once_concurrently):
+        index.add("Sega")
+
+    assert index.names() == ["Atari", "Sega"]
+
+
+def test_conditional_put_conflict(storage):
+    storage.put("page", b"data")
+    generation = storage.stat("page").generation
+    storage.put("page", b"other data")
+
+    with pytest.raises(ConflictError):
+        storage.put("page", b"lost update", if_generation_match=generation)
+    with pytest.raises(ConflictError):
+        storage.put("page", b"data", if_generation_match=0)
+    storage.put("new page", b"data", if_generation_match=0)
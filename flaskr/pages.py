@@ -2,17 +2,60 @@
  
 The following endpoints will be handled:
 
-URI             | Method | Description
-----------------|--------|-------------
-/               | GET    | Returns the home page
-/about          | GET    | Returns an about page
-/images/<image> | GET    | Returns the image from backend.get_image
-/pages          | GET    | Returns all of the pages in a list via backend.get_all_page_names
-/pages/<page>   | GET    | Returns the page from backend.get_wiki_page
+URI                        | Method | Description
+---------------------------|--------|-------------
+/                          | GET    | Returns the home page
+/about                     | GET    | Returns an about page
+/images/<image>            | GET    | Streams the image via backend.stream_image
+                           |        | (or redirects to a signed URL via
+                           |        | backend.get_image_url), scaled down to
+                           |        | ?w= pixels wide if given
+/pages                     | GET    | Returns the pages in a list via
+                           |        | backend.get_page_names
+/pages/<page>              | GET    | Returns the page from
+                           |        | backend.get_wiki_page_info, rendered
+                           |        | from wiki markup by backend.render_page
+/pages/<page>/history      | GET    | Lists the revisions of the page via
+                           |        | backend.get_all_previous_versions,
+                           |        | without reading their content
+/pages/<page>/revision     | GET    | Returns revision ?id= of the page via
+                           |        | backend.get_revision
+/pages/<page>/diff         | GET    | Returns the changes from revision ?from=
+                           |        | to revision ?to= (or the current page)
+                           |        | via backend.get_diff
+/pages/<page>/revert       | POST   | Makes revision ?revision= (a form field)
+                           |        | the current version again via
+                           |        | backend.revert_to_revision
+/pages/<page>/backlinks    | GET    | Returns the pages linking to the page via
+                           |        | backend.get_backlinks
+/pages/<page>/broken_links | GET    | Returns the missing pages the page links
+                           |        | to via backend.get_broken_links
+/broken_links              | GET    | Returns every missing page that is linked
+                           |        | to via backend.get_all_broken_links
+/search                    | GET    | Returns the pages matching ?q= via
+                           |        | backend.search
+
+Page responses carry an ETag made from the page generation (and the logged
+in user, whose name is part of the HTML), so a conditional request for an
+unchanged page is answered with a 304 after a metadata lookup.
+Anonymous responses may be cached by browsers and proxies for PAGE_MAX_AGE
+seconds, logged in users always revalidate.
 """
 
-from flask import render_template, send_file, request, redirect, url_for
+from flask import render_template, request, redirect, url_for
+from flask import Response, stream_with_context
+from markupsafe import Markup
 from flask_login import  login_required, current_user
+from flaskr.revisions import StaleBaseError
+from flaskr.storage import ConflictError
+from flaskr import thumbnails
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import is_resource_modified
+import hashlib
+import mimetypes
+
+# Content types stored for objects uploaded without a specific type.
+GENERIC_CONTENT_TYPES = ('application/octet-stream', 'text/plain')
 
 
 # Note: pages.py relies on the backend to fulfill some routes so we need to
@@ -27,10 +70,70 @@ def make_endpoints(app, backend):
 
     @app.route('/pages')
     def pages():
-        # Display a list of all the pages
-        list_of_pages = backend.get_all_page_names()
-        return render_template('pages.html', pages=list_of_pages)
+        """Returns one page of the sorted list of wiki pages.
+
+        Query parameters:
+            prefix: only list pages whose name starts with it
+            after: cursor from the previous page's "Next" link
+            limit: number of pages to list, capped at PAGES_MAX_PER_PAGE
+        """
+        prefix = request.args.get('prefix', '')
+        after = request.args.get('after')
+        limit = request.args.get('limit',
+                                 app.config['PAGES_PER_PAGE'],
+                                 type=int)
+        limit = max(1, min(limit, app.config['PAGES_MAX_PER_PAGE']))
+        list_of_pages, next_cursor = backend.get_page_names(prefix, after, limit)
+        context = dict(pages=list_of_pages,
+                       prefix=prefix,
+                       limit=limit,
+                       next_cursor=next_cursor)
+        if not app.config['PAGES_STREAM']:
+            return render_template('pages.html', **context)
+        # stream the rendered template so the first bytes go out before the
+        # whole list has been rendered
+        app.update_template_context(context)
+        template = app.jinja_env.get_template('pages.html')
+        return Response(stream_with_context(template.generate(context)))
     
+    @app.route('/search')
+    def search():
+        """Returns the pages best matching a query, ranked with BM25.
+
+        Query parameters:
+            q: the words to look for
+            limit: number of results, capped at SEARCH_MAX_RESULTS
+        """
+        query = request.args.get('q', '').strip()
+        limit = request.args.get('limit',
+                                 app.config['SEARCH_RESULTS'],
+                                 type=int)
+        limit = max(1, min(limit, app.config['SEARCH_MAX_RESULTS']))
+        results = backend.search(query, limit) if query else []
+        return render_template('search.html', query=query, results=results)
+
+    @app.route('/pages/<page_name>/backlinks')
+    def backlinks(page_name):
+        """Returns the pages linking to a page, from the link index."""
+        return render_template('links.html',
+                               heading=f'Pages linking to {page_name}',
+                               page_name=page_name,
+                               pages=backend.get_backlinks(page_name))
+
+    @app.route('/pages/<page_name>/broken_links')
+    def broken_links(page_name):
+        """Returns the pages a page links to that do not exist."""
+        return render_template('links.html',
+                               heading=f'Missing pages linked from {page_name}',
+                               page_name=page_name,
+                               pages=backend.get_broken_links(page_name))
+
+    @app.route('/broken_links')
+    def all_broken_links():
+        """Returns every missing page that is linked to, and from where."""
+        return render_template('broken_links.html',
+                               broken=backend.get_all_broken_links())
+
     @app.route('/save_changes', methods=['POST'])
     def save_changes():
         page_name = request.form['page_name']
@@ -41,39 +144,190 @@ def make_endpoints(app, backend):
         if not page_name.strip():
             return "Error: Page name cannot be empty", 400
         username = current_user.username
-        backend.save_wiki_page(page_name, content, username)
-        # Save content using the backend object
+        # the generation the editor was opened on, so we notice edits made
+        # by someone else in the meantime
+        generation = request.form.get('generation', type=int)
+        try:
+            # Save content using the backend object
+            backend.save_wiki_page(page_name, content, username, generation)
+        except ConflictError:
+            return render_template(
+                'main.html',
+                page_name='Edit Conflict',
+                page_content=f'{page_name} was changed by someone else '
+                'since you opened it. Reload the page and edit it again.'
+            ), 409
         # Redirect to the updated page after saving
         return redirect(url_for('show_page', page_name=page_name))
 
     @app.route('/pages/<page_name>/previous_version')
     @login_required
     def show_previous_version(page_name):
-        content, timestamp, username = backend.get_previous_version(page_name)
+        try:
+            content, timestamp, username = backend.get_previous_version(
+                page_name)
+        except StaleBaseError:
+            # a ValueError too, so it must be caught first
+            return "The page is being changed, try again", 409
+        except ValueError:
+            # the page itself is gone
+            return "No previous version found", 404
         if content is None:
             return "No previous version found", 404
 
-        return render_template('showing_previous_version.html', title=page_name, content=content, timestamp=timestamp, username=username, page=page_name)
+        return render_template('showing_previous_version.html', title=page_name, content=Markup(backend.render_page(content)), timestamp=timestamp, username=username, page=page_name)
+
 
 
+    @app.route('/pages/<page_name>/history')
+    @login_required
+    def page_history(page_name):
+        """Lists the revisions of a page, newest first.
+
+        Only the page's revision manifest is read; the content of a revision
+        is loaded when it is viewed or diffed.
+
+        Query parameters:
+            offset: number of newer revisions to skip
+        """
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = app.config['HISTORY_PER_PAGE']
+        # one more revision on each side: the newer one the first listed
+        # revision is diffed against, and one telling if there is a next page
+        start = max(0, offset - 1)
+        versions = backend.get_all_previous_versions(page_name, start,
+                                                     limit + 1 + offset - start)
+        newer = versions.pop(0)[0] if offset and versions else None
+        rows = []
+        for version in versions[:limit]:
+            rows.append((version, newer))
+            newer = version[0]
+        return render_template('previous_version.html',
+                               page_name=page_name,
+                               rows=rows,
+                               offset=offset,
+                               next_offset=(offset + limit
+                                            if len(versions) > limit else None))
+
+    @app.route('/pages/<page_name>/revision')
+    @login_required
+    def show_revision(page_name):
+        """Returns one revision of a page, named by the ?id= parameter."""
+        revision = request.args.get('id')
+        if not revision:
+            return "Missing revision id", 400
+        try:
+            content, timestamp, username = backend.get_revision(page_name,
+                                                                revision)
+        except StaleBaseError:
+            return "The page is being changed, try again", 409
+        except ValueError:
+            return "No such revision", 404
+        return render_template('showing_previous_version.html',
+                               title=page_name,
+                               content=Markup(backend.render_page(content)),
+                               timestamp=timestamp,
+                               username=username,
+                               page=page_name)
+
+    @app.route('/pages/<page_name>/diff')
+    @login_required
+    def page_diff(page_name):
+        """Returns the changes between two versions of a page.
+
+        Query parameters:
+            from: id of the older revision
+            to: id of the newer revision, or none for the current page
+        """
+        old = request.args.get('from')
+        new = request.args.get('to') or None
+        if not old:
+            return "Missing revision to diff from", 400
+        try:
+            changes = backend.get_diff(page_name, old, new)
+        except StaleBaseError:
+            return "The page is being changed, try again", 409
+        except ValueError:
+            return "No such revision", 404
+        return render_template('diff.html',
+                               page_name=page_name,
+                               old=old,
+                               new=new,
+                               diff=changes)
+
+    @app.route('/pages/<page_name>/revert', methods=['POST'])
+    @login_required
+    def revert_page(page_name):
+        """Makes a previous version of a page its current version again."""
+        revision = request.form.get('revision')
+        if not revision:
+            return "Missing revision id", 400
+        try:
+            backend.revert_to_revision(page_name, revision,
+                                       current_user.username)
+        except ConflictError:
+            # a ValueError too, so it must be caught first
+            return render_template(
+                'main.html',
+                page_name='Edit Conflict',
+                page_content=f'{page_name} was changed by someone else '
+                'while reverting it. Check its history and try again.'), 409
+        except ValueError:
+            return "No such revision", 404
+        return redirect(url_for('show_page', page_name=page_name))
 
     @app.route('/pages/<page_name>')
     def show_page(page_name):
+        """Returns a wiki page.
+
+        The rendered HTML is cached by page name, content generation and the
+        logged in user (the navigation shows their name), so repeated views
+        of an unchanged page skip the template entirely. Requests with a
+        matching If-None-Match get a 304 without the page being read.
+        """
+        username = (current_user.username
+                    if current_user.is_authenticated else None)
+        if request.if_none_match:
+            generation = backend.get_page_generation(page_name)
+            if generation is not None and request.if_none_match.contains(
+                    _page_etag(generation, username)):
+                return _cacheable_page(Response(status=304), generation,
+                                       username)
         # get the content from the backend
         try:
-            content = backend.get_wiki_page(page_name)
+            content, generation = backend.get_wiki_page_info(page_name)
         except ValueError as ve:
             # return error to user if page is not found
             return render_template('main.html',
                                 page_name=page_name,
                                 content=str(ve))
 
-        # render the show_page template with the title and content
-        return render_template('show_page.html',
-                            title=page_name,
-                            content=content,
-                            page_name=page_name
-                            )
+        key = (page_name, generation, username)
+        html = backend.rendered_cache.get(key)
+        if html is None:
+            # render the show_page template with the title, the content as
+            # HTML and the raw markup for the editor
+            html = render_template('show_page.html',
+                                   title=page_name,
+                                   content=content,
+                                   content_html=Markup(
+                                       backend.render_page(content)),
+                                   page_name=page_name,
+                                   generation=generation)
+            backend.rendered_cache.set(key, html)
+        return _cacheable_page(Response(html), generation, username)
+
+    def _cacheable_page(response, generation, username):
+        """Sets the ETag and Cache-Control headers of a page response."""
+        response.set_etag(_page_etag(generation, username))
+        response.vary.add('Cookie')
+        if username is None:
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['PAGE_MAX_AGE']
+        else:
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        return response
 
 
     @app.route("/about")
@@ -82,17 +336,133 @@ def make_endpoints(app, backend):
 
     @app.route('/images/<image>')
     def images(image):
-        """Returns the image from the backend.
+        """Streams the image from the backend.
 
         This is a parameterized route where the identifier for the image we 
-        want is passed in the route. We will call backend.get_image to get the 
-        image contents.
+        want is passed in the route. We first look up the image metadata with
+        backend.get_image_info, which is enough to answer conditional requests
+        (If-None-Match / If-Modified-Since) with a 304. Otherwise the bytes
+        are streamed in chunks from backend.stream_image, honoring a single
+        byte Range if one was requested.
 
-        We use the send_file method provided by Flask to return the bytes of an
-        image. Documentation can be found at 
-        https://flask.palletsprojects.com/en/2.2.x/api/#flask.send_file
+        The ETag is the generation of the stored image, so it changes exactly
+        when the image is replaced.
+
+        With SIGNED_URLS enabled, we instead redirect to a short-lived signed
+        URL so the image bytes bypass the app server entirely.
+
+        With ?w=<pixels>, a variant scaled down to that width (rounded up to
+        one of IMAGE_VARIANT_WIDTHS) is sent instead, see flaskr.thumbnails.
 
         Args:
             image: the name of the image that we want
         """
-        return send_file(backend.get_image(image), mimetype='image/jpeg')
+        width = request.args.get('w', type=int)
+        if width is not None and width > 0 and thumbnails.available():
+            response = _image_variant(
+                image, thumbnails.snap_width(width,
+                                             app.config['IMAGE_VARIANT_WIDTHS']))
+            if response is not None:
+                return response
+        if backend.url_signer is not None:
+            expires_in = app.config['SIGNED_URL_TTL']
+            response = redirect(backend.get_image_url(image, expires_in))
+            # browsers may reuse the redirect while the URL is still valid
+            response.cache_control.private = True
+            response.cache_control.max_age = expires_in // 2
+            return response
+        info = backend.get_image_info(image)
+        if info is None:
+            return 'Image not found', 404
+        etag = str(info.generation)
+        response = Response(mimetype=_image_mimetype(info))
+        response.set_etag(etag)
+        response.last_modified = info.updated
+        response.accept_ranges = 'bytes'
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['IMAGE_MAX_AGE']
+        if not is_resource_modified(request.environ,
+                                    etag=etag,
+                                    last_modified=info.updated):
+            response.status_code = 304
+            return response
+
+        start, end = 0, info.size
+        byte_range = request.range
+        if byte_range is not None and len(byte_range.ranges) > 1:
+            # multipart responses are not supported; servers may ignore
+            # Range and send the whole image instead
+            byte_range = None
+        if byte_range is not None and _if_range_matches(etag, info.updated):
+            bounds = byte_range.range_for_length(info.size)
+            if bounds is None:
+                response.status_code = 416
+                response.headers['Content-Range'] = f'bytes */{info.size}'
+                return response
+            start, end = bounds
+            response.status_code = 206
+            response.content_range = ContentRange('bytes', start, end,
+                                                  info.size)
+        response.response = backend.stream_image(image, start, end,
+                                                 info.generation)
+        response.content_length = end - start
+        response.direct_passthrough = True
+        return response
+
+    def _image_variant(image, width):
+        """Returns the response sending a scaled down image, or None to send
+        the original."""
+        info = backend.get_image_info(image)
+        if info is None:
+            return None
+        variant = backend.get_image_variant(image, width, info)
+        if variant is None:
+            return None
+        if backend.url_signer is not None:
+            expires_in = app.config['SIGNED_URL_TTL']
+            response = redirect(
+                backend.get_image_url(
+                    thumbnails.variant_name(image, width, info.generation),
+                    expires_in))
+            response.cache_control.private = True
+            response.cache_control.max_age = expires_in // 2
+            return response
+        data, content_type = variant
+        etag = f'{info.generation}-w{width}'
+        response = Response(mimetype=content_type)
+        response.set_etag(etag)
+        response.last_modified = info.updated
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['IMAGE_MAX_AGE']
+        if not is_resource_modified(request.environ,
+                                    etag=etag,
+                                    last_modified=info.updated):
+            response.status_code = 304
+            return response
+        response.set_data(data)
+        return response
+
+
+def _page_etag(generation, username):
+    """Returns the strong ETag of a page as seen by the given user."""
+    if username is None:
+        return str(generation)
+    user = hashlib.sha256(username.encode()).hexdigest()[:16]
+    return f'{generation}-{user}'
+
+
+def _image_mimetype(info):
+    """Returns the stored content type, or a guess from the file extension."""
+    if info.content_type and info.content_type not in GENERIC_CONTENT_TYPES:
+        return info.content_type
+    return mimetypes.guess_type(info.name)[0] or 'application/octet-stream'
+
+
+def _if_range_matches(etag, last_modified):
+    """Returns True unless an If-Range header says the image has changed."""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return if_range.date >= last_modified.replace(microsecond=0)
+    return True
@@ -6,16 +6,21 @@ from flaskr import create_app
 from unittest.mock import patch, MagicMock
 from io import BytesIO
 import datetime
+import re
 from flask import url_for
+from flaskr.revisions import StaleBaseError
+from flaskr.storage import ConflictError, LocalStorage
 
 
 
 # See https://flask.palletsprojects.com/en/2.2.x/testing/
 # for more info on testing
 @pytest.fixture
-def app():
+def app(tmp_path):
     app = create_app({
         'TESTING': True,
+        'STORAGE_ENGINE': 'local',
+        'STORAGE_ROOT': str(tmp_path),
     })
 
     return app
@@ -109,7 +114,8 @@ def test_all_pages(client):
         assert b"Pages in the Wiki" in resp.data
 
 
-@patch("flaskr.backend.Backend.get_wiki_page", return_value=b"Some info.")
+@patch("flaskr.backend.Backend.get_wiki_page_info",
+       return_value=("Some info.", 1))
 def test_get_page(mock_get_wiki_page, client):
     name = "myimportantinfo"
     resp = client.get("/pages/myimportantinfo")
@@ -119,10 +125,357 @@ def test_get_page(mock_get_wiki_page, client):
     mock_get_wiki_page.assert_called_once_with(name)
 
 
-@patch("flaskr.backend.Backend.get_image", return_value=BytesIO())
-def test_get_image(mock_get_image, client):
-    image_name = "my-image"
-    resp = client.get("/images/my-image")
+def test_get_page_renders_markup(client, content_storage):
+    content_storage.put(
+        "Sega", b"# Sega\n\nMade the **Genesis**, see [[Nintendo]].\n\n"
+        b"<script>alert(1)</script>")
+
+    resp = client.get("/pages/Sega")
+
+    assert b"<h1>Sega</h1>" in resp.data
+    assert b"<strong>Genesis</strong>" in resp.data
+    assert (b'<a class="wikilink" href="/pages/Nintendo">Nintendo</a>'
+            in resp.data)
+    assert b"<script>alert(1)</script>" not in resp.data
+    # the editor shows the markup itself
+    assert b"**Genesis**" in resp.data
+
+
+def test_backlinks_and_broken_links(client):
+    with patch("flaskr.backend.Backend.get_backlinks",
+               return_value=["Nintendo"]):
+        resp = client.get("/pages/Sega/backlinks")
+        assert b"/pages/Nintendo" in resp.data
+    with patch("flaskr.backend.Backend.get_broken_links",
+               return_value=["Sonic"]):
+        assert b"Sonic" in client.get("/pages/Sega/broken_links").data
+    with patch("flaskr.backend.Backend.get_all_broken_links",
+               return_value=[("Sonic", ["Sega", "Nintendo"])]):
+        resp = client.get("/broken_links")
+        assert b"Sonic" in resp.data
+        assert b"/pages/Nintendo" in resp.data
+
+
+def test_history_and_diff(app, client, content_storage):
+    app.config["HISTORY_PER_PAGE"] = 1
+    content_storage.put("Sega", b"Genesis")
+    with patch("flask_login.utils._get_user") as user:
+        user.return_value.username = "test_user"
+        for content in ["Mega Drive", "Mega Drive\nDreamcast"]:
+            client.post("/save_changes",
+                        data={
+                            "page_name": "Sega",
+                            "content": content
+                        })
+        # the history is listed from the revision manifest alone
+        with patch("flaskr.revisions.RevisionStore.content") as content:
+            history = client.get("/pages/Sega/history")
+            content.assert_not_called()
+        html = history.get_data(as_text=True)
+        revision_id = re.search(r'revision\?id=([^"]+)', html).group(1)
+        revision = client.get(f"/pages/Sega/revision?id={revision_id}")
+        older = client.get("/pages/Sega/history?offset=1")
+        diff_url = re.search(r'href="([^"]*/diff\?[^"]+)"',
+                             older.get_data(as_text=True)).group(1)
+        diff = client.get(diff_url.replace("&amp;", "&"))
+        changes = client.get("/pages/Sega/diff?from=history/Sega/missing")
+        missing_from = client.get("/pages/Sega/diff")
+
+    assert history.status_code == 200
+    assert b"offset=1" in history.data
+    assert b"Mega Drive" in revision.data
+    # the oldest revision is diffed against the next newer one
+    assert b"<del>- Genesis</del>" in diff.data
+    assert b"<ins>+ Mega Drive</ins>" in diff.data
+    assert b"Dreamcast" not in diff.data
+    assert changes.status_code == 404
+    assert missing_from.status_code == 400
+
+
+def test_revert_page(client, content_storage):
+    content_storage.put("Sega", b"Genesis")
+    with patch("flask_login.utils._get_user") as user:
+        user.return_value.username = "test_user"
+        client.post("/save_changes",
+                    data={
+                        "page_name": "Sega",
+                        "content": "spam"
+                    })
+        history = client.get("/pages/Sega/history").get_data(as_text=True)
+        revision = re.search(r'name="revision" value="([^"]+)"',
+                             history).group(1)
+        resp = client.post("/pages/Sega/revert", data={"revision": revision})
+        missing = client.post("/pages/Sega/revert",
+                              data={"revision": "history/Sega/missing"})
+
+    assert resp.status_code == 302
+    assert b"Genesis" in client.get("/pages/Sega").data
+    assert missing.status_code == 404
+
+
+def test_revert_page_conflict(client, content_storage):
+    content_storage.put("Sega", b"Genesis")
+    with patch("flask_login.utils._get_user") as user:
+        user.return_value.username = "test_user"
+        with patch("flaskr.backend.Backend.revert_to_revision",
+                   side_effect=ConflictError("Sega changed")):
+            resp = client.post("/pages/Sega/revert",
+                               data={"revision": "history/Sega/x.txt"})
+
+    assert resp.status_code == 409
+
+
+def test_previous_version_of_changing_page(client, content_storage):
+    content_storage.put("Sega", b"Genesis")
+    with patch("flask_login.utils._get_user") as user:
+        user.return_value.username = "test_user"
+        with patch("flaskr.backend.Backend.get_previous_version",
+                   side_effect=StaleBaseError("Sega changed")):
+            resp = client.get("/pages/Sega/previous_version")
+
+    assert resp.status_code == 409
+
+
+def test_get_page_reuses_rendered_html(app, client, content_storage):
+    content_storage.put("Sega", b"Genesis")
+    client.get("/pages/Sega")
+
+    with patch("flaskr.pages.render_template") as render:
+        resp = client.get("/pages/Sega")
+
+    assert b"Genesis" in resp.data
+    render.assert_not_called()
+
+
+def test_get_page_rendered_again_after_save(app, client, content_storage):
+    content_storage.put("Sega", b"Genesis")
+    client.get("/pages/Sega")
+
+    with patch("flask_login.utils._get_user") as user:
+        user.return_value.username = "test_user"
+        client.post("/save_changes",
+                    data={
+                        "page_name": "Sega",
+                        "content": "Dreamcast"
+                    })
+
+    assert b"Dreamcast" in client.get("/pages/Sega").data
+
+
+@pytest.fixture
+def content_storage(tmp_path):
+    return LocalStorage(str(tmp_path / "thewikicontent"))
+
+
+def test_get_image(client, content_storage):
+    content_storage.put("my-image.png", b"image bytes")
+    resp = client.get("/images/my-image.png")
+    assert resp.status_code == 200
+    assert resp.mimetype == "image/png"
+    assert resp.data == b"image bytes"
+    assert resp.headers["ETag"]
+    assert resp.headers["Last-Modified"]
+    assert resp.headers["Accept-Ranges"] == "bytes"
+
+
+def test_get_missing_image(client):
+    resp = client.get("/images/missing.png")
+    assert resp.status_code == 404
+
+
+def test_get_image_not_modified(client, content_storage):
+    content_storage.put("my-image.jpg", b"image bytes")
+    etag = client.get("/images/my-image.jpg").headers["ETag"]
+    with patch("flaskr.backend.Backend.stream_image") as mock_stream:
+        resp = client.get("/images/my-image.jpg",
+                          headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.data == b""
+    mock_stream.assert_not_called()
+
+
+def test_get_image_modified_after_replace(client, content_storage):
+    content_storage.put("my-image.jpg", b"image bytes")
+    etag = client.get("/images/my-image.jpg").headers["ETag"]
+    content_storage.put("my-image.jpg", b"new image bytes")
+    resp = client.get("/images/my-image.jpg", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.data == b"new image bytes"
+
+
+def test_get_image_range(client, content_storage):
+    content_storage.put("my-image.jpg", b"0123456789")
+    resp = client.get("/images/my-image.jpg", headers={"Range": "bytes=2-5"})
+    assert resp.status_code == 206
+    assert resp.data == b"2345"
+    assert resp.headers["Content-Range"] == "bytes 2-5/10"
+
+    resp = client.get("/images/my-image.jpg", headers={"Range": "bytes=-3"})
+    assert resp.data == b"789"
+
+
+def test_get_image_range_not_satisfiable(client, content_storage):
+    content_storage.put("my-image.jpg", b"0123456789")
+    resp = client.get("/images/my-image.jpg", headers={"Range": "bytes=20-"})
+    assert resp.status_code == 416
+
+
+def test_get_image_multiple_ranges(client, content_storage):
+    content_storage.put("my-image.jpg", b"0123456789")
+    resp = client.get("/images/my-image.jpg",
+                      headers={"Range": "bytes=0-1,5-6"})
     assert resp.status_code == 200
-    mock_get_image.assert_called_once_with(image_name)
+    assert resp.data == b"0123456789"
+    assert "Content-Range" not in resp.headers
+
+
+def test_get_image_stale_if_range(client, content_storage):
+    content_storage.put("my-image.jpg", b"0123456789")
+    resp = client.get("/images/my-image.jpg",
+                      headers={
+                          "Range": "bytes=2-5",
+                          "If-Range": '"stale"'
+                      })
+    assert resp.status_code == 200
+    assert resp.data == b"0123456789"
+
+
+
+SORTED_PAGES = ["Atari", "DS", "Sega", "Steam", "Tetris", "Wii"]
+
+
+def test_pages_prefix_filter(client):
+    with patch("flaskr.backend.Backend.get_all_page_names",
+               return_value=SORTED_PAGES):
+        resp = client.get("/pages?prefix=S")
+    assert resp.status_code == 200
+    assert b"Sega" in resp.data
+    assert b"Steam" in resp.data
+    assert b"Tetris" not in resp.data
+    assert b"Next" not in resp.data
+
+
+def test_pages_pagination(client):
+    with patch("flaskr.backend.Backend.get_all_page_names",
+               return_value=SORTED_PAGES):
+        first = client.get("/pages?limit=2")
+        second = client.get("/pages?limit=2&after=DS")
+    assert b"Atari" in first.data
+    assert b"Sega" not in first.data
+    assert b"after=DS" in first.data
+    assert b"Sega" in second.data
+    assert b"Steam" in second.data
+    assert b"Atari" not in second.data
+
+
+def test_pages_streamed(app, client):
+    app.config['PAGES_STREAM'] = True
+    with patch("flaskr.backend.Backend.get_all_page_names",
+               return_value=SORTED_PAGES):
+        resp = client.get("/pages")
+        assert resp.is_streamed
+        assert b"Pages in the Wiki" in resp.data
+        assert b"Wii" in resp.data
+
+
+def test_get_page_etag_and_304(client, content_storage):
+    content_storage.put("Sega", b"Genesis")
+
+    resp = client.get("/pages/Sega")
+    etag = resp.headers["ETag"]
+
+    assert resp.cache_control.public
+    assert resp.cache_control.max_age == 60
+    with patch("flaskr.backend.Backend.get_wiki_page_info") as get_page:
+        cached = client.get("/pages/Sega", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.headers["ETag"] == etag
+    get_page.assert_not_called()
+
+
+    with patch("flask_login.utils._get_user") as user:
+        user.return_value.username = "test_user"
+        client.post("/save_changes",
+                    data={
+                        "page_name": "Sega",
+                        "content": "Dreamcast"
+                    })
+    changed = client.get("/pages/Sega", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+
+
+def test_get_page_etag_differs_per_user(client, content_storage):
+    content_storage.put("Sega", b"Genesis")
+    anonymous = client.get("/pages/Sega").headers["ETag"]
+
+    with patch("flask_login.utils._get_user") as user:
+        user.return_value.username = "test_user"
+        resp = client.get("/pages/Sega", headers={"If-None-Match": anonymous})
+
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != anonymous
+    assert resp.cache_control.private
+    assert resp.cache_control.no_cache
+
+
+def test_search(client):
+    with patch("flaskr.backend.Backend.search",
+               return_value=[("Sega", 1.5)]) as search:
+        resp = client.get("/search?q=genesis&limit=1000")
+
+    assert resp.status_code == 200
+    assert b"/pages/Sega" in resp.data
+    search.assert_called_once_with("genesis", 100)
+
+
+def test_search_without_query(client):
+    resp = client.get("/search")
+
+    assert resp.status_code == 200
+    assert b"No pages match" not in resp.data
+
+
+def test_save_conflict(client, content_storage):
+    content_storage.put("Sega", b"Genesis")
+    generation = content_storage.stat("Sega").generation
+    content_storage.put("Sega", b"Dreamcast")
+
+    with patch("flask_login.utils._get_user") as user:
+        user.return_value.username = "test_user"
+        resp = client.post("/save_changes",
+                           data={
+                               "page_name": "Sega",
+                               "content": "Saturn",
+                               "generation": generation
+                           })
+
+    assert resp.status_code == 409
+    assert content_storage.get("Sega") == b"Dreamcast"
+
+
+def test_get_image_variant(client, content_storage):
+    content_storage.put("cami.jpg", b"\xff\xd8 original")
+    with patch("flaskr.thumbnails.available", return_value=True), patch(
+            "flaskr.thumbnails.resize",
+            return_value=(b"\xff\xd8 small", "image/jpeg")) as mock_resize:
+        resp = client.get("/images/cami.jpg?w=150")
+        etag = resp.headers["ETag"]
+        not_modified = client.get("/images/cami.jpg?w=150",
+                                  headers={"If-None-Match": etag})
+
+    assert resp.status_code == 200
+    assert resp.data == b"\xff\xd8 small"
+    assert resp.mimetype == "image/jpeg"
+    # rounded up to an allowed width
+    mock_resize.assert_called_once_with(b"\xff\xd8 original", 200)
+    assert etag.endswith('-w200"')
+    assert not_modified.status_code == 304
+
+
+def test_get_image_variant_falls_back_to_original(client, content_storage):
+    content_storage.put("cami.jpg", b"\xff\xd8 original")
+    with patch("flaskr.thumbnails.available", return_value=False):
+        resp = client.get("/images/cami.jpg?w=150")
 
+    assert resp.data == b"\xff\xd8 original"
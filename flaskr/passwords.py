@@ -0,0 +1,151 @@
+"""Salted, versioned password hashes for the user bucket.
+
+Users used to be stored as an unsalted sha256 of 'username:password'. New
+records are produced by a slow key derivation function from hashlib and
+carry everything needed to check them later:
+
+    $scrypt$n=16384,r=8,p=1$<salt>$<hash>
+    $pbkdf2-sha256$i=600000$<salt>$<hash>
+
+with the salt and hash in unpadded base64. Old sha256 records still verify,
+and PasswordHasher.needs_rehash tells the caller to replace any record that
+is not made with the current scheme and cost, which Backend.sign_in does
+after a successful login.
+
+Hashing is deliberately expensive, so it runs on a small thread pool: at
+most max_workers hashes run at once (hashlib releases the GIL while
+hashing) and at most max_pending more may wait, so a burst of logins cannot
+tie up every web worker. Beyond that, HashingBusyError is raised.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import hashlib
+import hmac
+import os
+import threading
+
+SCRYPT = 'scrypt'
+PBKDF2 = 'pbkdf2-sha256'
+# Default cost of each scheme: the scrypt n parameter, or pbkdf2 iterations.
+DEFAULT_COSTS = {SCRYPT: 2**14, PBKDF2: 600000}
+SALT_BYTES = 16
+HASH_BYTES = 32
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+class HashingBusyError(ValueError):
+    """Raised when too many passwords are already waiting to be hashed."""
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def _b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def _derive(scheme, cost, password, salt):
+    if scheme == SCRYPT:
+        return hashlib.scrypt(password.encode(),
+                              salt=salt,
+                              n=cost,
+                              r=SCRYPT_R,
+                              p=SCRYPT_P,
+                              maxmem=256 * SCRYPT_R * cost,
+                              dklen=HASH_BYTES)
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, cost,
+                               HASH_BYTES)
+
+
+def _format_params(scheme, cost):
+    if scheme == SCRYPT:
+        return f'n={cost},r={SCRYPT_R},p={SCRYPT_P}'
+    return f'i={cost}'
+
+
+def _parse(record):
+    """Returns (scheme, cost, salt, hash) of a record, or None if legacy."""
+    if not record.startswith('$'):
+        return None
+    _, scheme, params, salt, digest = record.split('$')
+    params = dict(param.split('=') for param in params.split(','))
+    if scheme == SCRYPT:
+        if (int(params['r']), int(params['p'])) != (SCRYPT_R, SCRYPT_P):
+            raise ValueError(f'Unsupported scrypt parameters: {params}')
+        cost = int(params['n'])
+    elif scheme == PBKDF2:
+        cost = int(params['i'])
+    else:
+        raise ValueError(f'Unknown password hash scheme: {scheme}')
+    return scheme, cost, _b64decode(salt), _b64decode(digest)
+
+
+def legacy_hash(username, password):
+    """Returns the unsalted record the wiki used to store."""
+    return hashlib.sha256(f'{username}:{password}'.encode()).hexdigest()
+
+
+class PasswordHasher:
+
+    def __init__(self, scheme=SCRYPT, cost=None, max_workers=2, max_pending=32):
+        """Constructs a hasher producing records with one scheme and cost.
+
+        Args:
+            scheme: SCRYPT or PBKDF2
+            cost: scrypt n (a power of 2) or pbkdf2 iterations, or None for
+                the scheme's default
+            max_workers: number of passwords hashed at the same time
+            max_pending: number of passwords allowed to wait for a worker
+        """
+        if scheme not in DEFAULT_COSTS:
+            raise ValueError(f'Unknown password hash scheme: {scheme}')
+        self.scheme = scheme
+        self.cost = DEFAULT_COSTS[scheme] if cost is None else cost
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='passwords')
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    def _run(self, scheme, cost, password, salt):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusyError('Too many logins at once, try again!')
+        try:
+            return self._executor.submit(_derive, scheme, cost, password,
+                                         salt).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Returns a new salted record for password."""
+        salt = os.urandom(SALT_BYTES)
+        digest = self._run(self.scheme, self.cost, password, salt)
+        return (f'${self.scheme}${_format_params(self.scheme, self.cost)}'
+                f'${_b64encode(salt)}${_b64encode(digest)}')
+
+    def verify(self, record, password, username):
+        """Returns True if password matches the stored record.
+
+        username is only needed to check legacy records.
+        """
+        parsed = _parse(record)
+        if parsed is None:
+            return hmac.compare_digest(record,
+                                       legacy_hash(username, password))
+        scheme, cost, salt, digest = parsed
+        return hmac.compare_digest(digest,
+                                   self._run(scheme, cost, password, salt))
+
+    def needs_rehash(self, record):
+        """Returns True if record was not made with this scheme and cost."""
+        parsed = _parse(record)
+        return parsed is None or parsed[:2] != (self.scheme, self.cost)
+
+
+def hasher_from_config(config):
+    """Returns the PasswordHasher described by the PASSWORD_HASH_* keys."""
+    return PasswordHasher(config.get('PASSWORD_HASH_SCHEME', SCRYPT),
+                          config.get('PASSWORD_HASH_COST'),
+                          config.get('PASSWORD_HASH_WORKERS', 2),
+                          config.get('PASSWORD_HASH_MAX_PENDING', 32))
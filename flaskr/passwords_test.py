@@ -0,0 +1,79 @@
+from flaskr.passwords import (HashingBusyError, PasswordHasher, PBKDF2, SCRYPT,
+                              hasher_from_config, legacy_hash)
+import pytest
+import threading
+
+
+@pytest.fixture
+def hasher():
+    return PasswordHasher(cost=2**4)
+
+
+def test_hash_and_verify(hasher):
+    record = hasher.hash("password")
+
+    assert record.startswith("$scrypt$n=16,r=8,p=1$")
+    assert hasher.verify(record, "password", "test_user")
+    assert not hasher.verify(record, "bad password", "test_user")
+    assert not hasher.needs_rehash(record)
+
+
+def test_records_are_salted(hasher):
+    assert hasher.hash("password") != hasher.hash("password")
+
+
+def test_pbkdf2():
+    hasher = PasswordHasher(PBKDF2, 1000)
+    record = hasher.hash("password")
+
+    assert record.startswith("$pbkdf2-sha256$i=1000$")
+    assert hasher.verify(record, "password", "test_user")
+
+
+def test_legacy_records_verify_and_need_rehash(hasher):
+    record = legacy_hash("test_user", "password")
+
+    assert hasher.verify(record, "password", "test_user")
+    assert not hasher.verify(record, "password", "other_user")
+    assert hasher.needs_rehash(record)
+
+
+def test_other_cost_or_scheme_needs_rehash(hasher):
+    assert hasher.needs_rehash(PasswordHasher(cost=2**5).hash("password"))
+    assert hasher.needs_rehash(PasswordHasher(PBKDF2, 1000).hash("password"))
+    # records with other parameters still verify
+    assert hasher.verify(
+        PasswordHasher(PBKDF2, 1000).hash("password"), "password", "user")
+
+
+def test_busy_when_too_many_pending(monkeypatch):
+    hasher = PasswordHasher(cost=2**4, max_workers=1, max_pending=0)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_derive(*args):
+        started.set()
+        release.wait()
+        return b""
+
+    monkeypatch.setattr("flaskr.passwords._derive", slow_derive)
+    thread = threading.Thread(target=hasher.hash, args=("password",))
+    thread.start()
+    started.wait()
+    try:
+        with pytest.raises(HashingBusyError):
+            hasher.hash("password")
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_hasher_from_config():
+    hasher = hasher_from_config({
+        "PASSWORD_HASH_SCHEME": PBKDF2,
+        "PASSWORD_HASH_COST": 1000
+    })
+
+    assert (hasher.scheme, hasher.cost) == (PBKDF2, 1000)
+    assert hasher_from_config({}).scheme == SCRYPT
+    with pytest.raises(ValueError):
+        PasswordHasher("md5")
@@ -0,0 +1,152 @@
+"""Opt-in cProfile sampling of selected endpoints.
+
+With PROFILE_ENABLED, a PROFILE_SAMPLE_RATE fraction of the requests to the
+endpoints in PROFILE_ENDPOINTS run under cProfile. The profiles of each
+endpoint are merged and written to '{PROFILE_DIR}/{endpoint}-{pid}.pstats'
+after every profiled request, so they can be opened with pstats or
+snakeviz, and a summary is served by the endpoints below (to clients
+sending 'Authorization: Bearer {PROFILE_TOKEN}', if a token is set):
+
+URI                          | Method | Description
+-----------------------------|--------|-------------
+/_profile                    | GET    | Lists the profiled endpoints
+/_profile/<endpoint>         | GET    | Returns the top functions of an
+                             |        | endpoint as text (?sort=cumulative
+                             |        | or tottime, &limit=40)
+/_profile/<endpoint>.pstats  | GET    | Downloads the merged profile
+
+Only one request is profiled at a time: Python 3.12 allows a single active
+profiler. cProfile only records the thread that enabled it (on Python 3.9
+to 3.11, which app.yaml runs), so the storage calls a request hands to the
+Backend's I/O pool do not show up as such. Their time appears under
+concurrent.futures.wait, called from Backend._wait or directly. The storage
+metrics on /metrics break that time down by operation. On Python 3.12 and
+later, cProfile records every thread instead, including those serving
+other requests, so profiles there also hold unrelated work.
+"""
+
+from flask import Response, abort, g, request, send_file
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import random
+import threading
+
+SORT_KEYS = ('cumulative', 'tottime', 'calls')
+
+
+class Profiles:
+    """The merged profiles of each endpoint."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._stats = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+        # held while a request is profiled
+        self.active = threading.Lock()
+
+    def path(self, endpoint):
+        return os.path.join(self.directory, f'{endpoint}-{os.getpid()}.pstats')
+
+    def add(self, endpoint, profile):
+        """Merges a finished profile into the endpoint's and saves it."""
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+            os.makedirs(self.directory, exist_ok=True)
+            stats.dump_stats(self.path(endpoint))
+
+    def counts(self):
+        """Returns endpoint -> number of requests profiled."""
+        with self._lock:
+            return dict(self._counts)
+
+    def report(self, endpoint, sort='cumulative', limit=40):
+        """Returns the top functions of an endpoint as text, or None."""
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                return None
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats(sort).print_stats(limit)
+            stats.stream = None
+        return (f'{self._counts[endpoint]} requests profiled\n' +
+                out.getvalue())
+
+
+def make_endpoints(app, profiles, endpoints, sample_rate=1.0, token=None):
+    """Profiles sampled requests to the given endpoints and serves reports.
+
+    Args:
+        app: an instance of the Flask app
+        profiles: the Profiles to merge the results into
+        endpoints: names of the endpoints to profile
+        sample_rate: fraction of their requests that are profiled
+        token: if given, the reports require an 'Authorization: Bearer
+            <token>' header
+    """
+    endpoints = frozenset(endpoints)
+
+    def check_token():
+        if token is not None and not hmac.compare_digest(
+                request.headers.get('Authorization', '').encode(),
+                f'Bearer {token}'.encode()):
+            abort(401)
+
+    @app.before_request
+    def start_profile():
+        if (request.endpoint not in endpoints or
+                random.random() >= sample_rate or
+                not profiles.active.acquire(blocking=False)):
+            return
+        profile = cProfile.Profile()
+        g.profile = profile
+        profile.enable()
+
+    @app.teardown_request
+    def stop_profile(error=None):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        profiles.active.release()
+        profiles.add(request.endpoint, profile)
+
+    @app.route('/_profile')
+    def profile_index():
+        check_token()
+        lines = [
+            f'{endpoint}: {count} requests profiled'
+            for endpoint, count in sorted(profiles.counts().items())
+        ]
+        return Response('\n'.join(lines) + '\n', content_type='text/plain')
+
+    @app.route('/_profile/<endpoint>.pstats')
+    def profile_download(endpoint):
+        check_token()
+        if endpoint not in profiles.counts():
+            abort(404)
+        return send_file(profiles.path(endpoint),
+                         mimetype='application/octet-stream',
+                         as_attachment=True,
+                         download_name=f'{endpoint}.pstats')
+
+    @app.route('/_profile/<endpoint>')
+    def profile_report(endpoint):
+        check_token()
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in SORT_KEYS:
+            abort(400)
+        limit = request.args.get('limit', 40, type=int)
+        report = profiles.report(endpoint, sort, limit)
+        if report is None:
+            abort(404)
+        return Response(report, content_type='text/plain')
@@ -0,0 +1,112 @@
+from flaskr import create_app
+from unittest.mock import patch
+import pstats
+import pytest
+
+
+@pytest.fixture
+def app(tmp_path):
+    return create_app({
+        'TESTING': True,
+        'STORAGE_ENGINE': 'local',
+        'STORAGE_ROOT': str(tmp_path / 'storage'),
+        'PROFILE_ENABLED': True,
+        'PROFILE_SAMPLE_RATE': 1.0,
+        'PROFILE_DIR': str(tmp_path / 'profiles'),
+    })
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def test_profiles_selected_endpoints(client, tmp_path):
+    with patch('flaskr.backend.Backend.get_all_page_names',
+               return_value=['Sega']):
+        client.get('/pages')
+        client.get('/pages')
+    client.get('/about')
+
+    resp = client.get('/_profile')
+
+    assert resp.get_data(as_text=True) == 'pages: 2 requests profiled\n'
+    files = list((tmp_path / 'profiles').iterdir())
+    assert len(files) == 1
+    stats = pstats.Stats(str(files[0]))
+    assert any(function == 'pages' for _, _, function in stats.stats)
+
+
+def test_profile_report(client):
+    client.get('/pages/Missing')
+
+    resp = client.get('/_profile/show_page?sort=tottime&limit=5')
+
+    text = resp.get_data(as_text=True)
+    assert resp.status_code == 200
+    assert text.startswith('1 requests profiled')
+    assert 'tottime' in text
+    assert client.get('/_profile/show_page?sort=name').status_code == 400
+    assert client.get('/_profile/about').status_code == 404
+
+
+def test_profile_download(client):
+    client.get('/pages/Missing')
+
+    resp = client.get('/_profile/show_page.pstats')
+
+    assert resp.status_code == 200
+    assert 'show_page.pstats' in resp.headers['Content-Disposition']
+    assert client.get('/_profile/about.pstats').status_code == 404
+
+
+def test_sampling(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'STORAGE_ENGINE': 'local',
+        'STORAGE_ROOT': str(tmp_path / 'storage'),
+        'PROFILE_ENABLED': True,
+        'PROFILE_SAMPLE_RATE': 0.1,
+        'PROFILE_DIR': str(tmp_path / 'profiles'),
+    })
+    client = app.test_client()
+
+    with patch('flaskr.profiling.random.random', side_effect=[0.5, 0.05]):
+        client.get('/pages/Missing')
+        client.get('/pages/Missing')
+
+    assert (client.get('/_profile').get_data(
+        as_text=True) == 'show_page: 1 requests profiled\n')
+
+
+def test_profiling_disabled_by_default(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'STORAGE_ENGINE': 'local',
+        'STORAGE_ROOT': str(tmp_path),
+    })
+
+    assert app.test_client().get('/_profile').status_code == 404
+
+
+def test_profile_token(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'STORAGE_ENGINE': 'local',
+        'STORAGE_ROOT': str(tmp_path / 'storage'),
+        'PROFILE_ENABLED': True,
+        'PROFILE_SAMPLE_RATE': 1.0,
+        'PROFILE_DIR': str(tmp_path / 'profiles'),
+        'PROFILE_TOKEN': 's3cret',
+    })
+    client = app.test_client()
+    client.get('/pages/Missing')
+    authorized = {'Authorization': 'Bearer s3cret'}
+
+    for url in ['/_profile', '/_profile/show_page',
+                '/_profile/show_page.pstats']:
+        assert client.get(url).status_code == 401
+        assert client.get(url, headers={
+            'Authorization': 'Bearer wrong'
+        }).status_code == 401
+        assert client.get(url, headers=authorized).status_code == 200
@@ -0,0 +1,427 @@
+"""Delta-compressed storage for the previous versions of wiki pages.
+
+Every time a page is saved, the content it had before the edit becomes a
+revision. Instead of uploading a full copy each time, revisions are stored
+as reverse deltas: a zlib-compressed diff that turns the next newer version
+of the page back into the old one. The newest revision is a delta against
+the current page, which we already have in memory when saving.
+
+To keep reconstruction cheap, every snapshot_interval-th revision is stored
+as a plain full copy, so rebuilding any version applies at most
+snapshot_interval - 1 deltas on top of a full copy or the current page.
+
+Revisions live under 'history/{page_name}/' and are named
+'{timestamp}-{username}.txt' for full copies or '.delta' for deltas. Each
+page also has an append-only manifest, 'history/{page_name}/manifest.jsonl',
+with one JSON line per revision (oldest first) holding its timestamp,
+author, blob name, stored size and kind. Reading the manifest replaces
+listing and parsing blob names; the newest revision is read from its last
+line with a small ranged read. Pages without a manifest have their history
+read from a listing instead, which also picks up older full copies named
+'history/{page_name}-{timestamp}-{username}.txt'; reading never writes, and
+the manifest is built when the next revision is recorded (or by
+migrate()).
+"""
+
+from collections import namedtuple
+from flaskr.cache import LRUCache
+from flaskr.storage import ConflictError
+from datetime import datetime, timedelta
+import difflib
+import hashlib
+import json
+import re
+import zlib
+
+HISTORY_PREFIX = 'history/'
+FULL_SUFFIX = '.txt'
+DELTA_SUFFIX = '.delta'
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+LEGACY_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
+DISPLAY_FORMAT = '%Y-%m-%d %H:%M:%S'
+MANIFEST_NAME = 'manifest.jsonl'
+
+_NEW_NAME = re.compile(r'(\d{20})-(.*)(\.txt|\.delta)$', re.DOTALL)
+_LEGACY_NAME = re.compile(r'(\d{14})-(.*)\.txt$', re.DOTALL)
+
+# One stored revision of a page. is_delta tells whether the blob holds a
+# delta or a full copy of the content, size is the number of bytes stored.
+Revision = namedtuple('Revision',
+                      ['name', 'timestamp', 'username', 'is_delta', 'size'])
+
+
+def _to_line(revision):
+    entry = {
+        'ts': revision.timestamp.strftime(TIMESTAMP_FORMAT),
+        'user': revision.username,
+        'blob': revision.name,
+        'size': revision.size,
+        'delta': revision.is_delta,
+    }
+    return json.dumps(entry) + '\n'
+
+
+def _from_line(line):
+    entry = json.loads(line)
+    return Revision(entry['blob'],
+                    datetime.strptime(entry['ts'], TIMESTAMP_FORMAT),
+                    entry['user'], entry['delta'], entry['size'])
+
+
+class StaleBaseError(ValueError):
+    """Raised when a delta is applied to a different version than its base.
+
+    This usually means the copy of the current page used was outdated.
+    """
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def make_delta(base, target):
+    """Returns compressed bytes that turn base into target with apply_delta.
+
+    The delta copies runs of lines from base and inserts the lines that are
+    new in target.
+    """
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, target_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif tag in ('replace', 'insert'):
+            ops.append(''.join(target_lines[j1:j2]))
+    payload = {'base': _digest(base), 'ops': ops}
+    return zlib.compress(json.dumps(payload).encode())
+
+
+def apply_delta(base, delta):
+    """Rebuilds the target text from base and a delta made by make_delta."""
+    payload = json.loads(zlib.decompress(delta))
+    if payload['base'] != _digest(base):
+        raise StaleBaseError(
+            'Revision delta does not match its base version')
+    base_lines = base.splitlines(keepends=True)
+    parts = []
+    for op in payload['ops']:
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.extend(base_lines[op[0]:op[1]])
+    return ''.join(parts)
+
+
+class RevisionStore:
+
+    # bytes read from the end of a manifest to find the newest revision
+    TAIL_BYTES = 4096
+    # how many times a manifest append is retried on concurrent writes
+    MAX_RETRIES = 5
+
+    def __init__(self, storage, snapshot_interval=10):
+        """Constructs a RevisionStore.
+
+        Args:
+            storage: the Storage engine holding the wiki content
+            snapshot_interval: store a full copy every this many revisions
+        """
+        self.storage = storage
+        self.snapshot_interval = max(1, snapshot_interval)
+        # maps page name -> (revisions, manifest generation) as last read or
+        # written by this process. Appends are conditional on the generation,
+        # so a stale entry only costs a retry.
+        self._manifests = LRUCache(maxsize=256)
+
+    @staticmethod
+    def _manifest_name(page_name):
+        return f'{HISTORY_PREFIX}{page_name}/{MANIFEST_NAME}'
+
+    def _load(self, page_name):
+        """Returns (revisions oldest first, generation) or (None, 0)."""
+        data, info = self.storage.get_with_info(self._manifest_name(page_name))
+        if data is None:
+            self._manifests.pop(page_name)
+            return None, 0
+        revisions = [_from_line(line) for line in data.splitlines()]
+        self._manifests.set(page_name, (revisions, info.generation))
+        return revisions, info.generation
+
+    def _revisions(self, page_name):
+        """Returns the revisions of a page oldest first."""
+        revisions, _ = self._load(page_name)
+        if revisions is None:
+            # not migrated yet; the next recorded revision writes the manifest
+            revisions = self._scan(page_name)
+        return revisions
+
+    def _scan(self, page_name):
+        """Finds the revisions of a page by listing and parsing blob names."""
+        revisions = []
+        prefix = f'{HISTORY_PREFIX}{page_name}/'
+        for name in self.storage.list(prefix=prefix):
+            match = _NEW_NAME.match(name[len(prefix):])
+            if match:
+                timestamp = datetime.strptime(match.group(1), TIMESTAMP_FORMAT)
+                revisions.append(
+                    Revision(name, timestamp, match.group(2),
+                             match.group(3) == DELTA_SUFFIX,
+                             self.storage.stat(name).size))
+        # the prefix of the old naming scheme also matches pages whose name
+        # continues with '-', which the timestamp check filters out
+        prefix = f'{HISTORY_PREFIX}{page_name}-'
+        for name in self.storage.list(prefix=prefix):
+            match = _LEGACY_NAME.match(name[len(prefix):])
+            if match:
+                timestamp = datetime.strptime(match.group(1),
+                                              LEGACY_TIMESTAMP_FORMAT)
+                revisions.append(
+                    Revision(name, timestamp, match.group(2), False,
+                             self.storage.stat(name).size))
+        revisions.sort(key=lambda r: (r.timestamp, r.name))
+        return revisions
+
+    def migrate(self, page_name):
+        """(Re)builds the manifest of a page from its history blobs.
+
+        Returns the revisions of the page oldest first.
+        """
+        revisions = self._scan(page_name)
+        self._manifests.pop(page_name)
+        self.storage.put(self._manifest_name(page_name),
+                         ''.join(_to_line(r) for r in revisions))
+        return revisions
+
+    def list(self, page_name, offset=0, limit=None):
+        """Returns revisions of a page newest first.
+
+        Args:
+            page_name: name of the page
+            offset: number of newest revisions to skip
+            limit: maximum number of revisions to return, or None for all
+        """
+        revisions = self._revisions(page_name)
+        end = len(revisions) - offset
+        start = 0 if limit is None else max(0, end - limit)
+        return revisions[start:max(0, end)][::-1]
+
+    def latest(self, page_name):
+        """Returns the newest revision of a page, or None if there are none.
+
+        Only the end of the manifest is read, however long the history is.
+        """
+        tail = self.storage.get_range(self._manifest_name(page_name),
+                                      -self.TAIL_BYTES)
+        if tail is None:
+            revisions = self._scan(page_name)
+            return revisions[-1] if revisions else None
+        lines = tail.rstrip(b'\n').split(b'\n')
+        if not lines[-1]:
+            return None
+        if len(lines) == 1 and len(tail) >= self.TAIL_BYTES:
+            # the newest line might have been cut off by the ranged read
+            return self._revisions(page_name)[-1]
+        return _from_line(lines[-1])
+
+    def record(self, page_name, old_content, new_content, username,
+               old_generation=None):
+        """Stores old_content as the newest revision before new_content.
+
+        If old_generation is the generation of the page holding old_content,
+        full copies are made with a copy inside the storage engine instead of
+        uploading old_content again.
+        """
+        return self._append(
+            page_name, lambda revisions: self._store(
+                page_name, revisions, old_content, new_content, username,
+                old_generation))
+
+    def record_copy(self, page_name, info, username):
+        """Stores the current version of a page as the newest revision.
+
+        The revision is a full copy made inside the storage engine, so the
+        content never passes through the app.
+
+        Args:
+            page_name: name of the page
+            info: ObjectInfo of the page version to keep
+            username: author of the edit replacing that version
+
+        Raises:
+            ConflictError if the page no longer has info.generation.
+        """
+
+        def store(revisions):
+            name, timestamp = self._new_name(page_name, revisions, username)
+            name += FULL_SUFFIX
+            self.storage.copy(page_name, name, info.generation)
+            return Revision(name, timestamp, username, False, info.size)
+
+        return self._append(page_name, store)
+
+    def _append(self, page_name, store):
+        """Adds the Revision returned by store(revisions) to the manifest.
+
+        store writes the revision's blob; it is called again (after the
+        blob is deleted) if another revision was recorded concurrently.
+        """
+        for _ in range(self.MAX_RETRIES):
+            cached = self._manifests.get(page_name)
+            if cached is not None:
+                revisions, generation = cached
+            else:
+                revisions, generation = self._load(page_name)
+            if revisions is None:
+                # the manifest is created along with the first revision
+                # recorded since migrating to manifests
+                revisions, generation = self._scan(page_name), 0
+            revision = store(revisions)
+            revisions = revisions + [revision]
+            try:
+                generation = self.storage.put(
+                    self._manifest_name(page_name),
+                    ''.join(_to_line(r) for r in revisions),
+                    if_generation_match=generation)
+            except ConflictError:
+                # someone else recorded a revision of this page first; drop
+                # our blob and redo it on top of theirs
+                self._manifests.pop(page_name)
+                self.storage.delete(revision.name)
+                continue
+            if generation is None:
+                self._manifests.pop(page_name)
+            else:
+                self._manifests.set(page_name, (revisions, generation))
+            return revision
+        raise ConflictError(f'Unable to record a revision of {page_name}')
+
+    def discard(self, page_name, revision):
+        """Removes a revision again, e.g. if the edit failed.
+
+        Revisions recorded since then are kept: the content the failed edit
+        replaced is still the version they were recorded against.
+        """
+        for _ in range(self.MAX_RETRIES):
+            revisions, generation = self._load(page_name)
+            if not revisions or revision not in revisions:
+                return
+            kept = [r for r in revisions if r != revision]
+            try:
+                self.storage.put(self._manifest_name(page_name),
+                                 ''.join(_to_line(r) for r in kept),
+                                 if_generation_match=generation)
+            except ConflictError:
+                continue
+            finally:
+                self._manifests.pop(page_name)
+            self.storage.delete(revision.name)
+            return
+        raise ConflictError(f'Unable to discard a revision of {page_name}')
+
+    def _store(self, page_name, revisions, old_content, new_content, username,
+               old_generation=None):
+        """Writes the blob for a new revision and returns its Revision."""
+        # count the deltas since the newest full copy, so no version is ever
+        # more than snapshot_interval - 1 deltas away from a full copy
+        trailing_deltas = 0
+        for revision in reversed(revisions):
+            if not revision.is_delta:
+                break
+            trailing_deltas += 1
+        name, timestamp = self._new_name(page_name, revisions, username)
+        if trailing_deltas + 1 >= self.snapshot_interval:
+            name += FULL_SUFFIX
+            data = old_content.encode()
+            if old_generation is not None:
+                try:
+                    self.storage.copy(page_name, name, old_generation)
+                    return Revision(name, timestamp, username, False,
+                                    len(data))
+                except ConflictError:
+                    # the page was already replaced (e.g. by the write this
+                    # revision belongs to), so upload our copy instead
+                    pass
+        else:
+            name += DELTA_SUFFIX
+            data = make_delta(new_content, old_content)
+        self.storage.put(name, data)
+        return Revision(name, timestamp, username, name.endswith(DELTA_SUFFIX),
+                        len(data))
+
+    @staticmethod
+    def _new_name(page_name, revisions, username):
+        """Returns (blob name without suffix, timestamp) of a new revision."""
+        # keep revision names strictly increasing even for edits made within
+        # the same microsecond or on a server with a clock running behind
+        timestamp = datetime.utcnow()
+        if revisions and timestamp <= revisions[-1].timestamp:
+            timestamp = revisions[-1].timestamp + timedelta(microseconds=1)
+        name = (f'{HISTORY_PREFIX}{page_name}/'
+                f'{timestamp.strftime(TIMESTAMP_FORMAT)}-{username}')
+        return name, timestamp
+
+    def content(self, page_name, revision_name, current_content):
+        """Rebuilds the content of one revision of a page.
+
+        Args:
+            page_name: name of the page
+            revision_name: name of the revision, as returned by list()
+            current_content: function returning the current page content,
+                only called if the newest revisions are deltas
+        """
+        _, content = self.get(page_name, revision_name, current_content)
+        return content
+
+    def find(self, page_name, revision_name):
+        """Returns the Revision of a page with the given name.
+
+        Raises ValueError if the page has no such revision.
+        """
+        for revision in self._revisions(page_name):
+            if revision.name == revision_name:
+                return revision
+        raise ValueError(f'No revision {revision_name} for {page_name}')
+
+    def get(self, page_name, revision_name, current_content):
+        """Returns (Revision, content) of one revision of a page.
+
+        Takes the same arguments as content() and raises ValueError if the
+        page has no such revision.
+        """
+        revisions = self._revisions(page_name)
+        names = [revision.name for revision in revisions]
+        if revision_name not in names:
+            raise ValueError(f'No revision {revision_name} for {page_name}')
+        # rebuilding this revision needs the newer ones, up to the nearest
+        # full copy (or all the way to the current page if they are all
+        # deltas)
+        chain = []
+        for revision in revisions[names.index(revision_name):]:
+            chain.append(revision)
+            if not revision.is_delta:
+                break
+        return chain[0], self._rebuild(chain, current_content)
+
+    def latest_content(self, page_name, current_content):
+        """Returns (newest revision, its content) or (None, None)."""
+        revision = self.latest(page_name)
+        if revision is None:
+            return None, None
+        return revision, self._rebuild([revision], current_content)
+
+    def _rebuild(self, chain, current_content):
+        """Applies a chain of revisions (oldest first) to get the oldest.
+
+        The chain either ends with a full copy or only holds deltas, in which
+        case the newest one is applied to the current page content.
+        """
+        chain = list(chain)
+        if chain[-1].is_delta:
+            content = current_content()
+        else:
+            content = self.storage.get(chain.pop().name).decode()
+        for revision in reversed(chain):
+            content = apply_delta(content, self.storage.get(revision.name))
+        return content
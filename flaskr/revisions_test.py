@@ -0,0 +1,240 @@
+from flaskr.revisions import RevisionStore, make_delta, apply_delta
+from flaskr.storage import ConflictError, LocalStorage
+from unittest.mock import patch
+import pytest
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(str(tmp_path))
+
+
+def edit(store, storage, page_name, versions):
+    """Saves each version in turn, recording the previous one."""
+    storage.put(page_name, versions[0])
+    for old, new in zip(versions, versions[1:]):
+        store.record(page_name, old, new, "user")
+        storage.put(page_name, new)
+
+
+def current(storage, page_name):
+    return lambda: storage.get(page_name).decode()
+
+
+@pytest.mark.parametrize(('base', 'target'), (
+    ("", ""),
+    ("a\nb\nc\n", "a\nB\nc\nd"),
+    ("one line", ""),
+    ("", "new\npage\n"),
+    ("x\r\ny\n", "y\nx\r\n"),
+))
+def test_delta_round_trip(base, target):
+    assert apply_delta(base, make_delta(base, target)) == target
+
+
+def test_delta_checks_base():
+    delta = make_delta("a\n", "b\n")
+
+    with pytest.raises(ValueError):
+        apply_delta("c\n", delta)
+
+
+@pytest.mark.parametrize('snapshot_interval', (1, 3, 10))
+def test_every_version_is_rebuilt(storage, snapshot_interval):
+    store = RevisionStore(storage, snapshot_interval)
+    versions = [f"line {i}\n" * 5 + f"edit {i}\n" for i in range(8)]
+    edit(store, storage, "Sega", versions)
+
+    revisions = store.list("Sega")
+
+    assert len(revisions) == 7
+    for revision, expected in zip(revisions, reversed(versions[:-1])):
+        assert store.content("Sega", revision.name,
+                             current(storage, "Sega")) == expected
+
+
+def test_snapshot_interval_bounds_delta_chains(storage):
+    store = RevisionStore(storage, snapshot_interval=3)
+    edit(store, storage, "Sega", [f"v{i}" for i in range(7)])
+
+    kinds = [r.is_delta for r in reversed(store.list("Sega"))]
+
+    assert kinds == [True, True, False, True, True, False]
+
+
+def test_legacy_revisions_are_read(storage):
+    store = RevisionStore(storage)
+    storage.put("history/Sega-20230101000000-old_user.txt", b"legacy")
+    storage.put("history/Sega-Genesis-20230102000000-other.txt", b"other")
+    edit(store, storage, "Sega", ["v1", "v2"])
+
+    revisions = store.list("Sega")
+
+    assert [r.username for r in revisions] == ["user", "old_user"]
+    assert store.content("Sega", revisions[1].name,
+                         current(storage, "Sega")) == "legacy"
+
+
+def test_other_pages_are_not_listed(storage):
+    store = RevisionStore(storage)
+    edit(store, storage, "Foo", ["a", "b"])
+    edit(store, storage, "FooBar", ["c", "d"])
+
+    assert len(store.list("Foo")) == 1
+
+
+def test_unknown_revision(storage):
+    store = RevisionStore(storage)
+
+    with pytest.raises(ValueError):
+        store.content("Sega", "history/Sega/missing.txt", lambda: "")
+    with pytest.raises(ValueError):
+        store.find("Sega", "history/Sega/missing.txt")
+
+
+def test_record_copy(storage):
+    store = RevisionStore(storage, snapshot_interval=10)
+    edit(store, storage, "Sega", ["v1", "v2"])
+    info = storage.stat("Sega")
+
+    revision = store.record_copy("Sega", info, "admin")
+
+    assert not revision.is_delta
+    assert store.find("Sega", revision.name) == revision
+    assert storage.get(revision.name) == b"v2"
+    # the older delta is now rebuilt on top of the copy
+    storage.put("Sega", b"v3")
+    assert store.content("Sega",
+                         store.list("Sega")[1].name,
+                         current(storage, "Sega")) == "v1"
+    with pytest.raises(ConflictError):
+        store.record_copy("Sega", info, "admin")
+
+
+def test_manifest_lists_without_scanning(storage):
+    store = RevisionStore(storage)
+    edit(store, storage, "Sega", ["v1", "v2", "v3"])
+
+    with patch.object(storage, "list") as mock_list:
+        revisions = store.list("Sega")
+        latest = store.latest("Sega")
+
+    mock_list.assert_not_called()
+    assert latest == revisions[0]
+    assert [r.size > 0 for r in revisions] == [True, True]
+
+
+def test_latest_only_reads_the_tail(storage):
+    store = RevisionStore(storage)
+    edit(store, storage, "Sega", [f"v{i}" for i in range(5)])
+
+    with patch.object(storage, "get_with_info") as mock_get:
+        revision, content = store.latest_content("Sega",
+                                                 current(storage, "Sega"))
+
+    mock_get.assert_not_called()
+    assert content == "v3"
+    assert revision.username == "user"
+
+
+def test_list_is_paginated(storage):
+    store = RevisionStore(storage)
+    edit(store, storage, "Sega", [f"v{i}" for i in range(6)])
+    everything = store.list("Sega")
+
+    assert store.list("Sega", 0, 2) == everything[:2]
+    assert store.list("Sega", 2, 2) == everything[2:4]
+    assert store.list("Sega", 4, 10) == everything[4:]
+    assert store.list("Sega", 10, 2) == []
+
+
+def test_migrate_builds_manifest_from_blobs(storage):
+    storage.put("history/Sega-20230101000000-old_user.txt", b"legacy")
+    storage.put("history/Sega-20230102000000-other_user.txt", b"newer")
+    store = RevisionStore(storage)
+
+    revisions = store.migrate("Sega")
+
+    assert [r.username for r in revisions] == ["old_user", "other_user"]
+    assert storage.exists("history/Sega/manifest.jsonl")
+    assert store.latest("Sega").username == "other_user"
+
+
+def test_page_without_history(storage):
+    store = RevisionStore(storage)
+
+    with patch.object(storage, "put") as mock_put:
+        assert store.latest("Sega") is None
+        assert store.latest_content("Sega", lambda: "") == (None, None)
+        assert store.list("Sega") == []
+
+    mock_put.assert_not_called()
+
+
+def test_legacy_history_migrated_on_next_record(storage):
+    storage.put("history/Sega-20230101000000-old_user.txt", b"legacy")
+    storage.put("Sega", b"v1")
+    store = RevisionStore(storage)
+
+    with patch.object(storage, "put") as mock_put:
+        assert store.latest("Sega").username == "old_user"
+        assert [r.username for r in store.list("Sega")] == ["old_user"]
+    mock_put.assert_not_called()
+
+    store.record("Sega", "v1", "v2", "user")
+
+    assert storage.exists("history/Sega/manifest.jsonl")
+    assert [r.username for r in store.list("Sega")] == ["user", "old_user"]
+
+
+def test_record_retries_on_concurrent_append(storage):
+    store = RevisionStore(storage)
+    edit(store, storage, "Sega", ["v1", "v2"])
+    original_store = store._store
+    calls = []
+
+    def record_concurrently(*args):
+        revision = original_store(*args)
+        if not calls:
+            calls.append(revision)
+            # another worker appends to the manifest before we do
+            other = RevisionStore(storage)
+            other.record("Sega", "v2", "v3", "other_user")
+        return revision
+
+    with patch.object(store, "_store", side_effect=record_concurrently):
+        store.record("Sega", "v3", "v4", "user")
+
+    assert [r.username for r in store.list("Sega")
+           ] == ["user", "other_user", "user"]
+    assert not storage.exists(calls[0].name)
+
+
+def test_discard_newest_revision(storage):
+    store = RevisionStore(storage)
+    edit(store, storage, "Sega", ["v0", "v1"])
+    older = store.list("Sega")[0]
+    revision = store.record("Sega", "v1", "v2", "user")
+
+    store.discard("Sega", revision)
+    store.discard("Sega", revision)
+
+    assert store.list("Sega") == [older]
+    assert not storage.exists(revision.name)
+
+
+def test_discard_revision_followed_by_others(storage):
+    store = RevisionStore(storage)
+    edit(store, storage, "Sega", ["v0", "v1"])
+    # the content write of this edit fails, while another one succeeds
+    failed = store.record("Sega", "v1", "broken", "user")
+    store.record("Sega", "v1", "v2", "other_user")
+    storage.put("Sega", "v2")
+
+    store.discard("Sega", failed)
+
+    revisions = store.list("Sega")
+    assert failed not in revisions
+    assert not storage.exists(failed.name)
+    assert [store.content("Sega", r.name, current(storage, "Sega"))
+            for r in revisions] == ["v1", "v0"]
@@ -0,0 +1,245 @@
+"""Full-text search over the wiki pages.
+
+SearchIndex keeps an inverted index: for every term, the pages containing it
+and how often (its postings list), plus the length of every page. Queries
+are ranked with BM25, so they only touch the postings of the query terms
+and never read the pages themselves.
+
+The index is split into shards by a hash of the page name, each stored as a
+zlib-compressed JSON object 'indexes/search/{shard}.json.z', where the pages
+of the shard are numbered in 'docs' and each postings list is a flat [page
+number, term frequency, ...] array. Indexing a page only rewrites its own
+shard, so saves write a fraction of the index and concurrent saves of pages
+in other shards never conflict. Every process keeps the decoded shards in
+memory and only checks their stored generations every max_age seconds, so
+most queries take well under a millisecond. Edits update a shard with a
+conditional write, the same way PageIndex does, and rebuild() recreates
+every shard from every page (which also replaces the single
+'indexes/search.json.z' object older versions kept).
+"""
+
+from collections import Counter, defaultdict
+from flaskr.storage import ConflictError
+import heapq
+import json
+import math
+import re
+import threading
+import time
+import zlib
+
+# BM25 parameters: term frequency saturation and length normalization.
+K1 = 1.2
+B = 0.75
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Returns the lowercase words of text, in order."""
+    return _TOKEN.findall(text.lower())
+
+
+class _Index:
+    """One decoded shard: page lengths and term -> {page: frequency}."""
+
+    def __init__(self):
+        self.docs = {}
+        self.postings = {}
+        # page -> {term: frequency}, so a page is removed without looking
+        # at the postings of the terms it does not contain
+        self.terms = {}
+        self.length = 0
+
+    @classmethod
+    def decode(cls, data):
+        payload = json.loads(zlib.decompress(data))
+        index = cls()
+        names = [name for name, _ in payload['docs']]
+        index.docs = dict(payload['docs'])
+        index.terms = {name: {} for name in names}
+        index.length = sum(index.docs.values())
+        for term, flat in payload['postings'].items():
+            pages = {}
+            for i in range(0, len(flat), 2):
+                name = names[flat[i]]
+                pages[name] = index.terms[name][term] = flat[i + 1]
+            index.postings[term] = pages
+        return index
+
+    def encode(self):
+        numbers = {name: i for i, name in enumerate(self.docs)}
+        postings = {}
+        for term, pages in self.postings.items():
+            flat = []
+            for name, frequency in pages.items():
+                flat += [numbers[name], frequency]
+            postings[term] = flat
+        payload = {'docs': list(self.docs.items()), 'postings': postings}
+        return zlib.compress(
+            json.dumps(payload, separators=(',', ':')).encode())
+
+    def remove(self, name):
+        """Drops a page, returning False if it was not indexed."""
+        if name not in self.docs:
+            return False
+        self.length -= self.docs.pop(name)
+        for term in self.terms.pop(name):
+            pages = self.postings[term]
+            del pages[name]
+            if not pages:
+                del self.postings[term]
+        return True
+
+    def add(self, name, text):
+        """Indexes a page, returning False if it is indexed as it is."""
+        terms = tokenize(text)
+        frequencies = dict(Counter(terms))
+        if self.terms.get(name) == frequencies:
+            return False
+        self.remove(name)
+        self.docs[name] = len(terms)
+        self.terms[name] = frequencies
+        self.length += len(terms)
+        for term, frequency in frequencies.items():
+            self.postings.setdefault(term, {})[name] = frequency
+        return True
+
+
+class SearchIndex:
+
+    SHARD_NAME = 'indexes/search/{}.json.z'
+    # the single object older versions kept the whole index in
+    LEGACY_OBJECT_NAME = 'indexes/search.json.z'
+    # how many times a conditional update is retried on concurrent writes
+    MAX_RETRIES = 5
+
+    def __init__(self, storage, max_age=5, clock=time.monotonic, shards=16):
+        """Constructs a SearchIndex kept in the given storage engine.
+
+        Args:
+            storage: the Storage engine holding the wiki content
+            max_age: seconds the in-memory copy is used before checking
+                whether the stored index changed
+            clock: function returning the current time in seconds
+            shards: number of objects the index is split into; changing it
+                requires rebuilding the index
+        """
+        self.storage = storage
+        self.max_age = max_age
+        self.clock = clock
+        self.shards = shards
+        # [(generation, _Index)] per shard, and when they were last checked
+        self._cached = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def _shard(self, name):
+        # crc32 rather than hash(), which differs between processes
+        return zlib.crc32(name.encode()) % self.shards
+
+    def _load(self, shard):
+        """Reads a stored shard, returning (_Index, generation)."""
+        data, info = self.storage.get_with_info(self.SHARD_NAME.format(shard))
+        if data is None:
+            return _Index(), 0
+        return _Index.decode(data), info.generation
+
+    def _current(self):
+        """Returns the in-memory shards, refreshing those that changed."""
+        with self._lock:
+            now = self.clock()
+            if self._cached is not None and now - self._checked < self.max_age:
+                return [index for _, index in self._cached]
+            cached = self._cached or [(None, None)] * self.shards
+            shards = []
+            for shard, (generation, index) in enumerate(cached):
+                info = self.storage.stat(self.SHARD_NAME.format(shard))
+                stored = 0 if info is None else info.generation
+                if index is None or stored != generation:
+                    index, stored = self._load(shard)
+                shards.append((stored, index))
+            self._cached = shards
+            self._checked = now
+            return [index for _, index in shards]
+
+    def _update(self, shard, change):
+        """Applies change(_Index) to a stored shard with retries.
+
+        Nothing is written if change returns False.
+        """
+        for _ in range(self.MAX_RETRIES):
+            index, generation = self._load(shard)
+            if not change(index):
+                return
+            try:
+                generation = self.storage.put(self.SHARD_NAME.format(shard),
+                                              index.encode(),
+                                              if_generation_match=generation)
+            except ConflictError:
+                # someone else updated the shard first, retry on their copy
+                continue
+            with self._lock:
+                if self._cached is not None:
+                    # without the new generation, the next check reloads it
+                    self._cached = list(self._cached)
+                    self._cached[shard] = (generation, index)
+            return
+        raise ConflictError('Unable to update the search index')
+
+    def add(self, name, text):
+        """Indexes (or re-indexes) a page with its current text."""
+        self._update(self._shard(name), lambda index: index.add(name, text))
+
+    def add_many(self, pages):
+        """Indexes several (name, text) pages with one write per shard."""
+        shards = defaultdict(list)
+        for name, text in pages:
+            shards[self._shard(name)].append((name, text))
+        for shard, texts in shards.items():
+            self._update(
+                shard, lambda index, texts=texts: any(
+                    [index.add(name, text) for name, text in texts]))
+
+    def remove(self, name):
+        """Drops a page from the index."""
+        self._update(self._shard(name), lambda index: index.remove(name))
+
+    def rebuild(self, pages):
+        """Recreates the index from (name, text) pairs.
+
+        Returns the number of pages indexed.
+        """
+        shards = [_Index() for _ in range(self.shards)]
+        for name, text in pages:
+            shards[self._shard(name)].add(name, text)
+        for shard, index in enumerate(shards):
+            self.storage.put(self.SHARD_NAME.format(shard), index.encode())
+        self.storage.delete(self.LEGACY_OBJECT_NAME)
+        with self._lock:
+            self._cached = None
+        return sum(len(index.docs) for index in shards)
+
+    def search(self, query, limit=20):
+        """Returns up to limit (page name, score) pairs, best match first."""
+        shards = self._current()
+        total = sum(len(index.docs) for index in shards)
+        if not total:
+            return []
+        average = sum(index.length for index in shards) / total or 1
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            matches = [(index, index.postings[term]) for index in shards
+                       if term in index.postings]
+            if not matches:
+                continue
+            found = sum(len(pages) for _, pages in matches)
+            idf = math.log(1 + (total - found + 0.5) / (found + 0.5))
+            for index, pages in matches:
+                for name, frequency in pages.items():
+                    norm = K1 * (1 - B + B * index.docs[name] / average)
+                    scores[name] += (idf * frequency * (K1 + 1) /
+                                     (frequency + norm))
+        return heapq.nsmallest(limit,
+                               scores.items(),
+                               key=lambda item: (-item[1], item[0]))
@@ -0,0 +1,123 @@
+from flaskr.search import SearchIndex, tokenize
+from flaskr.storage import ConflictError, LocalStorage
+from unittest.mock import ANY, MagicMock
+import pytest
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(str(tmp_path))
+
+
+@pytest.fixture
+def index(storage):
+    return SearchIndex(storage, max_age=0)
+
+
+def test_tokenize():
+    assert tokenize("Sonic the Hedgehog, 1991!") == [
+        "sonic", "the", "hedgehog", "1991"
+    ]
+
+
+def test_search_ranks_with_bm25(index):
+    index.add("Sega", "Sega made the Genesis. Sega made the Dreamcast.")
+    index.add("Nintendo", "Nintendo made the NES and the SNES.")
+    index.add("Sonic", "Sonic is Sega's mascot on the Genesis.")
+
+    results = index.search("sega genesis")
+
+    assert [name for name, _ in results] == ["Sega", "Sonic"]
+    assert results[0][1] > results[1][1] > 0
+    assert index.search("playstation") == []
+    assert len(index.search("made the", limit=1)) == 1
+
+
+def test_add_replaces_and_remove_drops(index):
+    index.add("Sega", "Genesis")
+    index.add("Sega", "Dreamcast")
+
+    assert index.search("genesis") == []
+    assert [name for name, _ in index.search("dreamcast")] == ["Sega"]
+
+    index.remove("Sega")
+    assert index.search("dreamcast") == []
+
+
+def test_index_is_shared_through_storage(storage, index):
+    index.add("Sega", "Genesis")
+    other = SearchIndex(storage, max_age=0)
+
+    assert [name for name, _ in other.search("genesis")] == ["Sega"]
+    other.add("Nintendo", "Genesis clone")
+    assert len(index.search("genesis")) == 2
+
+
+def test_search_reuses_fresh_copy(storage):
+    clock = MagicMock(return_value=0)
+    index = SearchIndex(storage, max_age=5, clock=clock)
+    SearchIndex(storage).add("Sega", "Genesis")
+    index.search("genesis")
+    storage.stat = MagicMock(wraps=storage.stat)
+
+    index.search("genesis")
+    storage.stat.assert_not_called()
+    clock.return_value = 10
+    index.search("genesis")
+    assert storage.stat.call_count == index.shards
+
+
+def test_search_reloads_only_changed_shards(storage, index):
+    index.add("Sega", "Genesis")
+    index.search("genesis")
+    SearchIndex(storage).add("Nintendo", "NES")
+    storage.get_with_info = MagicMock(wraps=storage.get_with_info)
+
+    index.search("genesis")
+
+    shard = SearchIndex.SHARD_NAME.format(index._shard("Nintendo"))
+    storage.get_with_info.assert_called_once_with(shard)
+
+
+def test_add_writes_only_changed_shard(storage, index):
+    index.add("Sega", "Genesis")
+    storage.put = MagicMock(wraps=storage.put)
+
+    index.add("Sega", "Genesis!")
+    storage.put.assert_not_called()
+    index.add("Sega", "Dreamcast")
+    storage.put.assert_called_once_with(
+        SearchIndex.SHARD_NAME.format(index._shard("Sega")), ANY,
+        if_generation_match=ANY)
+
+
+def test_add_retries_on_conflict(storage):
+    # a single shard, so both workers write the same object
+    index = SearchIndex(storage, max_age=0, shards=1)
+    index.add("Sega", "Genesis")
+    put = storage.put
+    calls = []
+
+    def put_once_conflicting(name, data, if_generation_match=None):
+        if not calls:
+            calls.append(name)
+            # another worker indexes a page in the meantime
+            SearchIndex(storage, shards=1).add("Nintendo", "NES")
+        return put(name, data, if_generation_match)
+
+    storage.put = put_once_conflicting
+    index.add("Sonic", "Genesis")
+
+    assert sorted(name for name, _ in index.search("genesis nes")) == [
+        "Nintendo", "Sega", "Sonic"
+    ]
+
+
+def test_rebuild(storage, index):
+    index.add("Old", "stale")
+    storage.put(SearchIndex.LEGACY_OBJECT_NAME, b"")
+
+    assert index.rebuild([("Sega", "Genesis"), ("Nintendo", "NES")]) == 2
+    assert not storage.exists(SearchIndex.LEGACY_OBJECT_NAME)
+    assert index.search("stale") == []
+    assert [name for name, _ in index.search("nes")] == ["Nintendo"]
@@ -0,0 +1,127 @@
+"""Short-lived URLs that let clients read and write storage directly.
+
+With SIGNED_URLS enabled, image requests are redirected to a signed URL and
+uploads go straight to a signed upload URL, so the bytes never pass through
+the Python workers. Two signers are available:
+
+GcsSigner uses V4 signed URLs for downloads and resumable upload sessions
+for uploads (the client may resume an interrupted upload with the same URL).
+
+LocalSigner is a stand-in for offline runs and tests. It signs URLs with an
+HMAC of the app's SECRET_KEY and serves them from the endpoint below:
+
+URI                 | Method | Description
+--------------------|--------|-------------
+/_storage/<name>    | GET    | Returns the object if the signature is valid
+/_storage/<name>    | PUT    | Stores the request body if the signature is valid
+"""
+
+from datetime import timedelta
+from flask import Response, abort, request, url_for
+from flaskr.storage import ConflictError
+import hashlib
+import hmac
+import mimetypes
+import time
+
+
+class GcsSigner:
+
+    def __init__(self, storage):
+        """Constructs a signer for the bucket of a GcsStorage."""
+        self.storage = storage
+
+    def download_url(self, name, expires_in, generation=None):
+        """Returns a URL that reads name for expires_in seconds."""
+        blob = self.storage.bucket.blob(name, generation=generation)
+        return blob.generate_signed_url(version='v4',
+                                        expiration=timedelta(seconds=expires_in),
+                                        method='GET')
+
+    def upload_url(self, name, content_type, expires_in):
+        """Returns (url, method) the client can upload the new object with.
+
+        The resumable session only creates the object if it does not exist
+        yet, so an upload cannot replace an existing page. GCS keeps sessions
+        open for a week regardless of expires_in.
+        """
+        blob = self.storage.bucket.blob(name)
+        url = blob.create_resumable_upload_session(
+            content_type=content_type,
+            origin=request.host_url.rstrip('/'),
+            if_generation_match=0)
+        return url, 'PUT'
+
+
+class LocalSigner:
+
+    def __init__(self, storage, secret_key):
+        """Constructs a signer serving a LocalStorage through /_storage."""
+        self.storage = storage
+        self.secret_key = secret_key.encode()
+
+    def _signature(self, method, name, expires):
+        message = f'{method}\n{name}\n{expires}'.encode()
+        return hmac.new(self.secret_key, message, hashlib.sha256).hexdigest()
+
+    def _url(self, method, name, expires_in):
+        expires = int(time.time()) + expires_in
+        return url_for('local_storage',
+                       name=name,
+                       expires=expires,
+                       signature=self._signature(method, name, expires),
+                       _external=True)
+
+    def download_url(self, name, expires_in, generation=None):
+        return self._url('GET', name, expires_in)
+
+    def upload_url(self, name, content_type, expires_in):
+        return self._url('PUT', name, expires_in), 'PUT'
+
+    def verify(self, method, name, expires, signature):
+        """Returns True if the signature is valid and has not expired."""
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+        expected = self._signature(method, name, int(expires))
+        return hmac.compare_digest(expected, signature)
+
+
+def signer_from_config(config, content_storage):
+    """Returns the signer for the configured engine, or None if disabled."""
+    if not config.get('SIGNED_URLS'):
+        return None
+    if config.get('STORAGE_ENGINE', 'gcs') == 'gcs':
+        return GcsSigner(content_storage)
+    return LocalSigner(content_storage, config['SECRET_KEY'])
+
+
+def make_endpoints(app, signer):
+    """Creates the endpoint serving the URLs signed by a LocalSigner.
+
+    Args:
+        app: an instance of the Flask app
+        signer: the LocalSigner whose URLs should be served
+    """
+
+    @app.route('/_storage/<path:name>', methods=['GET', 'PUT'])
+    def local_storage(name):
+        # HEAD requests are answered like the GET they were signed for
+        method = 'GET' if request.method == 'HEAD' else request.method
+        if not signer.verify(method, name,
+                             request.args.get('expires', ''),
+                             request.args.get('signature', '')):
+            abort(403)
+        if request.method == 'PUT':
+            try:
+                signer.storage.put(name,
+                                   request.stream,
+                                   if_generation_match=0)
+            except ConflictError as ce:
+                return str(ce), 409
+            return '', 200
+        data = signer.storage.get(name)
+        if data is None:
+            abort(404)
+        return Response(data,
+                        mimetype=mimetypes.guess_type(name)[0] or
+                        'application/octet-stream')
@@ -0,0 +1,121 @@
+from flaskr import create_app
+from flaskr.signing import GcsSigner, LocalSigner
+from flaskr.storage import LocalStorage
+from unittest.mock import MagicMock, patch
+from urllib.parse import urlsplit
+import pytest
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'LOGIN_DISABLED': True,
+        'STORAGE_ENGINE': 'local',
+        'STORAGE_ROOT': str(tmp_path),
+        'SIGNED_URLS': True,
+    })
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def content_storage(tmp_path):
+    return LocalStorage(str(tmp_path / "thewikicontent"))
+
+
+def path_of(url):
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}"
+
+
+def test_image_redirects_to_signed_url(client, content_storage):
+    content_storage.put("cami.jpg", b"image bytes")
+
+    resp = client.get("/images/cami.jpg")
+
+    assert resp.status_code == 302
+    assert "/_storage/cami.jpg" in resp.location
+    image = client.get(path_of(resp.location))
+    assert image.status_code == 200
+    assert image.data == b"image bytes"
+    assert image.mimetype == "image/jpeg"
+
+
+def test_tampered_url_is_rejected(client, content_storage):
+    content_storage.put("cami.jpg", b"image bytes")
+    url = path_of(client.get("/images/cami.jpg").location)
+
+    assert client.get(url.replace("cami.jpg", "other.jpg")).status_code == 403
+    assert client.put(url, data=b"overwrite").status_code == 403
+
+
+def test_expired_url_is_rejected(client, content_storage):
+    content_storage.put("cami.jpg", b"image bytes")
+    url = path_of(client.get("/images/cami.jpg").location)
+
+    with patch("flaskr.signing.time.time", return_value=2**40):
+        assert client.get(url).status_code == 403
+
+
+def test_direct_upload(client, content_storage):
+    resp = client.post("/upload/url",
+                       data={
+                           "wikiname": "Sega",
+                           "content_type": "text/plain"
+                       })
+    assert resp.status_code == 200
+    assert resp.json["method"] == "PUT"
+    upload_url = path_of(resp.json["url"])
+
+    assert client.put(upload_url, data=b"Sega info").status_code == 200
+    assert client.put(upload_url, data=b"Sega info").status_code == 409
+    complete = client.post("/upload/complete", data={"wikiname": "Sega"})
+
+    assert complete.status_code == 302
+    assert content_storage.get("Sega") == b"Sega info"
+    assert b"Sega" in client.get("/pages").data
+
+
+def test_upload_url_for_existing_page(client, content_storage):
+    content_storage.put("Sega", b"Sega info")
+
+    resp = client.post("/upload/url", data={"wikiname": "Sega"})
+
+    assert resp.status_code == 409
+    assert "already exists" in resp.json["error"]
+
+
+def test_complete_before_upload(client):
+    resp = client.post("/upload/complete", data={"wikiname": "Sega"})
+
+    assert b"Upload Failed!" in resp.data
+
+
+def test_upload_page_uses_direct_upload(client):
+    assert b"upload/url" in client.get("/upload").data
+
+
+def test_local_signer_verify(tmp_path):
+    signer = LocalSigner(LocalStorage(str(tmp_path)), "secret")
+    expires = "9999999999"
+    signature = signer._signature("GET", "page", 9999999999)
+
+    assert signer.verify("GET", "page", expires, signature)
+    assert not signer.verify("PUT", "page", expires, signature)
+    assert not signer.verify("GET", "page", "not a number", signature)
+
+
+def test_gcs_signer():
+    storage = MagicMock()
+    blob = storage.bucket.blob.return_value
+    blob.generate_signed_url.return_value = "https://signed"
+    signer = GcsSigner(storage)
+
+    assert signer.download_url("cami.jpg", 60) == "https://signed"
+    storage.bucket.blob.assert_called_with("cami.jpg", generation=None)
+    assert blob.generate_signed_url.call_args.kwargs["method"] == "GET"
@@ -0,0 +1,510 @@
+"""Storage engines used by the Backend.
+
+The Backend never talks to a bucket directly. It goes through one of the
+engines below, which all expose the same small set of operations on named
+objects:
+
+Method              | Description
+--------------------|-------------
+get(name)           | Returns the bytes stored under name, or None
+get_with_info(name) | Returns (bytes, ObjectInfo), or (None, None)
+get_range(name, ..) | Returns a byte range of the object, or None
+stat(name)          | Returns the ObjectInfo for name, or None
+open(name)          | Returns a seekable binary file to read the object from
+put(name, data)     | Stores data (bytes, str or a readable file object)
+                    | under name, optionally only if the stored
+                    | generation still matches, and returns the new
+                    | generation
+compose(name, srcs) | Stores the concatenation of other objects under name
+copy(src, dst)      | Copies an object (optionally a given generation of it)
+list(prefix)        | Yields the names starting with prefix in sorted order
+exists(name)        | Returns True if an object is stored under name
+delete(name)        | Removes the object, ignoring missing names
+
+GcsStorage wraps a Google Cloud Storage bucket and is what we run in
+production. LocalStorage keeps every object as a file on local disk so the
+whole wiki can be served (and benchmarked) without any network round-trips.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timezone
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google.api_core.exceptions import RequestRangeNotSatisfiable
+from google.cloud import storage
+from urllib.parse import quote, unquote
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Default bucket names used by the wiki.
+USER_BUCKET_NAME = 'theuserspasswords'
+CONTENT_BUCKET_NAME = 'thewikicontent'
+
+# Size of the chunks GcsStorage.open() downloads at a time.
+READ_CHUNK_SIZE = 256 * 1024
+# Size of the chunks file objects are copied into storage with. GCS requires
+# resumable upload chunks to be a multiple of 256 KiB.
+WRITE_CHUNK_SIZE = 1024 * 1024
+# Maximum number of source objects GCS can compose in one request.
+MAX_COMPOSE_SOURCES = 32
+
+# Metadata about a stored object. The generation changes every time the
+# object is rewritten, so it can be used to detect stale copies.
+ObjectInfo = namedtuple('ObjectInfo',
+                        ['name', 'size', 'generation', 'updated', 'content_type'])
+
+
+class ConflictError(ValueError):
+    """Raised when a conditional write finds a different generation stored."""
+
+
+class Storage:
+    """Interface shared by all storage engines.
+
+    Every engine stores opaque bytes under string names. Names may contain
+    '/' to group objects (e.g. 'history/...'), just like bucket object names.
+    """
+
+    def get(self, name):
+        """Returns the bytes stored under name, or None if there are none."""
+        raise NotImplementedError
+
+    def get_with_info(self, name):
+        """Returns (bytes, ObjectInfo) for name, or (None, None)."""
+        raise NotImplementedError
+
+    def get_range(self, name, start, end=None):
+        """Returns bytes start:end of the object, or None if it is missing.
+
+        Like slicing, end is exclusive and a negative start with no end
+        returns the last -start bytes, so small tails can be read without
+        downloading the whole object.
+        """
+        raise NotImplementedError
+
+    def stat(self, name):
+        """Returns the ObjectInfo for name without reading its data."""
+        raise NotImplementedError
+
+    def open(self, name, generation=None):
+        """Returns a seekable binary file object to read name from.
+
+        Data is fetched lazily as it is read, so large objects can be
+        streamed. If generation is given, engines that keep old generations
+        read that one.
+        """
+        raise NotImplementedError
+
+    def put(self, name, data, if_generation_match=None):
+        """Stores data under name, replacing any previous object.
+
+        If data is a file object, it is copied in WRITE_CHUNK_SIZE chunks so
+        it never has to fit in memory; if reading it fails, nothing is
+        stored. If if_generation_match is given, the
+        write only happens if the stored object still has that generation (0
+        meaning no object may exist yet), otherwise ConflictError is raised.
+
+        Returns the generation of the new object, or None if the engine
+        cannot tell without another request.
+        """
+        raise NotImplementedError
+
+    def compose(self, name, sources, if_generation_match=None):
+        """Stores the concatenation of the source objects under name.
+
+        The data is combined inside the storage engine, without passing
+        through the app. if_generation_match works like in put().
+        """
+        raise NotImplementedError
+
+    def copy(self, source, destination, source_generation=None,
+             if_generation_match=None):
+        """Copies an object inside the storage engine.
+
+        If source_generation is given and the source no longer has that
+        generation, ConflictError is raised. if_generation_match applies to
+        the destination and works like in put().
+
+        Returns the generation of the new object.
+        """
+        raise NotImplementedError
+
+    def list(self, prefix=None):
+        """Yields every object name starting with prefix, in sorted order."""
+        raise NotImplementedError
+
+    def exists(self, name):
+        """Returns True if an object is stored under name."""
+        raise NotImplementedError
+
+    def delete(self, name):
+        """Removes the object stored under name if there is one."""
+        raise NotImplementedError
+
+
+def _to_bytes(data):
+    if isinstance(data, str):
+        return data.encode()
+    return data
+
+
+class GcsStorage(Storage):
+    """Storage engine backed by a Google Cloud Storage bucket.
+
+    If no client is passed in, one is only constructed the first time the
+    bucket is used, so creating the app does not pay for it.
+    """
+
+    def __init__(self, bucket_name, client=None):
+        self.bucket_name = bucket_name
+        self._bucket = None
+        if client is not None:
+            self._bucket = client.bucket(bucket_name)
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = storage.Client().bucket(self.bucket_name)
+        return self._bucket
+
+    def get(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
+        with blob.open('rb') as b:
+            return b.read()
+
+    def get_with_info(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None, None
+        # the blob returned by get_blob pins its generation, so the data read
+        # below always matches the metadata we return with it
+        with blob.open('rb') as b:
+            return b.read(), self._info(blob)
+
+    def get_range(self, name, start, end=None):
+        # GCS ranges are inclusive, and checksums only cover whole objects
+        try:
+            return self.bucket.blob(name).download_as_bytes(
+                start=start,
+                end=None if end is None else end - 1,
+                checksum=None)
+        except NotFound:
+            return None
+        except RequestRangeNotSatisfiable:
+            return b''
+
+    def stat(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
+        return self._info(blob)
+
+    def open(self, name, generation=None):
+        blob = self.bucket.blob(name, generation=generation)
+        return blob.open('rb', chunk_size=READ_CHUNK_SIZE)
+
+    @staticmethod
+    def _info(blob):
+        return ObjectInfo(blob.name, blob.size, blob.generation, blob.updated,
+                          blob.content_type)
+
+    def put(self, name, data, if_generation_match=None):
+        blob = self.bucket.blob(name)
+        kwargs = {}
+        if if_generation_match is not None:
+            kwargs['if_generation_match'] = if_generation_match
+        try:
+            if hasattr(data, 'read'):
+                # the writer sends each chunk as part of a resumable upload
+                writer = blob.open('wb', chunk_size=WRITE_CHUNK_SIZE,
+                                   **kwargs)
+                try:
+                    shutil.copyfileobj(data, writer, WRITE_CHUNK_SIZE)
+                except BaseException:
+                    # closing the writer would finalize the object with the
+                    # data read so far; closing its buffer first makes it
+                    # skip that, and GCS drops the unfinished session
+                    writer._buffer.close()
+                    raise
+                writer.close()
+                return None
+            # a single request, where open('wb') starts a resumable upload
+            # session and then sends the data; the response holds the new
+            # object's metadata
+            blob.upload_from_string(_to_bytes(data), **kwargs)
+            return blob.generation
+        except PreconditionFailed as pf:
+            raise ConflictError(f'{name} was modified concurrently') from pf
+
+    def compose(self, name, sources, if_generation_match=None):
+        sources = [self.bucket.blob(source) for source in sources]
+        intermediates = []
+        # GCS composes at most 32 objects at once, so larger uploads are
+        # combined in rounds through intermediate objects
+        while len(sources) > MAX_COMPOSE_SOURCES:
+            combined = []
+            for i in range(0, len(sources), MAX_COMPOSE_SOURCES):
+                blob = self.bucket.blob(
+                    f'{name}.compose-{len(intermediates)}')
+                blob.compose(sources[i:i + MAX_COMPOSE_SOURCES])
+                intermediates.append(blob)
+                combined.append(blob)
+            sources = combined
+        try:
+            self.bucket.blob(name).compose(
+                sources, if_generation_match=if_generation_match)
+        except PreconditionFailed as pf:
+            raise ConflictError(f'{name} was modified concurrently') from pf
+        finally:
+            for blob in intermediates:
+                blob.delete()
+
+    def copy(self, source, destination, source_generation=None,
+             if_generation_match=None):
+        kwargs = {}
+        if if_generation_match is not None:
+            kwargs['if_generation_match'] = if_generation_match
+        try:
+            blob = self.bucket.copy_blob(self.bucket.blob(source),
+                                         self.bucket,
+                                         destination,
+                                         source_generation=source_generation,
+                                         **kwargs)
+        except (NotFound, PreconditionFailed) as e:
+            if source_generation is None and isinstance(e, NotFound):
+                raise
+            raise ConflictError(
+                f'{source} or {destination} was modified concurrently') from e
+        return blob.generation
+
+    def list(self, prefix=None):
+        for blob in self.bucket.list_blobs(prefix=prefix):
+            yield blob.name
+
+    def exists(self, name):
+        return self.bucket.blob(name).exists()
+
+    def delete(self, name):
+        try:
+            self.bucket.blob(name).delete()
+        except NotFound:
+            pass
+
+
+class LocalStorage(Storage):
+    """Storage engine that keeps every object as a file under a directory.
+
+    Object names are split on '/' into directories. Each name segment is
+    percent-encoded, and directories get a trailing '@' (which the encoding
+    never produces), so 'history' can be both a page and a prefix. Writes go
+    to a temporary file that is renamed into place, so readers never see a
+    partially written object.
+    """
+
+    _DIR_SUFFIX = '@'
+    _TMP_PREFIX = '.tmp-'
+
+    # The generation of a local object is its modification time in
+    # nanoseconds. Writes set it explicitly to a strictly increasing value so
+    # two writes never share a generation, even on coarse filesystem clocks.
+    _generation_lock = threading.Lock()
+    _last_generation = 0
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        # serializes conditional writes so check-and-replace is atomic within
+        # this process
+        self._write_lock = threading.Lock()
+
+    @staticmethod
+    def _quote(segment):
+        if segment in ('', '.', '..'):
+            return segment.replace('.', '%2E') or '%'
+        return quote(segment, safe='')
+
+    @staticmethod
+    def _unquote(segment):
+        return '' if segment == '%' else unquote(segment)
+
+    def _path(self, name):
+        segments = name.split('/')
+        dirs = [self._quote(s) + self._DIR_SUFFIX for s in segments[:-1]]
+        return os.path.join(self.root, *dirs, self._quote(segments[-1]))
+
+    @classmethod
+    def _next_generation(cls):
+        with cls._generation_lock:
+            cls._last_generation = max(time.time_ns(), cls._last_generation + 1)
+            return cls._last_generation
+
+    @staticmethod
+    def _info(name, st):
+        return ObjectInfo(
+            name, st.st_size, st.st_mtime_ns,
+            datetime.fromtimestamp(st.st_mtime_ns / 1e9, tz=timezone.utc),
+            mimetypes.guess_type(name)[0] or 'application/octet-stream')
+
+    def get(self, name):
+        try:
+            with open(self._path(name), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def get_with_info(self, name):
+        try:
+            with open(self._path(name), 'rb') as f:
+                # stat the open file so the info matches the data we read,
+                # even if the object is replaced in the meantime
+                return f.read(), self._info(name, os.fstat(f.fileno()))
+        except (FileNotFoundError, NotADirectoryError):
+            return None, None
+
+    def get_range(self, name, start, end=None):
+        try:
+            with open(self._path(name), 'rb') as f:
+                if start < 0:
+                    size = os.fstat(f.fileno()).st_size
+                    start = max(0, size + start)
+                f.seek(start)
+                return f.read(-1 if end is None else max(0, end - start))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def stat(self, name):
+        try:
+            return self._info(name, os.stat(self._path(name)))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def open(self, name, generation=None):
+        # the open file keeps reading the same data even if the object is
+        # replaced, but older generations are not kept
+        return open(self._path(name), 'rb')
+
+    def put(self, name, data, if_generation_match=None):
+        def write(f):
+            if hasattr(data, 'read'):
+                shutil.copyfileobj(data, f, WRITE_CHUNK_SIZE)
+            else:
+                f.write(_to_bytes(data))
+
+        return self._write(name, write, if_generation_match)
+
+    def compose(self, name, sources, if_generation_match=None):
+        paths = [self._path(source) for source in sources]
+
+        def write(f):
+            for path in paths:
+                with open(path, 'rb') as source:
+                    shutil.copyfileobj(source, f, WRITE_CHUNK_SIZE)
+
+        self._write(name, write, if_generation_match)
+
+    def copy(self, source, destination, source_generation=None,
+             if_generation_match=None):
+
+        def write(f):
+            try:
+                with open(self._path(source), 'rb') as s:
+                    generation = os.fstat(s.fileno()).st_mtime_ns
+                    if source_generation not in (None, generation):
+                        raise ConflictError(
+                            f'{source} was modified concurrently')
+                    shutil.copyfileobj(s, f, WRITE_CHUNK_SIZE)
+            except (FileNotFoundError, NotADirectoryError):
+                if source_generation is None:
+                    raise
+                raise ConflictError(f'{source} was modified concurrently')
+
+        return self._write(destination, write, if_generation_match)
+
+    def _write(self, name, write, if_generation_match):
+        """Writes an object through a temporary file renamed into place.
+
+        Args:
+            name: name of the object
+            write: function writing the data to the open temporary file
+            if_generation_match: generation the stored object must have
+
+        Returns:
+            the generation of the new object
+        """
+        path = self._path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=self._TMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            # the data is written before taking the lock, so conditional
+            # writes of large objects do not hold up other writers
+            with self._write_lock:
+                if if_generation_match is not None:
+                    info = self.stat(name)
+                    generation = 0 if info is None else info.generation
+                    if generation != if_generation_match:
+                        raise ConflictError(f'{name} was modified concurrently')
+                generation = self._next_generation()
+                os.utime(tmp_path, ns=(generation, generation))
+                os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return generation
+
+    def list(self, prefix=None):
+        prefix = prefix or ''
+        # Only walk the directory the prefix points into instead of the
+        # whole tree, e.g. 'history/Sega' only looks inside 'history@/'.
+        dir_segments = prefix.split('/')[:-1]
+        start = os.path.join(
+            self.root, *[self._quote(s) + self._DIR_SUFFIX for s in dir_segments])
+        base = ''.join(s + '/' for s in dir_segments)
+        names = [
+            name for name in self._walk(start, base) if name.startswith(prefix)
+        ]
+        yield from sorted(names)
+
+    def _walk(self, directory, base):
+        try:
+            entries = list(os.scandir(directory))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for entry in entries:
+            if entry.name.startswith(self._TMP_PREFIX):
+                continue
+            if entry.is_dir():
+                segment = self._unquote(entry.name[:-len(self._DIR_SUFFIX)])
+                yield from self._walk(entry.path, base + segment + '/')
+            else:
+                yield base + self._unquote(entry.name)
+
+    def exists(self, name):
+        return os.path.isfile(self._path(name))
+
+    def delete(self, name):
+        try:
+            os.unlink(self._path(name))
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+
+
+def storage_from_config(config, bucket_name):
+    """Returns the storage engine selected by the app config for a bucket.
+
+    STORAGE_ENGINE picks the engine: 'gcs' (the default) or 'local'. The
+    local engine keeps each bucket in its own directory under STORAGE_ROOT.
+    """
+    engine = config.get('STORAGE_ENGINE', 'gcs')
+    if engine == 'gcs':
+        return GcsStorage(bucket_name)
+    if engine == 'local':
+        return LocalStorage(os.path.join(config['STORAGE_ROOT'], bucket_name))
+    raise ValueError(f'Unknown storage engine: {engine}')
@@ -0,0 +1,258 @@
+from flaskr.storage import (ConflictError, GcsStorage, LocalStorage,
+                            WRITE_CHUNK_SIZE, storage_from_config)
+from google.cloud.storage.fileio import BlobWriter
+from unittest.mock import MagicMock
+import gc
+import io
+import os
+import pytest
+
+
+@pytest.fixture
+def local(tmp_path):
+    return LocalStorage(str(tmp_path))
+
+
+def test_local_put_and_get(local):
+    local.put("Sega", "Sega content")
+
+    assert local.get("Sega") == b"Sega content"
+    assert local.exists("Sega")
+
+
+def test_local_get_missing(local):
+    assert local.get("missing") is None
+    assert not local.exists("missing")
+
+
+def test_local_put_replaces(local):
+    local.put("page", b"old")
+    local.put("page", b"new")
+
+    assert local.get("page") == b"new"
+
+
+def test_local_list_sorted_with_prefix(local):
+    for name in ["b", "a", "history/a-1-x.txt", "history/b-1-y.txt", "c.png"]:
+        local.put(name, b"data")
+
+    assert list(local.list()) == [
+        "a", "b", "c.png", "history/a-1-x.txt", "history/b-1-y.txt"
+    ]
+    assert list(local.list(prefix="history/a")) == ["history/a-1-x.txt"]
+    assert list(local.list(prefix="missing/")) == []
+
+
+def test_local_name_can_be_object_and_prefix(local):
+    local.put("history", b"page")
+    local.put("history/history-1-x.txt", b"old page")
+
+    assert local.get("history") == b"page"
+    assert list(local.list()) == ["history", "history/history-1-x.txt"]
+
+
+def test_local_odd_names_stay_inside_root(local, tmp_path):
+    local.put("../escape", b"data")
+    local.put("a b%c", b"data")
+
+    assert local.get("../escape") == b"data"
+    assert sorted(local.list()) == ["../escape", "a b%c"]
+    assert not os.path.exists(tmp_path.parent / "escape")
+
+
+def test_local_delete(local):
+    local.put("page", b"data")
+
+    local.delete("page")
+    local.delete("page")
+
+    assert not local.exists("page")
+
+
+def test_local_put_leaves_no_temp_files(local, tmp_path):
+    local.put("page", b"data")
+
+    assert os.listdir(tmp_path) == ["page"]
+
+
+def test_gcs_get_reads_blob():
+    bucket = MagicMock()
+    bucket.get_blob.return_value.open.return_value.__enter__.return_value.read.return_value = b"data"
+    client = MagicMock()
+    client.bucket.return_value = bucket
+
+    gcs = GcsStorage("bucket", client)
+
+    assert gcs.get("page") == b"data"
+    client.bucket.assert_called_with("bucket")
+    bucket.get_blob.assert_called_with("page")
+
+
+def test_gcs_client_is_created_lazily(monkeypatch):
+    client_class = MagicMock()
+    monkeypatch.setattr("flaskr.storage.storage.Client", client_class)
+
+    gcs = GcsStorage("bucket")
+    client_class.assert_not_called()
+
+    gcs.exists("page")
+    client_class.assert_called_once_with()
+
+
+def test_storage_from_config(tmp_path):
+    local = storage_from_config(
+        {
+            "STORAGE_ENGINE": "local",
+            "STORAGE_ROOT": str(tmp_path)
+        }, "bucket")
+
+    assert isinstance(local, LocalStorage)
+    assert local.root == str(tmp_path / "bucket")
+    assert isinstance(storage_from_config({}, "bucket"), GcsStorage)
+    with pytest.raises(ValueError):
+        storage_from_config({"STORAGE_ENGINE": "ftp"}, "bucket")
+
+
+def test_local_stat_and_generation(local):
+    local.put("page", b"data")
+    first = local.stat("page")
+    local.put("page", b"more data")
+    data, second = local.get_with_info("page")
+
+    assert data == b"more data"
+    assert second.size == 9
+    assert second.generation > first.generation
+    assert local.stat("missing") is None
+    assert local.get_with_info("missing") == (None, None)
+
+
+def test_local_get_range(local):
+    local.put("page", b"0123456789")
+
+    assert local.get_range("page", 2, 5) == b"234"
+    assert local.get_range("page", 7) == b"789"
+    assert local.get_range("page", -3) == b"789"
+    assert local.get_range("page", -30) == b"0123456789"
+    assert local.get_range("missing", 0) is None
+
+
+def test_local_put_file_object(local):
+    local.put("page", io.BytesIO(b"x" * 3000000))
+
+    assert local.stat("page").size == 3000000
+
+
+def test_local_compose(local):
+    local.put("a", b"012")
+    local.put("b", b"345")
+
+    local.compose("ab", ["a", "b"], if_generation_match=0)
+
+    assert local.get("ab") == b"012345"
+    with pytest.raises(ConflictError):
+        local.compose("ab", ["b", "a"], if_generation_match=0)
+    assert local.get("ab") == b"012345"
+
+
+def test_gcs_put_file_object_in_chunks():
+    bucket = MagicMock()
+    client = MagicMock()
+    client.bucket.return_value = bucket
+    writer = bucket.blob.return_value.open.return_value
+
+    GcsStorage("bucket", client).put("page", io.BytesIO(b"data"),
+                                     if_generation_match=0)
+
+    bucket.blob.return_value.open.assert_called_with(
+        "wb", chunk_size=WRITE_CHUNK_SIZE, if_generation_match=0)
+    writer.write.assert_called_with(b"data")
+    writer.close.assert_called_once_with()
+
+
+def test_gcs_put_does_not_finalize_interrupted_stream():
+    bucket = MagicMock()
+    client = MagicMock()
+    client.bucket.return_value = bucket
+    blob = bucket.blob.return_value
+    blob.open.side_effect = lambda mode, chunk_size, **kwargs: BlobWriter(
+        blob, chunk_size=chunk_size, **kwargs)
+    stream = MagicMock()
+    stream.read.side_effect = [b"part of the data", ConnectionError("gone")]
+
+    with pytest.raises(ConnectionError):
+        GcsStorage("bucket", client).put("page", stream)
+
+    # nothing was sent, neither while copying nor when the writer is closed
+    # or collected
+    gc.collect()
+    blob._initiate_resumable_upload.assert_not_called()
+
+
+def test_gcs_compose_in_rounds():
+    bucket = MagicMock()
+    client = MagicMock()
+    client.bucket.return_value = bucket
+
+    GcsStorage("bucket", client).compose("page",
+                                         [f"part-{i}" for i in range(40)])
+
+    # 40 parts are combined into 2 intermediate objects, then into the page
+    assert bucket.blob.return_value.compose.call_count == 3
+    assert bucket.blob.return_value.delete.call_count == 2
+
+
+def test_local_copy(local):
+    local.put("page", b"data")
+    generation = local.stat("page").generation
+
+    local.copy("page", "history/page", generation)
+
+    assert local.get("history/page") == b"data"
+    local.put("page", b"new data")
+    with pytest.raises(ConflictError):
+        local.copy("page", "history/page2", generation)
+    with pytest.raises(ConflictError):
+        local.copy("missing", "history/page2", generation)
+    assert not local.exists("history/page2")
+
+
+def test_local_copy_if_generation_match(local):
+    local.put("history/page", b"old")
+    generation = local.put("page", b"data")
+
+    new_generation = local.copy("history/page", "page",
+                                if_generation_match=generation)
+
+    assert local.get("page") == b"old"
+    assert local.stat("page").generation == new_generation
+    with pytest.raises(ConflictError):
+        local.copy("history/page", "page", if_generation_match=generation)
+
+
+def test_gcs_copy_if_generation_match():
+    bucket = MagicMock()
+    client = MagicMock()
+    client.bucket.return_value = bucket
+    bucket.copy_blob.return_value.generation = 8
+
+    generation = GcsStorage("bucket", client).copy("history/page", "page",
+                                                   if_generation_match=7)
+
+    assert generation == 8
+    bucket.copy_blob.assert_called_once_with(bucket.blob.return_value,
+                                             bucket,
+                                             "page",
+                                             source_generation=None,
+                                             if_generation_match=7)
+
+
+def test_gcs_put_bytes_in_one_request():
+    bucket = MagicMock()
+    client = MagicMock()
+    client.bucket.return_value = bucket
+
+    GcsStorage("bucket", client).put("page", "data", if_generation_match=7)
+
+    bucket.blob.return_value.upload_from_string.assert_called_once_with(
+        b"data", if_generation_match=7)
+    bucket.blob.return_value.open.assert_not_called()
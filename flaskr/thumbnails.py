@@ -0,0 +1,90 @@
+"""Scaled down variants of the wiki images.
+
+/images/<image>?w=200 serves the image scaled down to 200 pixels wide. A
+variant is made once, with Pillow, and stored next to the originals as
+'variants/{image}/w{width}-{generation}', so it is made again when the image
+is replaced. An empty variant records that the original is served instead.
+The Backend keeps recently served variants in memory as well.
+
+Requested widths are rounded up to one of a few allowed widths, so clients
+cannot make us store a variant for every possible width. Images that are
+already narrower than the width, that Pillow cannot read, or that are
+bigger than MAX_SOURCE_BYTES or MAX_PIXELS are served as they are.
+
+Pillow is optional: without it every image is served as it is.
+"""
+
+from io import BytesIO
+import bisect
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional
+    Image = None
+
+VARIANTS_PREFIX = 'variants/'
+# Widths variants are made at, smallest first.
+DEFAULT_WIDTHS = (64, 128, 200, 400, 800, 1600)
+# Originals larger than this are not decoded to make a variant.
+MAX_SOURCE_BYTES = 20 * 1024 * 1024
+# Originals with more pixels than this are not decoded either: a small
+# compressed file can hold a huge bitmap.
+MAX_PIXELS = 25 * 1000 * 1000
+JPEG_QUALITY = 85
+
+
+def available():
+    """Returns True if variants can be made (Pillow is installed)."""
+    return Image is not None
+
+
+def snap_width(width, widths=DEFAULT_WIDTHS):
+    """Returns the smallest allowed width at least as large as width."""
+    index = bisect.bisect_left(widths, width)
+    return widths[min(index, len(widths) - 1)]
+
+
+def variant_name(name, width, generation):
+    """Returns the object name of an image's variant."""
+    return f'{VARIANTS_PREFIX}{name}/w{width}-{generation}'
+
+
+def content_type(data):
+    """Returns the content type of a stored variant."""
+    return 'image/jpeg' if data.startswith(b'\xff\xd8') else 'image/png'
+
+
+def resize(data, width):
+    """Returns (bytes, content type) of an image scaled down to width.
+
+    JPEGs stay JPEGs, anything else becomes a PNG. Returns None if the
+    image is not wider than width, has more than MAX_PIXELS pixels or
+    cannot be read.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(BytesIO(data)) as image:
+            # only the header has been read so far
+            if image.width * image.height > MAX_PIXELS:
+                return None
+            if image.width <= width:
+                return None
+            height = max(1, round(image.height * width / image.width))
+            # lets the JPEG decoder skip most of the pixels
+            image.draft('RGB', (width, height))
+            if image.format == 'JPEG':
+                image_format, content_type = 'JPEG', 'image/jpeg'
+                options = {'quality': JPEG_QUALITY, 'optimize': True}
+                image = image.convert('RGB')
+            else:
+                image_format, content_type = 'PNG', 'image/png'
+                options = {'optimize': True}
+                if image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+                    image = image.convert('RGBA')
+            image = image.resize((width, height), Image.LANCZOS)
+            out = BytesIO()
+            image.save(out, image_format, **options)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    return out.getvalue(), content_type
@@ -0,0 +1,66 @@
+from flaskr import thumbnails
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+import pytest
+
+
+def test_snap_width():
+    assert thumbnails.snap_width(1) == 64
+    assert thumbnails.snap_width(200) == 200
+    assert thumbnails.snap_width(201) == 400
+    assert thumbnails.snap_width(5000) == 1600
+    assert thumbnails.snap_width(90, (100, 300)) == 100
+
+
+def test_variant_name():
+    assert (thumbnails.variant_name("cami.jpg", 200,
+                                    17) == "variants/cami.jpg/w200-17")
+
+
+def test_content_type():
+    assert thumbnails.content_type(b"\xff\xd8\xff\xe0") == "image/jpeg"
+    assert thumbnails.content_type(b"\x89PNG\r\n") == "image/png"
+
+
+def test_resize_without_pillow():
+    with patch.object(thumbnails, "Image", None):
+        assert not thumbnails.available()
+        assert thumbnails.resize(b"\x89PNG", 64) is None
+
+
+def test_resize_refuses_too_many_pixels():
+    Image = MagicMock()
+    image = Image.open.return_value.__enter__.return_value
+    # a small file declaring a 100000 x 100000 bitmap
+    image.width = image.height = 100000
+
+    with patch.object(thumbnails, "Image", Image):
+        assert thumbnails.resize(b"\x89PNG", 200) is None
+
+    image.draft.assert_not_called()
+    image.resize.assert_not_called()
+
+
+def test_resize():
+    Image = pytest.importorskip("PIL.Image")
+    original = BytesIO()
+    Image.new("RGB", (1000, 500), "red").save(original, "JPEG")
+
+    data, content_type = thumbnails.resize(original.getvalue(), 200)
+
+    assert content_type == "image/jpeg"
+    assert len(data) < len(original.getvalue())
+    with Image.open(BytesIO(data)) as image:
+        assert image.size == (200, 100)
+    # already narrow enough, or not an image
+    assert thumbnails.resize(original.getvalue(), 1600) is None
+    assert thumbnails.resize(b"not an image", 200) is None
+
+
+def test_resize_refuses_too_many_pixels_with_pillow(monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    original = BytesIO()
+    Image.new("RGB", (1000, 500), "red").save(original, "PNG")
+    monkeypatch.setattr(thumbnails, "MAX_PIXELS", 1000 * 500 - 1)
+
+    assert thumbnails.resize(original.getvalue(), 200) is None
@@ -1,14 +1,35 @@
 """ All endpoints related to uploads are created here.
  
 Endpoints:
-URI     | Method | Description
---------|--------|-------------
-/upload | GET    | Returns the upload page
-/upload | POST   | Extracts the name/data and calls backend.upload
+URI              | Method | Description
+-----------------|--------|-------------
+/upload          | GET    | Returns the upload page
+/upload          | POST   | Extracts the name/data and calls backend.upload
+/upload/url      | POST   | Returns a signed URL to upload straight to storage
+/upload/complete | POST   | Registers a page uploaded through /upload/url
+/upload/resumable      | POST | Starts a resumable upload
+/upload/resumable/<id> | PUT  | Stores the part given by the Content-Range header
+/upload/resumable/<id> | GET  | Returns how many bytes have been received
+
+/upload/url and /upload/complete are only used when SIGNED_URLS is enabled,
+in which case the upload page sends the file to storage directly instead of
+through the app.
+
+Uploads are copied to storage in chunks, so a worker never holds a whole
+file in memory. A single request may carry at most MAX_CONTENT_LENGTH bytes;
+larger files, or uploads over unreliable connections, go through the
+resumable endpoints in parts of up to UPLOAD_CHUNK_SIZE bytes. If a part
+fails, the client asks for the offset and continues from there. The parts
+of abandoned uploads stay under 'uploads/' until `flask expire-uploads`
+deletes them; on GCS, a lifecycle rule deleting objects under that prefix
+after a day does the same without a scheduled command.
 """
 
-from flask import render_template, request, url_for, redirect
+from flask import (render_template, request, url_for, redirect, jsonify,
+                   abort)
 from flask_login import login_required
+from flaskr.storage import ConflictError
+from werkzeug.http import parse_content_range_header
 
 
 # Note: upload relies on the backend to fulfill some routes so we need to
@@ -31,7 +52,9 @@ def make_endpoints(app, backend):
         decorator.
         """
 
-        return render_template('upload.html')
+        return render_template('upload.html',
+                               direct_upload=backend.url_signer is not None,
+                               chunk_size=app.config['UPLOAD_CHUNK_SIZE'])
 
     @app.route('/upload', methods=['POST'])
     @login_required
@@ -55,9 +78,9 @@ def make_endpoints(app, backend):
                 page_name='Unable to Upload',
                 page_content='Need a file and name for the wiki page')
         try:
-            # for now, we assume that we are uploading text files so we need to
-            # take the string contents of the file and upload it to the bucket
-            backend.upload(wiki_name, wiki_content.stream.read())
+            # hand over the file object so the backend copies it to the
+            # bucket in chunks instead of reading it into memory
+            backend.upload(wiki_name, wiki_content.stream)
         except ValueError as ve:
             # upload failed in the backend, return an error page to the user
             return render_template('main.html',
@@ -65,3 +88,104 @@ def make_endpoints(app, backend):
                                    page_content=str(ve))
         # redirect the user to the new wiki page that they uploaded
         return redirect(url_for('show_page', page_name=wiki_name))
+
+    @app.route('/upload/url', methods=['POST'])
+    @login_required
+    def upload_url():
+        """Returns a signed URL to upload a new page straight to storage.
+
+        The response is JSON with the url and the HTTP method to send the
+        file with. Once the upload finished, the client posts the same
+        wikiname to /upload/complete.
+        """
+        wiki_name = request.form.get('wikiname')
+        if not wiki_name or backend.url_signer is None:
+            return jsonify(error='Need a name for the wiki page'), 400
+        try:
+            url, method = backend.create_upload_url(
+                wiki_name,
+                request.form.get('content_type') or 'application/octet-stream',
+                app.config['SIGNED_URL_TTL'])
+        except ValueError as ve:
+            return jsonify(error=str(ve)), 409
+        return jsonify(url=url, method=method)
+
+    @app.route('/upload/complete', methods=['POST'])
+    @login_required
+    def upload_complete():
+        """Registers a page that was uploaded through /upload/url."""
+        wiki_name = request.form.get('wikiname')
+        try:
+            backend.complete_upload(wiki_name)
+        except ValueError as ve:
+            return render_template('main.html',
+                                   page_name='Upload Failed!',
+                                   page_content=str(ve))
+        return redirect(url_for('show_page', page_name=wiki_name))
+
+    @app.route('/upload/resumable', methods=['POST'])
+    @login_required
+    def start_resumable_upload():
+        """Starts a resumable upload of a new page.
+
+        Expects the wikiname and the total size in bytes. Returns JSON with
+        the url to PUT the parts to and the size of the parts to send.
+        """
+        wiki_name = request.form.get('wikiname')
+        size = request.form.get('size', '')
+        if not wiki_name or not size.isdigit():
+            return jsonify(error='Need a name and a size for the upload'), 400
+        try:
+            upload_id = backend.start_upload(wiki_name, int(size),
+                                             app.config['UPLOAD_MAX_SIZE'])
+        except ValueError as ve:
+            return jsonify(error=str(ve)), 409
+        if upload_id is None:
+            # an empty page, there is nothing left to send
+            return jsonify(offset=0,
+                           complete=True,
+                           url=url_for('show_page', page_name=wiki_name)), 201
+        return jsonify(upload_id=upload_id,
+                       url=url_for('resumable_upload', upload_id=upload_id),
+                       chunk_size=app.config['UPLOAD_CHUNK_SIZE'],
+                       offset=0), 201
+
+    @app.route('/upload/resumable/<upload_id>', methods=['GET', 'PUT'])
+    @login_required
+    def resumable_upload(upload_id):
+        """Receives one part of a resumable upload or reports its offset.
+
+        A PUT carries a Content-Range header such as 'bytes 0-1048575/5000000'
+        and must start at the current offset, otherwise 409 is returned along
+        with the offset to continue from.
+        """
+        try:
+            if request.method == 'GET':
+                offset, size = backend.upload_offset(upload_id)
+                return jsonify(offset=offset, size=size)
+            content_range = parse_content_range_header(
+                request.headers.get('Content-Range'))
+            length = request.content_length
+            if content_range is None or length is None or (
+                    content_range.stop - content_range.start != length):
+                return jsonify(error='Need a Content-Range for the part'), 400
+            max_length = app.config['MAX_CONTENT_LENGTH']
+            if max_length is not None and length > max_length:
+                abort(413)
+            offset, name = backend.write_upload(upload_id,
+                                                content_range.start,
+                                                request.stream, length)
+        except KeyError:
+            abort(404)
+        except ConflictError:
+            offset, size = backend.upload_offset(upload_id)
+            return jsonify(error='Upload continues at a different offset',
+                           offset=offset,
+                           size=size), 409
+        except ValueError as ve:
+            return jsonify(error=str(ve)), 400
+        if name is None:
+            return jsonify(offset=offset, complete=False)
+        return jsonify(offset=offset,
+                       complete=True,
+                       url=url_for('show_page', page_name=name))
@@ -1,13 +1,16 @@
 from flaskr import create_app, user, backend
 from unittest.mock import patch
+from io import BytesIO
 from werkzeug.datastructures import FileStorage
 import pytest
 
 
 @pytest.fixture
-def app():
+def app(tmp_path):
     app = create_app({
         'TESTING': True,
+        'STORAGE_ENGINE': 'local',
+        'STORAGE_ROOT': str(tmp_path),
         'LOGIN_DISABLED': True,
     })
     return app
@@ -62,10 +65,10 @@ def test_upload_successful(client):
     # mock the backend upload() method to make things easier. We do not have to
     # mock the buckets or blobs.
     with patch('flaskr.backend.Backend.upload', return_value=None):
-        # mock the get_wiki_page() method which is called when we redirect the
-        # user after uploading the page.
-        with patch("flaskr.backend.Backend.get_wiki_page",
-                   return_value=b"Some info."):
+        # mock the get_wiki_page_info() method which is called when we
+        # redirect the user after uploading the page.
+        with patch("flaskr.backend.Backend.get_wiki_page_info",
+                   return_value=("Some info.", 1)):
             upload_resp = client.post("/upload",
                                       data={
                                           "wikiname":
@@ -79,3 +82,78 @@ def test_upload_successful(client):
             assert pages_resp.status_code == 200
             assert b"mywikiname" in pages_resp.data
             assert b"Some info." in pages_resp.data
+
+
+def test_upload_streams_file(app, client):
+    resp = client.post("/upload",
+                       data={
+                           "wikiname": "big",
+                           "wikicontent": (BytesIO(b"x" * 1000000), "big.txt")
+                       })
+
+    assert resp.status_code == 302
+    assert app.config["MAX_CONTENT_LENGTH"] > 1000000
+
+
+def test_upload_too_large(app, client):
+    app.config["MAX_CONTENT_LENGTH"] = 1000
+
+    resp = client.post("/upload",
+                       data={
+                           "wikiname": "big",
+                           "wikicontent": (BytesIO(b"x" * 2000), "big.txt")
+                       })
+
+    assert resp.status_code == 413
+
+
+def test_resumable_upload(client):
+    started = client.post("/upload/resumable",
+                          data={
+                              "wikiname": "big",
+                              "size": "10"
+                          })
+    url = started.json["url"]
+
+    assert started.status_code == 201
+    first = client.put(url,
+                       data=b"01234",
+                       headers={"Content-Range": "bytes 0-4/10"})
+    assert first.json == {"offset": 5, "complete": False}
+    # a retried part is rejected with the offset to continue from
+    retried = client.put(url,
+                         data=b"01234",
+                         headers={"Content-Range": "bytes 0-4/10"})
+    assert retried.status_code == 409
+    assert retried.json["offset"] == 5
+    assert client.get(url).json == {"offset": 5, "size": 10}
+    last = client.put(url,
+                      data=b"56789",
+                      headers={"Content-Range": "bytes 5-9/10"})
+    assert last.json["complete"]
+    assert b"0123456789" in client.get(last.json["url"]).data
+
+
+def test_resumable_upload_of_empty_page(client):
+    started = client.post("/upload/resumable",
+                          data={
+                              "wikiname": "empty",
+                              "size": "0"
+                          })
+
+    assert started.status_code == 201
+    assert started.json["complete"]
+    assert client.get(started.json["url"]).status_code == 200
+
+
+def test_resumable_upload_errors(client):
+    assert client.post("/upload/resumable", data={
+        "wikiname": "big"
+    }).status_code == 400
+    assert client.get("/upload/resumable/missing").status_code == 404
+    url = client.post("/upload/resumable",
+                      data={
+                          "wikiname": "big",
+                          "size": "10"
+                      }).json["url"]
+    assert client.put(url, data=b"0123").status_code == 400
@@ -8,17 +8,31 @@ Reference documentation: https://flask-login.readthedocs.io/en/latest/#your-user
 
 class User:
 
+    # a session loads its user on every request, so keep instances small
+    __slots__ = ('username',)
+
+    # by default, every User that we create is authenticated
+    is_authenticated = True
+    # by default, every User is active
+    is_active = True
+    # every user we encounter should not be anonymous. They must all have a
+    # username and password
+    is_anonymous = False
+
     def __init__(self, username):
         """Constructs a default instance of the User class for login/logout."""
 
         self.username = username
-        # by default, we return True to indicate that every User that we create will be authenticated
-        self.is_authenticated = True
-        # by default, we return True to indicate that every User is active
-        self.is_active = True
-        # every user we encounter should not be anonymous. They must all have a username and password
-        self.is_anonymous = False
 
     def get_id(self):
         """Return the string that uniquely identifies the user."""
         return self.username
+
+    def __eq__(self, other):
+        return isinstance(other, User) and self.username == other.username
+
+    def __hash__(self):
+        return hash(self.username)
+
+    def __repr__(self):
+        return f'User({self.username!r})'